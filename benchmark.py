@@ -0,0 +1,176 @@
+"""
+End-to-end benchmarks of lalalai_splitter against mock_lalalai, so that
+changes to scheduling can be compared by numbers.  Each run splits one
+generated input file with `batch_process_multiple_stems` and reports the
+wall time, the time until the first stem was downloaded, the bytes moved
+each way and the requests made.
+
+Usage:
+    python3 benchmark.py --stem-counts 1,3,6 --sizes 1,16 --concurrency 1x1,2x2,4x4
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import lalalai_splitter
+import mock_lalalai
+
+
+def parse_int_list(value):
+    """parses a comma-separated list of integers"""
+    return [int(item) for item in value.split(",") if item]
+
+
+def parse_concurrency(value):
+    """parses a comma-separated list of SPLITSxDOWNLOADS pairs"""
+    pairs = []
+    for item in value.split(","):
+        splits, _, downloads = item.partition("x")
+        pairs.append((int(splits), int(downloads or splits)))
+    return pairs
+
+
+def make_input_file(directory, megabytes):
+    """writes a file of `megabytes` of random data and returns its path"""
+    path = os.path.join(directory, f"bench_{megabytes}mb.wav")
+    with open(path, "wb") as f:
+        for _ in range(megabytes):
+            f.write(os.urandom(1024 * 1024))
+    return path
+
+
+def run_once(server, input_path, output_path, stem_count, splits, downloads):
+    """
+    Runs one batch against `server` and returns its measurements as a
+    dict.
+    """
+    events = []
+    lalalai_splitter.progress_handler = lambda event, fields: events.append(
+        (time.monotonic(), event)
+    )
+    server.api.reset_stats()
+    stems = lalalai_splitter.stem_types[:stem_count]
+
+    start = time.monotonic()
+    lalalai_splitter.batch_process_multiple_stems(
+        "0123456789abcdef",
+        input_path,
+        output_path,
+        stems,
+        [],
+        1,
+        "phoenix",
+        max_concurrent_splits=splits,
+        max_concurrent_downloads=downloads,
+        skip_existing=False,
+    )
+    wall = time.monotonic() - start
+
+    first_stem = min(
+        (t for t, event in events if event == "download_complete"), default=None
+    )
+    stats = server.api.stats
+    return {
+        "stems": stem_count,
+        "size_mb": os.path.getsize(input_path) // (1024 * 1024),
+        "splits": splits,
+        "downloads": downloads,
+        "wall_seconds": round(wall, 3),
+        "first_stem_seconds": (
+            round(first_stem - start, 3) if first_stem is not None else None
+        ),
+        "bytes_up": stats["bytes_in"],
+        "bytes_down": stats["bytes_out"],
+        "requests": sum(stats["requests"].values()),
+        "requests_by_endpoint": dict(stats["requests"]),
+        "injected_errors": stats["errors"],
+    }
+
+
+def print_table(results):
+    """prints `results` as an aligned table"""
+    columns = [
+        ("stems", "stems"),
+        ("size_mb", "MB"),
+        ("splits", "splits"),
+        ("downloads", "dls"),
+        ("wall_seconds", "wall s"),
+        ("first_stem_seconds", "1st stem s"),
+        ("bytes_up", "bytes up"),
+        ("bytes_down", "bytes down"),
+        ("requests", "requests"),
+    ]
+    rows = [[heading for _, heading in columns]]
+    rows.extend([str(result[key]) for key, _ in columns] for result in results)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark lalalai_splitter offline")
+    parser.add_argument(
+        "--stem-counts", type=parse_int_list, default=[1, 3, 6], help="e.g. 1,3,6"
+    )
+    parser.add_argument(
+        "--sizes", type=parse_int_list, default=[1, 16], help="input sizes in MB"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=parse_concurrency,
+        default=[(1, 1), (2, 2), (4, 4)],
+        help="SPLITSxDOWNLOADS pairs, e.g. 1x1,2x2,4x4",
+    )
+    parser.add_argument(
+        "--queue-delay", type=float, default=mock_lalalai.DEFAULT_QUEUE_DELAY
+    )
+    parser.add_argument(
+        "--split-time", type=float, default=mock_lalalai.DEFAULT_SPLIT_TIME
+    )
+    parser.add_argument(
+        "--curve", choices=["linear", "ease", "stall"], default="linear"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--download-rate", type=float, metavar="BYTES_PER_SECOND", default=None
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="print results as JSON lines"
+    )
+    args = parser.parse_args()
+
+    server = mock_lalalai.start_mock_server(
+        queue_delay=args.queue_delay,
+        split_time=args.split_time,
+        curve=args.curve,
+        error_rate=args.error_rate,
+        download_rate=args.download_rate,
+    )
+    lalalai_splitter.URL_API = server.url_api
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            input_path = make_input_file(directory, size)
+            for stem_count in args.stem_counts:
+                for splits, downloads in args.concurrency:
+                    output_path = tempfile.mkdtemp(dir=directory)
+                    result = run_once(
+                        server, input_path, output_path, stem_count, splits, downloads
+                    )
+                    if args.json:
+                        print(json.dumps(result), flush=True)
+                    results.append(result)
+
+    if not args.json:
+        print_table(results)
+    server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,530 @@
+"""
+Local audio processing for lalalai_splitter: reading and writing PCM WAV
+files in blocks, and the arithmetic done on them, vectorized with NumPy,
+and lossless FLAC encoding of PCM files with the `flac` or `ffmpeg`
+command.  NumPy is optional; without it, `numpy_available` returns False
+and the splitter skips the features that need it.  Likewise
+`flac_encoder` returns None if neither command is installed.
+"""
+
+import math
+import os
+import shutil
+import struct
+import subprocess
+import wave
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# frames read, processed and written at a time
+BLOCK_FRAMES = 65536
+
+# how much of the start of two tracks is compared to line them up, and
+# the largest offset between them that is looked for, in frames
+ALIGN_WINDOW_FRAMES = 1 << 17
+MAX_ALIGN_LAG = 4096
+
+# a synthesized backing track is only trusted if the stem correlates with
+# the original at least this much and taking it away didn't add energy
+MIN_STEM_CORRELATION = 0.05
+MAX_RESIDUAL_ENERGY_RATIO = 1.05
+
+# silence is audio whose peak stays at or below -60 dBFS; a margin of
+# it is left around what's heard, and it's only trimmed if there's at
+# least MIN_TRIM_SECONDS of it
+SILENCE_THRESHOLD = 10 ** (-60 / 20)
+SILENCE_MARGIN_SECONDS = 0.05
+MIN_TRIM_SECONDS = 1.0
+
+# the commands tried in turn for FLAC encoding and decoding, the widest
+# PCM samples they're given, in bytes, and how often a running one is
+# checked for having been cancelled, in seconds
+FLAC_ENCODERS = ("flac", "ffmpeg")
+FLAC_MAX_SAMPLE_WIDTH = 3
+CODEC_POLL_INTERVAL = 0.1
+
+# ffmpeg's PCM codecs by container and sample width, for decoding FLAC
+FFMPEG_PCM_CODECS = {
+    ".wav": {1: "pcm_u8", 2: "pcm_s16le", 3: "pcm_s24le"},
+    ".aif": {1: "pcm_s8", 2: "pcm_s16be", 3: "pcm_s24be"},
+    ".aiff": {1: "pcm_s8", 2: "pcm_s16be", 3: "pcm_s24be"},
+}
+
+
+def numpy_available():
+    """returns whether NumPy is installed"""
+    return np is not None
+
+
+def is_wav(path):
+    """returns whether `path` is a PCM WAV file that `wave` can read"""
+    try:
+        with wave.open(path, "rb"):
+            return True
+    except (wave.Error, EOFError, OSError):
+        return False
+
+
+def decode_frames(data, sample_width, channels):
+    """
+    Converts raw little-endian PCM `data` to a float64 array of shape
+    (frames, channels) with samples scaled to [-1, 1).
+    """
+    if sample_width == 1:
+        samples = np.frombuffer(data, dtype=np.uint8).astype(np.float64) - 128
+    elif sample_width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        samples = ((samples ^ 0x800000) - 0x800000).astype(np.float64)
+    else:
+        dtype = {2: "<i2", 4: "<i4"}[sample_width]
+        samples = np.frombuffer(data, dtype=dtype).astype(np.float64)
+    return samples.reshape(-1, channels) / (1 << (8 * sample_width - 1))
+
+
+def encode_frames(frames, sample_width):
+    """
+    Converts a float array of samples in [-1, 1) back to raw PCM bytes,
+    clipping anything out of range.
+    """
+    scale = 1 << (8 * sample_width - 1)
+    samples = np.clip(np.rint(frames.reshape(-1) * scale), -scale, scale - 1)
+    if sample_width == 1:
+        return (samples + 128).astype(np.uint8).tobytes()
+    if sample_width == 3:
+        raw = samples.astype("<i4").view(np.uint8).reshape(-1, 4)
+        return raw[:, :3].tobytes()
+    return samples.astype({2: "<i2", 4: "<i4"}[sample_width]).tobytes()
+
+
+def read_block(reader, nframes):
+    """reads up to `nframes` frames from a `wave` reader as floats"""
+    return decode_frames(
+        reader.readframes(nframes), reader.getsampwidth(), reader.getnchannels()
+    )
+
+
+def read_exact(reader, nframes):
+    """
+    Reads `nframes` frames from a `wave` reader as floats, padding with
+    silence past the end of the file.
+    """
+    frames = read_block(reader, nframes)
+    if len(frames) < nframes:
+        padding = np.zeros((nframes - len(frames), frames.shape[1]))
+        frames = np.concatenate([frames, padding])
+    return frames
+
+
+def same_format(first, second):
+    """returns whether two `wave` readers have the same channels and rate"""
+    return (
+        first.getnchannels() == second.getnchannels()
+        and first.getframerate() == second.getframerate()
+    )
+
+
+def estimate_lag(original_path, stem_path):
+    """
+    Estimates how many frames later the stem starts than the part of the
+    original it was separated from, by cross-correlating the first
+    ALIGN_WINDOW_FRAMES of each, mixed down to mono.  Negative if the
+    stem starts early.
+    """
+    with wave.open(original_path, "rb") as original, wave.open(
+        stem_path, "rb"
+    ) as stem:
+        a = read_block(original, ALIGN_WINDOW_FRAMES).mean(axis=1)
+        b = read_block(stem, ALIGN_WINDOW_FRAMES).mean(axis=1)
+    if not len(a) or not len(b) or not b.any():
+        return 0
+    size = 1 << math.ceil(math.log2(len(a) + len(b)))
+    correlation = np.fft.irfft(np.fft.rfft(b, size) * np.conj(np.fft.rfft(a, size)))
+    # lags from -MAX_ALIGN_LAG to MAX_ALIGN_LAG, negative ones wrapped around
+    lags = np.concatenate(
+        [np.arange(0, MAX_ALIGN_LAG + 1), np.arange(-MAX_ALIGN_LAG, 0)]
+    )
+    candidates = np.concatenate(
+        [correlation[: MAX_ALIGN_LAG + 1], correlation[-MAX_ALIGN_LAG:]]
+    )
+    return int(lags[np.argmax(candidates)])
+
+
+def subtract_stem(original_path, stem_path, output_path):
+    """
+    Writes the original minus the stem to `output_path`, in the original's
+    format and bit depth, a block at a time, after lining the stem up with
+    the original.  This is the backing track for the stem, made locally.
+
+    Returns True if the result passed the residual check: the stem has to
+    correlate with the original, and taking it away can't leave more
+    energy than there was to start with.  If it didn't, or the two files
+    aren't WAVs of the same channels and sample rate, `output_path` is
+    removed and False is returned, and the backing track should be
+    downloaded instead.
+    """
+    if not (is_wav(original_path) and is_wav(stem_path)):
+        return False
+    lag = estimate_lag(original_path, stem_path)
+
+    original_energy = stem_energy = residual_energy = cross = 0.0
+    with wave.open(original_path, "rb") as original, wave.open(
+        stem_path, "rb"
+    ) as stem:
+        if not same_format(original, stem):
+            return False
+        with wave.open(output_path, "wb") as output:
+            output.setnchannels(original.getnchannels())
+            output.setsampwidth(original.getsampwidth())
+            output.setframerate(original.getframerate())
+
+            # line the stem up: skip its extra lead-in, or pad it with
+            # silence if it starts early
+            if lag > 0:
+                stem.readframes(lag)
+            lead_in = max(0, -lag)
+
+            while True:
+                a = read_block(original, BLOCK_FRAMES)
+                if not len(a):
+                    break
+                if lead_in:
+                    pad = min(lead_in, len(a))
+                    lead_in -= pad
+                    b = np.concatenate(
+                        [np.zeros((pad, a.shape[1])), read_exact(stem, len(a) - pad)]
+                    )
+                else:
+                    b = read_exact(stem, len(a))
+                residual = a - b
+                output.writeframes(encode_frames(residual, original.getsampwidth()))
+
+                original_energy += float(np.einsum("ij,ij->", a, a))
+                stem_energy += float(np.einsum("ij,ij->", b, b))
+                residual_energy += float(np.einsum("ij,ij->", residual, residual))
+                cross += float(np.einsum("ij,ij->", a, b))
+
+    passed = residual_energy <= original_energy * MAX_RESIDUAL_ENERGY_RATIO
+    if stem_energy > 0 and original_energy > 0:
+        correlation = cross / math.sqrt(original_energy * stem_energy)
+        passed = passed and correlation >= MIN_STEM_CORRELATION
+    if not passed:
+        os.remove(output_path)
+    return passed
+
+
+class SilenceTrim:
+    """
+    Where the audible part of a WAV file lies: `lead_frames` of silence
+    come before it and `total_frames` is the length of the whole file.
+    `frame_size` is the bytes per frame, for working out what trimming
+    saves.
+    """
+
+    def __init__(self, lead_frames, kept_frames, total_frames, framerate, frame_size):
+        self.lead_frames = lead_frames
+        self.kept_frames = kept_frames
+        self.total_frames = total_frames
+        self.framerate = framerate
+        self.frame_size = frame_size
+
+    @property
+    def trimmed_frames(self):
+        return self.total_frames - self.kept_frames
+
+    @property
+    def seconds_saved(self):
+        return self.trimmed_frames / self.framerate
+
+    @property
+    def bytes_saved(self):
+        return self.trimmed_frames * self.frame_size
+
+
+def measure_silence(path, threshold=SILENCE_THRESHOLD):
+    """
+    Finds the leading and trailing silence of the WAV file at `path`,
+    reading it a block at a time; silence is anything whose peak on every
+    channel is at or below `threshold`.  A margin of SILENCE_MARGIN_SECONDS
+    is left around the audible part.  Returns a `SilenceTrim`, or None if
+    there's less than MIN_TRIM_SECONDS of silence to trim.
+    """
+    first = last = None
+    position = 0
+    with wave.open(path, "rb") as reader:
+        framerate = reader.getframerate()
+        frame_size = reader.getsampwidth() * reader.getnchannels()
+        while len(block := read_block(reader, BLOCK_FRAMES)):
+            loud = np.flatnonzero(np.abs(block).max(axis=1) > threshold)
+            if len(loud):
+                if first is None:
+                    first = position + int(loud[0])
+                last = position + int(loud[-1])
+            position += len(block)
+
+    if first is None:
+        return None
+    margin = int(SILENCE_MARGIN_SECONDS * framerate)
+    start = max(0, first - margin)
+    end = min(position, last + 1 + margin)
+    if position - (end - start) < MIN_TRIM_SECONDS * framerate:
+        return None
+    return SilenceTrim(start, end - start, position, framerate, frame_size)
+
+
+def write_frames(path, start, nframes, output_path):
+    """
+    Writes `nframes` frames of the WAV file at `path`, from frame `start`
+    on, to a WAV file of the same format at `output_path`.
+    """
+    with wave.open(path, "rb") as reader, wave.open(output_path, "wb") as writer:
+        writer.setparams(reader.getparams())
+        reader.setpos(start)
+        copy_frames(reader, writer, nframes, pad=False)
+
+
+def write_trimmed(path, trim, output_path):
+    """writes the part of the WAV file at `path` that `trim` keeps"""
+    write_frames(path, trim.lead_frames, trim.kept_frames, output_path)
+
+
+def write_silence(writer, nframes):
+    """writes `nframes` frames of silence with a `wave` writer"""
+    frame_size = writer.getsampwidth() * writer.getnchannels()
+    # 8-bit samples are unsigned, with silence in the middle of the range
+    silence = b"\x80" if writer.getsampwidth() == 1 else b"\0"
+    block = silence * (min(nframes, BLOCK_FRAMES) * frame_size)
+    while nframes > 0:
+        count = min(nframes, BLOCK_FRAMES)
+        writer.writeframes(block[: count * frame_size])
+        nframes -= count
+
+
+def copy_frames(reader, writer, nframes, pad=True):
+    """
+    Copies `nframes` frames from a `wave` reader to a writer of the same
+    format, as they are, a block at a time.  If the reader runs out first,
+    the rest is made up with silence, unless `pad` is false.
+    """
+    frame_size = reader.getsampwidth() * reader.getnchannels()
+    while nframes > 0:
+        data = reader.readframes(min(BLOCK_FRAMES, nframes))
+        if not data:
+            break
+        writer.writeframes(data)
+        nframes -= len(data) // frame_size
+    if pad:
+        write_silence(writer, nframes)
+
+
+def restore_silence(path, trim):
+    """
+    Puts back the silence that `trim` took off, around the track split
+    from the trimmed audio at `path`, so that it lines up sample for
+    sample with the original.  The track is cut or padded to the
+    original's length.  Returns False, leaving the file alone, if it isn't
+    a WAV at the original's sample rate.
+    """
+    if not is_wav(path):
+        return False
+    part_path = path + ".pad"
+    with wave.open(path, "rb") as reader:
+        if reader.getframerate() != trim.framerate:
+            return False
+        with wave.open(part_path, "wb") as writer:
+            writer.setparams(reader.getparams())
+            write_silence(writer, trim.lead_frames)
+            copy_frames(reader, writer, trim.total_frames - trim.lead_frames)
+    os.replace(part_path, path)
+    return True
+
+
+def wav_length(path):
+    """returns the frame count and sample rate of the WAV file at `path`"""
+    with wave.open(path, "rb") as reader:
+        return reader.getnframes(), reader.getframerate()
+
+
+def plan_segments(total_frames, segment_frames, overlap_frames):
+    """
+    Divides `total_frames` frames into as few segments of at most
+    `segment_frames` frames as will do, each overlapping the next by
+    `overlap_frames`, and as near the same length as they can be.
+    Returns a list of (start frame, frame count) pairs.
+    """
+    step = max(1, segment_frames - overlap_frames)
+    count = max(1, math.ceil((total_frames - overlap_frames) / step))
+    step = math.ceil((total_frames - overlap_frames) / count)
+    return [
+        (i * step, min(step + overlap_frames, total_frames - i * step))
+        for i in range(count)
+    ]
+
+
+def crossfade(tail, head):
+    """
+    Fades from `tail`, the end of one segment's track, into `head`, the
+    start of the next one's, over the same frames of the input, with
+    raised-cosine gains that always sum to one.
+    """
+    fade_in = 0.5 - 0.5 * np.cos(np.linspace(0, np.pi, len(tail)))
+    return tail + (head - tail) * fade_in[:, None]
+
+
+def stitch_segments(paths, segments, output_path):
+    """
+    Joins the tracks at `paths`, split from the overlapping `segments` of
+    an input, given as (start frame, frame count) pairs, back into one
+    track at `output_path` as long as the input.  Each track crossfades
+    into the next over the frames they overlap; the rest is copied as it
+    is.  Returns False, writing nothing, unless the tracks are all WAVs
+    of the same format.
+    """
+    params = None
+    for path in paths:
+        if not is_wav(path):
+            return False
+        with wave.open(path, "rb") as reader:
+            if params is None:
+                params = reader.getparams()
+            elif reader.getparams()[:3] != params[:3]:
+                return False
+
+    part_path = output_path + ".part"
+    tail = None
+    with wave.open(part_path, "wb") as writer:
+        writer.setparams(params)
+        for i, (path, (start, nframes)) in enumerate(zip(paths, segments)):
+            lead = follow = 0
+            if i > 0:
+                lead = sum(segments[i - 1]) - start
+            if i + 1 < len(segments):
+                follow = start + nframes - segments[i + 1][0]
+            with wave.open(path, "rb") as reader:
+                if lead:
+                    head = read_exact(reader, lead)
+                    writer.writeframes(
+                        encode_frames(crossfade(tail, head), params.sampwidth)
+                    )
+                copy_frames(reader, writer, nframes - lead - follow)
+                if follow:
+                    tail = read_exact(reader, follow)
+    os.replace(part_path, output_path)
+    return True
+
+
+def flac_encoder():
+    """returns the path of the first of FLAC_ENCODERS installed, or None"""
+    for name in FLAC_ENCODERS:
+        path = shutil.which(name)
+        if path is not None:
+            return path
+    return None
+
+
+def pcm_sample_width(path):
+    """
+    Returns the bytes per sample of the uncompressed PCM WAV or AIFF file
+    at `path`, or None if it's anything else, such as a compressed or
+    floating point file.
+    """
+    if is_wav(path):
+        with wave.open(path, "rb") as reader:
+            return reader.getsampwidth()
+    try:
+        with open(path, "rb") as f:
+            form, _, form_type = struct.unpack(">4sI4s", f.read(12))
+            if form != b"FORM" or form_type != b"AIFF":
+                return None
+            # the sample size is in the COMM chunk, after the channel and
+            # frame counts
+            while header := f.read(8):
+                chunk_id, size = struct.unpack(">4sI", header)
+                if chunk_id == b"COMM":
+                    _, _, bits = struct.unpack(">HIH", f.read(8))
+                    return (bits + 7) // 8
+                f.seek(size + size % 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        pass
+    return None
+
+
+def run_codec(args, output_path, cancel=None):
+    """
+    Runs the encoder or decoder command `args`, which writes
+    `output_path`, stopping it if the `cancel` event is set.  Raises
+    `RuntimeError` with what it wrote to stderr if it fails, removing
+    whatever it wrote.
+    """
+    process = subprocess.Popen(
+        args,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    try:
+        while True:
+            try:
+                _, stderr = process.communicate(timeout=CODEC_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel is not None and cancel.is_set():
+                    process.kill()
+                    process.wait()
+                    raise RuntimeError(f"{os.path.basename(args[0])} cancelled")
+        if process.returncode != 0:
+            message = stderr.decode(errors="replace").strip().splitlines()
+            raise RuntimeError(
+                f"{os.path.basename(args[0])} failed: "
+                + (message[-1] if message else f"exit status {process.returncode}")
+            )
+    except BaseException:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+
+
+def encode_flac(path, output_path, cancel=None):
+    """
+    Encodes the PCM WAV or AIFF file at `path` as FLAC at `output_path`
+    with `flac_encoder`.  The encoder streams from one file to the other,
+    so nothing is held in memory.  Raises `RuntimeError` if there's no
+    encoder or it fails.
+    """
+    encoder = flac_encoder()
+    if encoder is None:
+        raise RuntimeError("neither flac nor ffmpeg is installed")
+    if os.path.basename(encoder).startswith("ffmpeg"):
+        args = [encoder, "-nostdin", "-v", "error", "-y", "-i", path]
+        args += ["-map", "0:a", "-c:a", "flac", output_path]
+    else:
+        args = [encoder, "--silent", "--force", "-5", "-o", output_path, path]
+    run_codec(args, output_path, cancel)
+
+
+def decode_flac(path, output_path, sample_width, cancel=None):
+    """
+    Decodes the FLAC file at `path` back to PCM with `sample_width` bytes
+    per sample, as a WAV or AIFF file according to `output_path`'s
+    extension.  Raises `RuntimeError` if there's no decoder or it fails.
+    """
+    decoder = flac_encoder()
+    if decoder is None:
+        raise RuntimeError("neither flac nor ffmpeg is installed")
+    extension = os.path.splitext(output_path)[1].lower()
+    if os.path.basename(decoder).startswith("ffmpeg"):
+        codec = FFMPEG_PCM_CODECS.get(extension, FFMPEG_PCM_CODECS[".wav"])
+        args = [decoder, "-nostdin", "-v", "error", "-y", "-i", path]
+        args += ["-map", "0:a", "-c:a", codec[sample_width], output_path]
+    else:
+        args = [decoder, "--silent", "--force", "--decode"]
+        if extension in (".aif", ".aiff"):
+            args.append("--force-aiff-format")
+        args += ["-o", output_path, path]
+    run_codec(args, output_path, cancel)
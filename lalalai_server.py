@@ -0,0 +1,750 @@
+"""
+A job server for lalalai_splitter, so that one process, with the
+shop's license keys, does the splitting for everyone on the network.
+Clients submit audio files over HTTP and get back a job ID, with which
+they can follow the job's progress, cancel it and fetch its tracks.
+
+Jobs are run by a pool of workers sharing one `Scheduler`, taking turns
+among clients so that one client's long backlog doesn't hold up
+another's single file.  Identical inputs, split with the same filter and
+splitter, share one upload and one split: a job submitted while another
+for the same input is waiting is merged into it, and a later one finds
+the tracks already in the output manifest.
+
+Endpoints:
+    POST   /jobs?stems=vocals&backing_tracks=vocals&filename=song.wav
+           (the body is the audio file; also filter, splitter and client,
+           which defaults to the X-Client header or the remote address)
+    GET    /jobs?client=NAME               a client's jobs
+    GET    /jobs/ID                        a job's status and tracks
+    GET    /jobs/ID/events?since=N         its progress, as JSON lines,
+                                           until it's finished
+    GET    /jobs/ID/tracks/NAME            a track
+    DELETE /jobs/ID                        cancel a job
+
+Usage:
+    python3 lalalai_server.py --root /srv/unmixer --port 8766
+    curl --data-binary @song.wav \
+        'http://localhost:8766/jobs?stems=vocals&filename=song.wav'
+"""
+
+import asyncio
+import collections
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import lalalai_splitter
+
+DEFAULT_PORT = 8766
+
+# the largest file accepted, and the blocks files are received and sent in
+MAX_UPLOAD_BYTES = 2 * 1024 * 1024 * 1024
+TRANSFER_BLOCK_SIZE = 1024 * 1024
+
+# how long an event stream may go quiet before a blank line is sent, to
+# keep the connection alive through proxies
+EVENT_STREAM_KEEPALIVE = 15.0
+
+# how many of its latest events a job keeps, how long a finished job is
+# kept before it's forgotten (its tracks stay on disk), and how often
+# finished jobs are looked for
+JOB_MAX_EVENTS = 1000
+JOB_RETENTION = 24 * 60 * 60
+JOB_EXPIRE_INTERVAL = 60.0
+
+FILTERS = {"mild": 0, "normal": 1, "aggressive": 2}
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+
+class FairQueue:
+    """
+    Runs waiting for a worker, queued per client and handed out to the
+    client served least recently, so that clients take turns however
+    many runs each has queued.  Used only on the service's event loop.
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.served = {}
+        self.count = 0
+        self.changed = asyncio.Event()
+
+    def put(self, client, item):
+        self.queues.setdefault(client, collections.deque()).append(item)
+        self.changed.set()
+
+    def remove(self, client, item):
+        """take an item that hasn't been handed out off the queue"""
+        items = self.queues.get(client)
+        if items is not None and item in items:
+            items.remove(item)
+            if not items:
+                del self.queues[client]
+
+    async def get(self):
+        """waits for the oldest item of the client served least recently"""
+        while not self.queues:
+            self.changed.clear()
+            await self.changed.wait()
+        client = min(self.queues, key=lambda c: self.served.get(c, 0))
+        self.count += 1
+        self.served[client] = self.count
+        items = self.queues[client]
+        item = items.popleft()
+        if not items:
+            del self.queues[client]
+        return item
+
+
+class Run:
+    """
+    One call of `async_batch_process_multiple_stems` for an input, on
+    behalf of the jobs that asked for it.  `index` tags its progress
+    events, as the file index, so they can be routed to its jobs.
+    """
+
+    def __init__(self, index, key, client, input_path, output_path):
+        self.index = index
+        self.key = key
+        self.client = client
+        self.input_path = input_path
+        self.output_path = output_path
+        self.jobs = []
+        self.status = "queued"
+        self.task = None
+
+    @property
+    def filter_type(self):
+        return self.key[1]
+
+    @property
+    def splitter(self):
+        return self.key[2]
+
+    def stems(self):
+        """the stems any of its jobs want"""
+        return sorted({stem for job in self.jobs for stem in job.stems})
+
+    def backing_tracks(self):
+        """the backing tracks any of its jobs want"""
+        return sorted({stem for job in self.jobs for stem in job.backing_tracks})
+
+
+class Job:
+    """A client's request to split a file, and what has come of it."""
+
+    def __init__(self, client, filename, stems, backing_tracks):
+        self.id = uuid.uuid4().hex[:16]
+        self.client = client
+        self.filename = filename
+        self.stems = stems
+        self.backing_tracks = backing_tracks
+        self.run = None
+        self.status = "queued"
+        self.error = None
+        self.events = collections.deque(maxlen=JOB_MAX_EVENTS)
+        self.event_count = 0
+        self.submitted = time.time()
+        self.finished = None
+
+    def wants(self, stem, track_type):
+        """whether the job asked for `stem`'s track of `track_type`"""
+        return track_type in lalalai_splitter.wanted_track_types(
+            stem, self.stems, self.backing_tracks
+        )
+
+    def add_event(self, record):
+        self.events.append(record)
+        self.event_count += 1
+
+    def events_since(self, since):
+        """the events it still has from the `since`th on"""
+        first = self.event_count - len(self.events)
+        return list(itertools.islice(self.events, max(0, since - first), None))
+
+    def finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.finished = time.time()
+
+
+class JobService:
+    """
+    The jobs submitted to the server, and the event loop, on a thread of
+    its own, where `workers` tasks run them.  Methods are called from the
+    HTTP server's threads; the job table is guarded by `lock`, which is
+    also notified whenever a job gets an event or finishes.  Finished
+    jobs are forgotten after `job_retention` seconds.  Other keyword
+    arguments are passed on to `async_batch_process_multiple_stems`.
+    """
+
+    def __init__(
+        self,
+        api_key,
+        root,
+        workers,
+        scheduler_options,
+        job_retention=JOB_RETENTION,
+        **kwargs,
+    ):
+        self.api_key = api_key
+        self.root = root
+        self.workers = max(1, workers)
+        self.scheduler_options = scheduler_options
+        self.job_retention = job_retention
+        self.kwargs = kwargs
+        self.lock = threading.Condition()
+        self.jobs = {}
+        self.runs = {}
+        self.queued_runs = {}
+        self.run_count = 0
+        self.loop = asyncio.new_event_loop()
+        for name in ("incoming", "inputs", "results"):
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+
+    def start(self):
+        """start the event loop and its workers"""
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.call(self.start_workers)
+        lalalai_splitter.event_bus.subscribe(self.route_event)
+
+    def call(self, fn, *args):
+        """runs fn(*args) on the event loop and returns its result"""
+
+        async def call():
+            return fn(*args)
+
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result()
+
+    def start_workers(self):
+        self.scheduler = lalalai_splitter.Scheduler(**self.scheduler_options)
+        self.queue = FairQueue()
+        self.input_locks = {}
+        for _ in range(self.workers):
+            self.loop.create_task(self.work())
+        self.loop.create_task(self.expire_jobs())
+
+    async def expire_jobs(self):
+        """forget the jobs that finished more than `job_retention` ago"""
+        while True:
+            await asyncio.sleep(JOB_EXPIRE_INTERVAL)
+            cutoff = time.time() - self.job_retention
+            with self.lock:
+                for job_id, job in list(self.jobs.items()):
+                    if job.finished is not None and job.finished < cutoff:
+                        del self.jobs[job_id]
+
+    def receive(self, rfile, length):
+        """
+        Saves `length` bytes of an uploaded file from `rfile` into the
+        incoming directory, returning its path and SHA-256 hex digest.
+        """
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.join(self.root, "incoming"), delete=False
+        ) as f:
+            try:
+                while length > 0:
+                    block = rfile.read(min(length, TRANSFER_BLOCK_SIZE))
+                    if not block:
+                        raise ValueError("the upload was cut short")
+                    digest.update(block)
+                    f.write(block)
+                    length -= len(block)
+            except BaseException:
+                f.close()
+                os.unlink(f.name)
+                raise
+        return f.name, digest.hexdigest()
+
+    def submit(self, job, upload_path, digest, filter_type, splitter):
+        """
+        Queues `job` for the file received at `upload_path`, merging it
+        into a waiting run of the same input if there is one.
+        """
+        # the input and its tracks are named for its contents, not for
+        # whatever each client called it
+        extension = os.path.splitext(job.filename)[1].lower()
+        input_path = os.path.join(self.root, "inputs", digest[:16] + extension)
+        if os.path.exists(input_path):
+            os.unlink(upload_path)
+        else:
+            os.replace(upload_path, input_path)
+        output_path = os.path.join(
+            self.root, "results", f"{digest[:16]}-{filter_type}-{splitter}"
+        )
+        os.makedirs(output_path, exist_ok=True)
+        key = (digest, filter_type, splitter)
+        self.call(self.enqueue, job, key, input_path, output_path)
+
+    def enqueue(self, job, key, input_path, output_path):
+        with self.lock:
+            run = self.queued_runs.get(key)
+            if run is None:
+                self.run_count += 1
+                run = Run(self.run_count, key, job.client, input_path, output_path)
+                self.runs[run.index] = run
+                self.queued_runs[key] = run
+                self.queue.put(job.client, run)
+            run.jobs.append(job)
+            job.run = run
+            self.jobs[job.id] = job
+
+    def cancel(self, job_id):
+        """cancels a job, and its run if no other job wants it"""
+        self.call(self.cancel_job, job_id)
+
+    def cancel_job(self, job_id):
+        with self.lock:
+            job = self.jobs[job_id]
+            if job.status in FINISHED_STATUSES:
+                return
+            run = job.run
+            run.jobs.remove(job)
+            job.finish("cancelled")
+            self.lock.notify_all()
+            if run.jobs:
+                return
+            if run.status == "queued":
+                # not started, though it may be waiting for another run of
+                # its input to finish
+                self.queue.remove(run.client, run)
+                self.queued_runs.pop(run.key, None)
+                self.runs.pop(run.index, None)
+                run.status = "cancelled"
+            elif run.task is not None:
+                run.task.cancel()
+
+    async def work(self):
+        """run the queued runs one after another"""
+        while True:
+            run = await self.queue.get()
+            # a run of an input that's being split waits for that to
+            # finish, and then finds what it has in common in the manifest;
+            # each input's lock is kept only while runs of it want it
+            lock, users = self.input_locks.get(run.key, (asyncio.Lock(), 0))
+            self.input_locks[run.key] = (lock, users + 1)
+            try:
+                await self.run_locked(run, lock)
+            finally:
+                lock, users = self.input_locks[run.key]
+                if users == 1:
+                    del self.input_locks[run.key]
+                else:
+                    self.input_locks[run.key] = (lock, users - 1)
+
+    async def run_locked(self, run, lock):
+        """run `run` while holding its input's `lock`, unless cancelled"""
+        async with lock:
+            with self.lock:
+                if run.status == "cancelled":
+                    return
+                run.status = "running"
+                self.queued_runs.pop(run.key, None)
+                for job in run.jobs:
+                    job.status = "running"
+            run.task = asyncio.create_task(
+                lalalai_splitter.process_one_of_many(
+                    run.index,
+                    None,
+                    self.api_key,
+                    run.input_path,
+                    run.output_path,
+                    run.stems(),
+                    run.backing_tracks(),
+                    run.filter_type,
+                    run.splitter,
+                    scheduler=self.scheduler,
+                    **self.kwargs,
+                )
+            )
+            await asyncio.wait([run.task])
+        with self.lock:
+            if run.task.cancelled():
+                run.status, error = "cancelled", None
+            elif run.task.result() is not None:
+                run.status, error = "failed", str(run.task.result())
+            else:
+                run.status, error = "done", None
+            for job in run.jobs:
+                job.finish(run.status, error)
+            self.runs.pop(run.index, None)
+            self.lock.notify_all()
+
+    def route_event(self, event):
+        """adds a progress event to the jobs of the run it's about"""
+        if event.file_index is None:
+            return
+        with self.lock:
+            run = self.runs.get(event.file_index)
+            if run is None:
+                return
+            fields = {k: v for k, v in event.fields.items() if k != "file_index"}
+            fields.pop("path", None)
+            record = {"event": event.name, "time": event.time, **fields}
+            for job in run.jobs:
+                if event.stem is None or event.stem in (
+                    job.stems + job.backing_tracks
+                ):
+                    job.add_event(record)
+            self.lock.notify_all()
+
+    def tracks(self, job):
+        """
+        Returns a dict of the job's downloaded tracks, by the name they're
+        served under: the client's filename with the track's suffix.
+        """
+        run = job.run
+        manifest = lalalai_splitter.OutputManifest(run.output_path)
+        stored_name = os.path.splitext(os.path.basename(run.input_path))[0]
+        client_name = os.path.splitext(os.path.basename(job.filename))[0]
+        tracks = {}
+        for entry in manifest.entries:
+            if not job.wants(entry["stem"], entry["track_type"]):
+                continue
+            file_path = os.path.join(run.output_path, entry["file"])
+            if not os.path.isfile(file_path):
+                continue
+            name = entry["file"]
+            if name.startswith(stored_name):
+                name = client_name + name[len(stored_name) :]
+            tracks[name] = file_path
+        return tracks
+
+    def status(self, job):
+        """the job as a JSON-able dict"""
+        with self.lock:
+            status = {
+                "id": job.id,
+                "client": job.client,
+                "filename": job.filename,
+                "stems": job.stems,
+                "backing_tracks": job.backing_tracks,
+                "status": job.status,
+                "error": job.error,
+                "submitted": job.submitted,
+                "finished": job.finished,
+                "events": job.event_count,
+                "last_event": job.events[-1] if job.events else None,
+            }
+        status["tracks"] = sorted(self.tracks(job))
+        return status
+
+    def events(self, job, since):
+        """
+        Yields lists of the job's events from the `since`th on, as they
+        come, and an empty list after each quiet EVENT_STREAM_KEEPALIVE
+        seconds, until the job is finished and they've all been yielded.
+        """
+        while True:
+            with self.lock:
+                self.lock.wait_for(
+                    lambda: job.event_count > since
+                    or job.status in FINISHED_STATUSES,
+                    EVENT_STREAM_KEEPALIVE,
+                )
+                events = job.events_since(since)
+                finished = job.status in FINISHED_STATUSES
+                since = job.event_count
+            yield events
+            if finished:
+                return
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """Serves the requests of a `JobServer`, on keep-alive connections."""
+
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json({"status": "error", "error": message}, status)
+
+    def route(self):
+        """returns the path's parts after /jobs, and the query, or None"""
+        parts = urlsplit(self.path)
+        path = [unquote(part) for part in parts.path.strip("/").split("/")]
+        if path[0] != "jobs":
+            return None, None
+        return path[1:], {k: v[-1] for k, v in parse_qs(parts.query).items()}
+
+    def find_job(self, job_id):
+        with self.service.lock:
+            job = self.service.jobs.get(job_id)
+        if job is None:
+            self.send_error_json(404, f"no job {job_id}")
+        return job
+
+    def client(self, query):
+        client = query.get("client") or self.headers.get("X-Client")
+        return client or self.client_address[0]
+
+    def do_POST(self):
+        path, query = self.route()
+        if path != []:
+            self.close_connection = True
+            self.send_error_json(404, "not found")
+            return
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            self.close_connection = True
+            self.send_error_json(411, "Content-Length is required")
+            return
+
+        stems = lalalai_splitter.parse_stem_list(query.get("stems", ""))
+        backing_tracks = lalalai_splitter.parse_stem_list(
+            query.get("backing_tracks", "")
+        )
+        filename = os.path.basename(query.get("filename", "")) or "upload.wav"
+        error = None
+        invalid = lalalai_splitter.validate_stems(stems + backing_tracks)
+        if invalid is not None:
+            error = f"unknown stem: {invalid}"
+        elif not stems and not backing_tracks:
+            error = "at least one of stems or backing_tracks is required"
+        elif query.get("filter", "normal") not in FILTERS:
+            error = f"unknown filter: {query['filter']}"
+        elif query.get("splitter", "phoenix") not in ("phoenix", "cassiopeia"):
+            error = f"unknown splitter: {query['splitter']}"
+        elif not filename.lower().endswith(lalalai_splitter.AUDIO_EXTENSIONS):
+            error = f"not an audio file: {filename}"
+        elif length > MAX_UPLOAD_BYTES:
+            error = "file too large"
+        if error is not None:
+            # the body isn't read, so the connection can't be reused
+            self.close_connection = True
+            self.send_error_json(400, error)
+            return
+
+        try:
+            upload_path, digest = self.service.receive(self.rfile, length)
+        except ValueError as e:
+            self.close_connection = True
+            self.send_error_json(400, str(e))
+            return
+        job = Job(self.client(query), filename, stems, backing_tracks)
+        self.service.submit(
+            job,
+            upload_path,
+            digest,
+            FILTERS[query.get("filter", "normal")],
+            query.get("splitter", "phoenix"),
+        )
+        self.send_json(self.service.status(job), 202)
+
+    def do_GET(self):
+        path, query = self.route()
+        if path is None:
+            self.send_error_json(404, "not found")
+        elif path == []:
+            client = self.client(query)
+            with self.service.lock:
+                jobs = [j for j in self.service.jobs.values() if j.client == client]
+            self.send_json([self.service.status(job) for job in jobs])
+        elif len(path) == 1:
+            job = self.find_job(path[0])
+            if job is not None:
+                self.send_json(self.service.status(job))
+        elif len(path) == 2 and path[1] == "events":
+            job = self.find_job(path[0])
+            if job is not None:
+                since = query.get("since", "0")
+                self.send_events(job, int(since) if since.isdigit() else 0)
+        elif len(path) == 3 and path[1] == "tracks":
+            job = self.find_job(path[0])
+            if job is not None:
+                self.send_track(job, path[2])
+        else:
+            self.send_error_json(404, "not found")
+
+    def do_DELETE(self):
+        path, query = self.route()
+        if path is None or len(path) != 1:
+            self.send_error_json(404, "not found")
+            return
+        job = self.find_job(path[0])
+        if job is not None:
+            self.service.cancel(job.id)
+            self.send_json(self.service.status(job))
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def send_events(self, job, since):
+        """streams the job's events as JSON lines until it's finished"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for events in self.service.events(job, since):
+                lines = "".join(json.dumps(event) + "\n" for event in events)
+                self.write_chunk(lines.encode("utf-8") or b"\n")
+            self.write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def send_track(self, job, name):
+        file_path = self.service.tracks(job).get(name)
+        if file_path is None:
+            self.send_error_json(404, f"no track {name}")
+            return
+        with open(file_path, "rb") as f:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header(
+                "Content-Disposition",
+                f"attachment; filename*=utf-8''{quote(name)}",
+            )
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, TRANSFER_BLOCK_SIZE)
+
+
+class JobServer(ThreadingHTTPServer):
+    """An HTTP server for a `JobService`."""
+
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        super().__init__(address, JobHandler)
+        self.service = service
+
+
+def start_job_server(service, port=0, host="127.0.0.1"):
+    """
+    Starts `service` and a `JobServer` for it on a background thread, on
+    `port` (0 picks a free one), and returns the server.
+    """
+    service.start()
+    server = JobServer((host, port), service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = ArgumentParser(description="Split audio with Lalal.ai for others")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--root",
+        default=".",
+        help="directory to keep inputs and tracks in (default: .)",
+    )
+    parser.add_argument(
+        "--license",
+        default=os.environ.get("LALALAI_LICENSE"),
+        help="license key, or comma-separated keys to share the work among "
+        "(default: $LALALAI_LICENSE)",
+    )
+    parser.add_argument(
+        "--api-url",
+        default=lalalai_splitter.URL_API,
+        help="the API's base URL "
+        f"(default: $LALALAI_API_URL or {lalalai_splitter.URL_API})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="files split at once (default: uploads plus splits in flight)",
+    )
+    parser.add_argument(
+        "--max-concurrent-uploads",
+        type=int,
+        default=lalalai_splitter.DEFAULT_MAX_CONCURRENT_UPLOADS,
+    )
+    parser.add_argument(
+        "--max-upload-rate",
+        type=float,
+        metavar="BYTES_PER_SECOND",
+        help="cap on the combined upload rate",
+    )
+    parser.add_argument(
+        "--max-concurrent-splits",
+        type=int,
+        default=lalalai_splitter.DEFAULT_MAX_CONCURRENT_SPLITS,
+    )
+    parser.add_argument(
+        "--max-concurrent-downloads",
+        type=int,
+        default=lalalai_splitter.DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+    )
+    parser.add_argument(
+        "--trim-silence", action="store_true", help="as for lalalai_splitter"
+    )
+    parser.add_argument(
+        "--compress-uploads", action="store_true", help="as for lalalai_splitter"
+    )
+    parser.add_argument(
+        "--segment-minutes",
+        type=float,
+        metavar="MINUTES",
+        help="as for lalalai_splitter",
+    )
+    args = parser.parse_args()
+
+    if not args.license:
+        parser.error("a license key is required (--license or $LALALAI_LICENSE)")
+    lalalai_splitter.URL_API = args.api_url
+    lalalai_splitter.progress_handler = None
+    os.makedirs(args.root, exist_ok=True)
+
+    licenses = [key.strip() for key in args.license.split(",") if key.strip()]
+    if len(licenses) == 1:
+        license = licenses[0]
+    else:
+        license = lalalai_splitter.LicensePool(licenses)
+    service = JobService(
+        license,
+        os.path.abspath(args.root),
+        args.workers or args.max_concurrent_uploads + args.max_concurrent_splits,
+        {
+            "max_concurrent_uploads": args.max_concurrent_uploads,
+            "max_concurrent_splits": args.max_concurrent_splits,
+            "max_concurrent_downloads": args.max_concurrent_downloads,
+            "max_upload_rate": args.max_upload_rate,
+        },
+        # uploads of the same input are reused across restarts, too
+        upload_cache=lalalai_splitter.UploadCache(
+            os.path.join(args.root, "uploads.sqlite3")
+        ),
+        trim_silence=args.trim_silence,
+        compress_uploads=args.compress_uploads,
+        segment_seconds=args.segment_minutes and args.segment_minutes * 60,
+    )
+    server = start_job_server(service, args.port, args.host)
+    print(f"serving jobs on http://{args.host}:{server.server_address[1]}/jobs")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,18 +20,138 @@
 # SOFTWARE.
 
 
+import asyncio
+import contextlib
+import contextvars
+import email.utils
+import hashlib
+import http.client
+import io
 import json
+import math
 import os
+import queue
+import random
 import re
+import select
+import shutil
+import sqlite3
 import sys
+import tempfile
+import threading
 import time
+import wave
 from argparse import ArgumentParser
-from urllib.parse import quote, unquote, urlencode
-from urllib.request import urlopen, Request
+from concurrent.futures import Future, InvalidStateError
+from urllib.error import HTTPError
+from urllib.parse import quote, unquote, urlencode, urljoin, urlsplit
+
+import lalalai_audio
 
 
 CURRENT_DIR_PATH = os.path.dirname(os.path.realpath(__file__))
-URL_API = "https://www.lalal.ai/api/"
+# the API's base URL; point it elsewhere, such as at mock_lalalai, with
+# $LALALAI_API_URL or --api-url
+URL_API = os.environ.get("LALALAI_API_URL", "https://www.lalal.ai/api/")
+
+# how many splits to keep in flight on the server at once, and how many
+# downloads to run alongside them
+DEFAULT_MAX_CONCURRENT_SPLITS = 2
+DEFAULT_MAX_CONCURRENT_DOWNLOADS = 2
+
+# how many files to upload at once in a batch of files
+DEFAULT_MAX_CONCURRENT_UPLOADS = 1
+
+# file extensions picked up when a directory is given as input
+AUDIO_EXTENSIONS = (
+    ".wav",
+    ".aif",
+    ".aiff",
+    ".flac",
+    ".mp3",
+    ".ogg",
+    ".m4a",
+    ".aac",
+)
+
+# bounds on how long the status poller waits between checks of a task,
+# how much longer it waits each time a task is still queued, how long it
+# waits when a running task's progress hasn't moved, and how many IDs it
+# asks about in one check/ request
+POLL_MIN_INTERVAL = 1.0
+POLL_MAX_INTERVAL = 30.0
+POLL_QUEUED_BACKOFF = 1.5
+POLL_QUEUED_INTERVAL = 5.0
+POLL_BATCH_SIZE = 50
+
+# how many polls in a row may describe a different split of the same file
+# (see StatusPoller.update) before a task gives up on seeing its own
+POLL_MISMATCH_LIMIT = 60
+
+# how long a cached upload's file ID is trusted before uploading again,
+# and the block size used when hashing input files
+UPLOAD_CACHE_TTL = 7 * 24 * 60 * 60
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# persistent connections kept per host by the connection pool, how long
+# an idle one is kept before it's assumed the server has dropped it, and
+# how many redirects a request will follow
+HTTP_MAX_CONNECTIONS_PER_HOST = 8
+HTTP_MAX_IDLE = 30.0
+HTTP_MAX_REDIRECTS = 5
+
+# client-side limits on API requests: the average rate per second and the
+# largest burst, how many times a transient failure is retried and the
+# bounds of the jittered backoff between tries, and how many failures in a
+# row pause all requests for how many seconds
+API_REQUEST_RATE = 5.0
+API_REQUEST_BURST = 10
+API_RETRIES = 6
+API_BACKOFF_BASE = 1.0
+API_BACKOFF_MAX = 60.0
+API_FAILURE_THRESHOLD = 5
+API_COOLDOWN = 30.0
+
+# how long the minutes left on a license are trusted before asking the
+# billing API again
+LICENSE_LIMITS_TTL = 300.0
+
+# socket timeout for API requests in general and for uploads, whose
+# response can take a while after the last byte is sent
+HTTP_TIMEOUT = 60.0
+UPLOAD_TIMEOUT = 300.0
+
+# uploads: the block size the file is read and sent in, how often to report
+# progress, and how many times to retry a transient failure
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+UPLOAD_PROGRESS_INTERVAL = 1.0
+UPLOAD_RETRIES = 3
+
+# downloads: the read buffer size, how often to report progress, how many
+# times to resume a dropped download, and whether to reserve the file's
+# full size on disk up front
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+DOWNLOAD_PROGRESS_INTERVAL = 1.0
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_PREALLOCATE = False
+
+# bucket bounds of the metrics' histograms of durations, in seconds, and
+# of transfer rates, in bytes per second, and how often a metrics file is
+# rewritten during a run
+METRICS_SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+METRICS_RATE_BUCKETS = tuple(2 ** (10 + 2 * i) for i in range(11))
+METRICS_WRITE_INTERVAL = 10.0
+
+# long WAV inputs can be cut into segments of about DEFAULT_SEGMENT_SECONDS
+# that are split in parallel, each overlapping the next by
+# SEGMENT_OVERLAP_SECONDS so that their tracks can be crossfaded back
+# together; a segment that fails is tried again on its own this many times
+DEFAULT_SEGMENT_SECONDS = 600.0
+SEGMENT_OVERLAP_SECONDS = 2.0
+SEGMENT_RETRIES = 2
+
+# the file in each output directory that records what was downloaded there
+MANIFEST_NAME = ".unmixer_manifest.json"
 
 stem_types = [
     "vocals",
@@ -58,6 +178,474 @@ def validate_stems(stems):
     return None
 
 
+def format_rate(bytes_per_second):
+    """Formats a transfer rate for a progress message, e.g. "2.5MB/s"."""
+    for unit in ("B", "KB", "MB"):
+        if bytes_per_second < 1024:
+            return f"{bytes_per_second:.1f}{unit}/s"
+        bytes_per_second /= 1024
+    return f"{bytes_per_second:.1f}GB/s"
+
+
+def format_progress_field(name, value):
+    """
+    Formats one field of a progress message the way the GUI expects it:
+    paths quoted, percentages with a "%" and rates in human units.
+    """
+    if value is None:
+        return "?"
+    if name == "path":
+        return f'"{value}"'
+    if name == "percent":
+        return f"{value}%"
+    if name == "bytes_per_second":
+        return format_rate(value)
+    if name == "segment":
+        return f"#{value}"
+    if name == "file_index":
+        return f"@{value}"
+    return str(value)
+
+
+def print_progress(event, fields):
+    """
+    Prints a progress event as a "%event field..." line, the form that
+    UnMixer's GUI picks out of the output.  The line is written in one
+    call so that lines from different threads don't interleave.
+    """
+    words = [f"%{event}"]
+    words.extend(format_progress_field(name, value) for name, value in fields.items())
+    sys.stdout.write(" ".join(words) + "\n")
+
+
+def print_progress_json(event, fields):
+    """Prints a progress event as one line of JSON."""
+    line = json.dumps({"event": event, "time": time.time(), **fields})
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+# the phases of processing a file, which a progress event whose name
+# starts with one of them is about
+EVENT_PHASES = ("upload", "compress", "split", "download", "segment", "stitch")
+
+
+class ProgressEvent:
+    """
+    A progress event as an object: its `name`, the `time` it happened,
+    the `file_index`, `segment`, `stem` and `track_type` it's about, the
+    `phase` of processing it belongs to, and the `percent` done and
+    `bytes` moved, each None where it doesn't apply.  Everything reported
+    with it, those included, is in the `fields` dict.
+    """
+
+    __slots__ = (
+        "name",
+        "time",
+        "file_index",
+        "segment",
+        "stem",
+        "track_type",
+        "phase",
+        "percent",
+        "bytes",
+        "fields",
+    )
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.time = time.time()
+        self.file_index = fields.get("file_index")
+        self.segment = fields.get("segment")
+        self.stem = fields.get("stem")
+        self.track_type = fields.get("track_type")
+        self.phase = next(
+            (phase for phase in EVENT_PHASES if name.startswith(phase)), None
+        )
+        self.percent = fields.get("percent")
+        self.bytes = fields.get("bytes")
+        self.fields = fields
+
+    def __repr__(self):
+        return f"ProgressEvent({self.name!r}, {self.fields!r})"
+
+
+class EventBus:
+    """
+    Hands each progress event, as a `ProgressEvent`, to everything that
+    has subscribed to it: callbacks, which are called on the thread that
+    reported the event and so should be quick, and queues, for consumers
+    like the GUI that handle events on a thread of their own.  With no
+    subscribers, publishing an event costs one check.
+
+    A bus is safe to share between threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = ()
+
+    def subscribe(self, callback):
+        """
+        Calls `callback` with each event from now on.  Returns it, to be
+        given to `unsubscribe`.
+        """
+        with self.lock:
+            self.subscribers += (callback,)
+        return callback
+
+    def subscribe_queue(self):
+        """
+        Returns a `queue.SimpleQueue` that each event from now on is put
+        on.  Its `put` method is what to give to `unsubscribe`.
+        """
+        events = queue.SimpleQueue()
+        self.subscribe(events.put)
+        return events
+
+    def unsubscribe(self, callback):
+        """stops calling `callback`"""
+        with self.lock:
+            self.subscribers = tuple(s for s in self.subscribers if s != callback)
+
+    def publish(self, name, fields):
+        """delivers an event to every subscriber"""
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+        event = ProgressEvent(name, fields)
+        for subscriber in subscribers:
+            subscriber(event)
+
+
+# how progress events get reported: `progress_handler` is called with the
+# event's name and fields, and may be set to None, as the GUI does, to
+# leave them to `event_bus`; main switches it to print_progress_json
+progress_handler = print_progress
+event_bus = EventBus()
+
+# the position in its batch of the file being worked on, if any, which
+# is added to every progress event about it
+current_file_index = contextvars.ContextVar("current_file_index", default=None)
+
+# likewise the 1-based number of the segment being worked on, when a long
+# file is processed in segments
+current_segment = contextvars.ContextVar("current_segment", default=None)
+
+
+def report(event, **fields):
+    """Reports a progress event through `progress_handler` and `event_bus`."""
+    if tracer is not None:
+        tracer.marker(event, fields.get("stem") or "batch", dict(fields))
+    segment = current_segment.get()
+    if segment is not None:
+        fields["segment"] = segment
+    file_index = current_file_index.get()
+    if file_index is not None:
+        fields["file_index"] = file_index
+    if progress_handler is not None:
+        progress_handler(event, fields)
+    event_bus.publish(event, fields)
+
+
+class Histogram:
+    """
+    Counts observations into cumulative buckets, Prometheus style, with
+    the sum and count of everything observed.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """add `value` to the histogram"""
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def escape_label_value(value):
+    """
+    Escapes a label value for the Prometheus text format, in which
+    backslashes, double quotes and newlines must be backslash-escaped.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Counters and histograms of how a run went: the time each phase of
+    each stem took (upload, queue, split and download), the bytes moved
+    and the rate they moved at, and the count and latency of HTTP
+    requests by endpoint.  Each metric is identified by a name and a set
+    of labels, and can be exported in the Prometheus text format or as a
+    JSON snapshot.
+
+    Recording is off unless `enable_metrics` has been called; until then
+    each hook costs one test of the module's `metrics` for None.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def add(self, name, amount=1, **labels):
+        """add `amount` to the counter `name` with `labels`"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=METRICS_SECONDS_BUCKETS, **labels):
+        """add `value` to the histogram `name` with `labels`"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def observe_transfer(self, phase, seconds, nbytes, **labels):
+        """record the time, bytes and rate of an upload or download"""
+        self.observe("unmixer_phase_seconds", seconds, phase=phase, **labels)
+        self.add("unmixer_bytes_total", nbytes, phase=phase)
+        if seconds > 0:
+            self.observe(
+                "unmixer_bytes_per_second",
+                nbytes / seconds,
+                buckets=METRICS_RATE_BUCKETS,
+                phase=phase,
+            )
+
+    def snapshot(self):
+        """returns everything recorded so far as a JSON-ready dict"""
+        with self.lock:
+            return {
+                "time": time.time(),
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "buckets": dict(zip(h.buckets, h.counts)),
+                        "sum": h.sum,
+                        "count": h.count,
+                    }
+                    for (name, labels), h in sorted(self.histograms.items())
+                ],
+            }
+
+    def prometheus(self):
+        """returns everything recorded so far in the Prometheus text format"""
+
+        def format_labels(labels, **extra):
+            pairs = [*labels, *extra.items()]
+            if not pairs:
+                return ""
+            return (
+                "{"
+                + ",".join(f'{k}="{escape_label_value(v)}"' for k, v in pairs)
+                + "}"
+            )
+
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} histogram")
+                for bound, count in zip(h.buckets, h.counts):
+                    le = format_labels(labels, le=bound)
+                    lines.append(f"{name}_bucket{le} {count}")
+                le = format_labels(labels, le="+Inf")
+                lines.append(f"{name}_bucket{le} {h.count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {h.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, format=None):
+        """
+        Writes the metrics to `path`, replacing it atomically, as JSON if
+        `format` is "json" or `path` ends in ".json", else as Prometheus
+        text.
+        """
+        if format is None:
+            format = "json" if path.endswith(".json") else "prometheus"
+        if format == "json":
+            text = json.dumps(self.snapshot(), indent=1)
+        else:
+            text = self.prometheus()
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(text)
+        os.replace(temp_path, path)
+
+
+# the metrics being recorded, if any
+metrics = None
+
+
+def enable_metrics():
+    """starts recording metrics, if that isn't already on, and returns them"""
+    global metrics
+    if metrics is None:
+        metrics = Metrics()
+    return metrics
+
+
+def start_metrics_writer(path, format=None, interval=METRICS_WRITE_INTERVAL):
+    """
+    Writes `metrics` to `path` every `interval` seconds from a daemon
+    thread, so a dashboard can follow a long run.  Returns an event that
+    stops the thread when set.
+    """
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            metrics.write(path, format)
+
+    threading.Thread(target=run, daemon=True).start()
+    return stop
+
+
+def request_endpoint(url):
+    """the name an HTTP request's metrics are filed under"""
+    name = urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1]
+    return name if name in ("upload", "split", "check", "get-limits") else "download"
+
+
+class Tracer:
+    """
+    Collects a timeline of a run as Chrome trace events, for viewing in
+    chrome://tracing or Perfetto.  Each file of a batch is a process and
+    each stem a thread ("track") in it, with spans for the upload, the
+    split request, polling and each download, and a marker for every
+    progress event.  The segments of a file processed in segments have
+    tracks of their own.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.origin = time.monotonic()
+        self.events = []
+        self.tracks = {}
+
+    def track(self, name):
+        """returns the process and thread IDs of the track `name`"""
+        pid = current_file_index.get() or 0
+        segment = current_segment.get()
+        if segment is not None:
+            name = f"{name} part {segment}"
+        with self.lock:
+            if (pid, None) not in self.tracks:
+                self.tracks[(pid, None)] = pid
+                process_name = f"file {pid}" if pid else "batch"
+                self.events.append(self.metadata("process_name", pid, 0, process_name))
+            tid = self.tracks.get((pid, name))
+            if tid is None:
+                tid = self.tracks[(pid, name)] = len(self.tracks)
+                self.events.append(self.metadata("thread_name", pid, tid, name))
+        return pid, tid
+
+    @staticmethod
+    def metadata(kind, pid, tid, name):
+        return {"name": kind, "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+
+    def timestamp(self, t):
+        """converts a `time.monotonic` time to trace microseconds"""
+        return round((t - self.origin) * 1e6, 1)
+
+    def span(self, name, track, start, end, args=None):
+        """records a span from `start` to `end` on `track`"""
+        pid, tid = self.track(track)
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": self.timestamp(start),
+            "dur": self.timestamp(end) - self.timestamp(start),
+            "pid": pid,
+            "tid": tid,
+            "args": args or {},
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def marker(self, name, track, args=None):
+        """records a point-in-time marker on `track`"""
+        pid, tid = self.track(track)
+        event = {
+            "name": name,
+            "ph": "i",
+            "s": "t",
+            "ts": self.timestamp(time.monotonic()),
+            "pid": pid,
+            "tid": tid,
+            "args": args or {},
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def write(self, path):
+        """writes the trace to `path` as JSON, replacing it atomically"""
+        with self.lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(trace, f, default=str)
+        os.replace(temp_path, path)
+
+
+# the trace being recorded, if any
+tracer = None
+
+
+@contextlib.contextmanager
+def tracing(path):
+    """
+    Records a trace of what runs inside the `with` block and writes it to
+    `path` at the end.  If a trace is already being recorded, it's
+    written instead.
+    """
+    global tracer
+    previous = tracer
+    if tracer is None:
+        tracer = Tracer()
+    try:
+        yield tracer
+    finally:
+        tracer.write(path)
+        tracer = previous
+
+
+@contextlib.contextmanager
+def trace_span(name, track, **args):
+    """records the `with` block as a span on `track`, if tracing is on"""
+    if tracer is None:
+        yield
+        return
+    recorder = tracer
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        recorder.span(name, track, start, time.monotonic(), args)
+
+
 def make_content_disposition(filename, disposition="attachment"):
     """
     Generates a Content-Disposition header for a given filename, with
@@ -72,25 +660,687 @@ def make_content_disposition(filename, disposition="attachment"):
     return f"{disposition}; {file_expr}"
 
 
-def upload_file(file_path, license):
+class PooledResponse:
+    """
+    A response to a `ConnectionPool` request.  Closing it hands its
+    connection back to the pool if the body was read to the end and the
+    server is keeping the connection open, else closes the connection.
+    """
+
+    def __init__(self, pool, key, conn, response, slot):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.slot = slot
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def readinto(self, b):
+        return self.response.readinto(b)
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.checkin(self.key, self.conn)
+        else:
+            self.response.close()
+            self.conn.close()
+        self.conn = None
+        self.slot.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ConnectionPool:
+    """
+    Keeps persistent HTTP and HTTPS connections open to each host so that
+    successive requests skip the TCP and TLS handshakes.  At most
+    `max_per_host` requests to a host are in progress at once; further
+    requests wait for a connection to come free.  An idle connection is
+    dropped if it has been idle longer than `max_idle` seconds or the
+    server has closed it, and a request that fails on a reused connection
+    is retried once on a new one.
+
+    A pool is safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        max_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+        max_idle=HTTP_MAX_IDLE,
+        timeout=HTTP_TIMEOUT,
+    ):
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """
+        Sends a request and returns a `PooledResponse`, following
+        redirects.  Raises `HTTPError` for 4xx and 5xx responses.
+        `timeout` overrides the pool's socket timeout for this request.
+        """
+        headers = dict(headers or {})
+        for _ in range(HTTP_MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            if metrics is None:
+                response = self.send(key, method, path, body, headers, timeout)
+            else:
+                response = self.send_measured(
+                    key, method, path, body, headers, timeout, url
+                )
+
+            location = response.headers.get("Location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                response.close()
+                url = urljoin(url, location)
+                if response.status == 303 or method == "POST" and response.status < 307:
+                    method = "GET"
+                    body = None
+                continue
+
+            if response.status >= 400:
+                content = response.read()
+                response.close()
+                raise HTTPError(
+                    url,
+                    response.status,
+                    response.reason,
+                    response.headers,
+                    io.BytesIO(content),
+                )
+            return response
+        raise HTTPError(url, response.status, "too many redirects", None, None)
+
+    def send_measured(self, key, method, path, body, headers, timeout, url):
+        """`send`, recording the request's count and latency in `metrics`"""
+        endpoint = request_endpoint(url)
+        start = time.monotonic()
+        status = "error"
+        try:
+            response = self.send(key, method, path, body, headers, timeout)
+            status = response.status
+            return response
+        finally:
+            metrics.add(
+                "unmixer_http_requests_total",
+                method=method,
+                endpoint=endpoint,
+                status=status,
+            )
+            metrics.observe(
+                "unmixer_http_request_seconds",
+                time.monotonic() - start,
+                method=method,
+                endpoint=endpoint,
+            )
+
+    def send(self, key, method, path, body, headers, timeout):
+        slot = self.slot(key)
+        slot.acquire()
+        try:
+            start = body.tell() if hasattr(body, "tell") else None
+            while True:
+                conn, reused = self.checkout(key)
+                conn.timeout = self.timeout if timeout is None else timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(conn.timeout)
+                try:
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                except ConnectionError:
+                    # a kept-alive connection that the server closed after
+                    # our health check; try once more on a fresh one
+                    conn.close()
+                    if not reused:
+                        raise
+                    if start is not None:
+                        body.seek(start)
+                    continue
+                return PooledResponse(self, key, conn, response, slot)
+        except BaseException:
+            slot.release()
+            raise
+
+    def slot(self, key):
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.max_per_host)
+            return self.slots[key]
+
+    def checkout(self, key):
+        """
+        Returns a healthy idle connection to the host, or a new one, and
+        whether it was reused.
+        """
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                idle = self.idle.get(key)
+                if not idle:
+                    break
+                conn, last_used = idle.pop()
+            if now - last_used < self.max_idle and self.healthy(conn):
+                return conn, True
+            conn.close()
+
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout), False
+        return http.client.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def warm(self, url):
+        """
+        Opens a connection to `url`'s host ahead of a request to it, so the
+        request doesn't wait for the TCP and TLS handshakes, and leaves it
+        idle in the pool.  Failures are ignored; the request will run into
+        them itself.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        conn, reused = self.checkout(key)
+        if not reused:
+            try:
+                conn.connect()
+            except OSError:
+                conn.close()
+                return
+        self.checkin(key, conn)
+
+    def checkin(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append((conn, time.monotonic()))
+
+    @staticmethod
+    def healthy(conn):
+        """
+        An idle connection should have nothing to read; if its socket is
+        readable, the server has closed it (or sent something unexpected).
+        """
+        if conn.sock is None:
+            return False
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+        return not readable
+
+
+http_pool = ConnectionPool()
+
+
+class TokenBucket:
+    """
+    Holds the requests that share it to `rate` per second on average,
+    letting through bursts of up to `burst` at once.  `take` sleeps when
+    the bucket is empty.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """waits for a token and takes it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # take the token now, even if it's still owed, so that
+            # waiters queue up in order
+            self.tokens -= 1
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class CircuitBreaker:
+    """
+    Stops requests from going out while the API looks unhealthy.  After
+    `threshold` retryable failures in a row the circuit opens and `wait`
+    holds every caller for `cooldown` seconds; then one caller is let
+    through as a probe, and its success closes the circuit again while
+    its failure reopens it.  Opening and closing are reported with
+    `api_paused` and `api_resumed` events.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.cond = threading.Condition()
+
+    def wait(self):
+        """waits until a request may be sent"""
+        with self.cond:
+            while self.opened is not None:
+                remaining = self.opened + self.cooldown - time.monotonic()
+                if remaining <= 0 and not self.probing:
+                    self.probing = True
+                    return
+                self.cond.wait(remaining if remaining > 0 else None)
+
+    def success(self):
+        """records that a request got through"""
+        with self.cond:
+            was_open = self.opened is not None
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+            self.cond.notify_all()
+        if was_open:
+            report("api_resumed")
+
+    def failure(self):
+        """records a retryable failure, opening the circuit if need be"""
+        with self.cond:
+            self.failures += 1
+            opening = self.probing or (
+                self.opened is None and self.failures >= self.threshold
+            )
+            if opening:
+                self.opened = time.monotonic()
+                self.probing = False
+                self.cond.notify_all()
+        if opening:
+            report("api_paused", seconds=self.cooldown)
+
+    def release(self):
+        """
+        records that a request ended in a way that says nothing about the
+        API's health, so that a probe can be sent again
+        """
+        with self.cond:
+            self.probing = False
+            self.cond.notify_all()
+
+
+def is_retryable(exception):
+    """
+    Returns whether a request that raised `exception` is worth sending
+    again: connection failures, timeouts, throttling (429) and server
+    errors (5xx) are, while other HTTP errors and the API's own error
+    responses are not.
+    """
+    if isinstance(exception, HTTPError):
+        return exception.code == 429 or exception.code >= 500
+    return isinstance(exception, (OSError, http.client.HTTPException))
+
+
+def license_refused(exception):
+    """
+    Returns whether `exception`, or the one it was raised from, may be the
+    API refusing a license, because it's out of minutes or not valid: an
+    `APIError` reply, or an HTTP 401, 402 or 403.
+    """
+    for e in (exception, exception.__cause__):
+        if isinstance(e, APIError):
+            return True
+        if isinstance(e, HTTPError) and e.code in (401, 402, 403):
+            return True
+    return False
+
+
+def retry_after(exception):
+    """
+    Returns the number of seconds the `Retry-After` header of an
+    `HTTPError` asks us to wait, or None if it doesn't say.
+    """
+    headers = getattr(exception, "headers", None)
+    value = headers.get("Retry-After") if headers is not None else None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class RequestPolicy:
+    """
+    The rules every API request goes out under: a `TokenBucket` caps the
+    request rate, a `CircuitBreaker` pauses all requests while the API is
+    failing, and retryable failures are sent again after an exponential
+    backoff with full jitter, or after as long as the server's
+    `Retry-After` asks for, whichever is longer.
+    """
+
+    def __init__(
+        self,
+        rate=API_REQUEST_RATE,
+        burst=API_REQUEST_BURST,
+        retries=API_RETRIES,
+        failure_threshold=API_FAILURE_THRESHOLD,
+        cooldown=API_COOLDOWN,
+    ):
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+        self.retries = retries
+
+    @staticmethod
+    def backoff(attempt, exception):
+        """returns how long to wait before retry number `attempt`"""
+        delay = random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2**attempt))
+        return max(delay, retry_after(exception) or 0)
+
+    def call(self, request, retries=None, on_retry=None, cancel=None):
+        """
+        Calls `request()`, which sends one API request, and returns what it
+        returns, retrying it up to `retries` times if it raises a retryable
+        error.  `on_retry`, if given, is called with the retry number and
+        the delay before it; otherwise an `api_retry` event is reported.
+        A set `cancel` event cuts the wait short with `TransferCancelled`.
+        """
+        if retries is None:
+            retries = self.retries
+        attempt = 0
+        while True:
+            self.breaker.wait()
+            self.bucket.take()
+            try:
+                result = request()
+            except Exception as e:
+                if not is_retryable(e):
+                    self.breaker.release()
+                    raise
+                self.breaker.failure()
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                delay = self.backoff(attempt, e)
+                if on_retry is not None:
+                    on_retry(attempt, delay)
+                else:
+                    report("api_retry", attempt=attempt, seconds=round(delay, 1))
+                sleep_unless_cancelled(delay, cancel, "request")
+            else:
+                self.breaker.success()
+                return result
+
+
+request_policy = RequestPolicy()
+
+
+def fetch_json(method, url, body=None, headers=None, timeout=None):
+    """sends a request through the connection pool and decodes its JSON reply"""
+    with http_pool.request(method, url, body, headers, timeout) as response:
+        return json.load(response)
+
+
+class BandwidthLimiter:
+    """
+    Caps the combined rate of the transfers that share it at
+    `bytes_per_second`, by making `consume` sleep when they get ahead.
+    """
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+
+    def consume(self, nbytes):
+        """waits until `nbytes` more may be sent"""
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_free, now)
+            self.next_free = start + nbytes / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+class TransferCancelled(Exception):
+    """Raised by a transfer whose `cancel` event has been set."""
+
+
+class APIError(RuntimeError):
+    """
+    Raised with the message of an error reply to an upload or split, such
+    as the API's refusal of a license that's out of minutes.
+    """
+
+
+def sleep_unless_cancelled(seconds, cancel, name):
+    """
+    Sleeps for `seconds`, or raises `TransferCancelled` for `name` as soon
+    as the `cancel` event, if any, is set.
+    """
+    if cancel is None:
+        time.sleep(seconds)
+    elif cancel.wait(seconds):
+        raise TransferCancelled(name)
+
+
+class UploadBody:
+    """
+    The body of an upload, as an iterable of UPLOAD_BLOCK_SIZE blocks
+    read from an open file.  Each iteration starts over from the top of
+    the file, so a failed request can be sent again, and reports how far
+    along it is with `upload_progress` events.  If a `BandwidthLimiter`
+    is given, blocks are held back to keep within it.  If the `cancel`
+    event is set, the next block raises `TransferCancelled`.
+    """
+
+    def __init__(self, f, bandwidth=None, cancel=None):
+        self.f = f
+        self.bandwidth = bandwidth
+        self.cancel = cancel
+        self.size = os.fstat(f.fileno()).st_size
+
+    def __iter__(self):
+        self.f.seek(0)
+        sent = 0
+        start = last_report = time.monotonic()
+        while block := self.f.read(UPLOAD_BLOCK_SIZE):
+            if self.cancel is not None and self.cancel.is_set():
+                raise TransferCancelled(self.f.name)
+            if self.bandwidth is not None:
+                self.bandwidth.consume(len(block))
+            yield block
+            sent += len(block)
+            now = time.monotonic()
+            if now - last_report >= UPLOAD_PROGRESS_INTERVAL or sent == self.size:
+                last_report = now
+                report(
+                    "upload_progress",
+                    percent=100 * sent // self.size,
+                    bytes_per_second=sent / max(now - start, 1e-6),
+                    bytes=sent,
+                )
+
+
+def upload_file(
+    file_path,
+    license,
+    timeout=UPLOAD_TIMEOUT,
+    retries=UPLOAD_RETRIES,
+    bandwidth=None,
+    cancel=None,
+):
     """
     Uploads a file to the Lalal.ai API and returns the file ID on success.
-    Raises a `RuntimeError` with the API error message on failure.
+    The file is streamed with an exact Content-Length, reporting progress
+    and throughput as it goes, under the shared `request_policy`.
+    Transient failures are retried up to `retries` times, reported with
+    `upload_retry` events; `timeout` is the socket timeout in seconds.
+    `bandwidth` is an optional `BandwidthLimiter`, and `cancel` an
+    optional `threading.Event` that stops the upload with
+    `TransferCancelled`.
+
+    Raises an `APIError` with the API error message on failure.
     """
     url_for_upload = URL_API + "upload/"
     _, filename = os.path.split(file_path)
-    headers = {
-        "Content-Disposition": make_content_disposition(filename),
-        "Authorization": f"license {license}",
-    }
     with open(file_path, "rb") as f:
-        request = Request(url_for_upload, f, headers)
-        with urlopen(request) as response:
-            upload_result = json.load(response)
-            if upload_result["status"] == "success":
-                return upload_result["id"]
-            else:
-                raise RuntimeError(upload_result["error"])
+        body = UploadBody(f, bandwidth, cancel)
+        headers = {
+            "Content-Disposition": make_content_disposition(filename),
+            "Content-Length": str(body.size),
+            "Authorization": f"license {license}",
+        }
+        start = time.monotonic()
+        upload_result = request_policy.call(
+            lambda: fetch_json("POST", url_for_upload, body, headers, timeout),
+            retries=retries,
+            on_retry=lambda attempt, delay: report("upload_retry", attempt=attempt),
+            cancel=cancel,
+        )
+
+    if upload_result["status"] == "success":
+        if metrics is not None:
+            metrics.observe_transfer("upload", time.monotonic() - start, body.size)
+        return upload_result["id"]
+    else:
+        raise APIError(upload_result["error"])
+
+
+def hash_file(file_path):
+    """
+    Returns the SHA-256 hex digest of the file at `file_path`, reading it
+    in blocks so that large files aren't loaded into memory.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class UploadCache:
+    """
+    Remembers the Lalal.ai file ID that each uploaded file got, keyed by
+    a hash of the file's contents and the license it was uploaded with,
+    in an SQLite table.  Entries expire after `ttl` seconds.
+
+    Unlike `KeyValueStore`, an `UploadCache` is shared by the files of a
+    batch, so its connection is guarded by a lock.
+    """
+
+    def __init__(self, db_file, ttl=UPLOAD_CACHE_TTL):
+        """initialize database connection and ensure the table exists"""
+        self.db_file = db_file
+        self.ttl = ttl
+        self.checked = set()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.create_table()
+
+    def execute(self, sql, args=()):
+        """run a statement, commit, and return any rows it produced"""
+        with self.lock:
+            cursor = self.conn.execute(sql, args)
+            rows = cursor.fetchall()
+            self.conn.commit()
+        return rows
+
+    def create_table(self):
+        """create the upload cache table if it doesn't exist"""
+        self.execute(
+            """
+            CREATE TABLE IF NOT EXISTS upload_cache (
+                hash text NOT NULL,
+                license text NOT NULL,
+                file_id text NOT NULL,
+                expires real NOT NULL,
+                PRIMARY KEY (hash, license)
+            );
+        """
+        )
+
+    def get(self, digest, license):
+        """get the file ID for a hash, return None if absent or expired"""
+        rows = self.execute(
+            "SELECT file_id FROM upload_cache"
+            " WHERE hash = ? AND license = ? AND expires > ?",
+            (digest, license, time.time()),
+        )
+        return rows[0][0] if rows else None
+
+    def set(self, digest, license, file_id):
+        """record the file ID for a hash, replacing any earlier one"""
+        self.execute(
+            """
+            INSERT OR REPLACE INTO upload_cache
+            (hash, license, file_id, expires) VALUES (?, ?, ?, ?)
+        """,
+            (digest, license, file_id, time.time() + self.ttl),
+        )
+        self.checked.add(file_id)
+
+    def delete(self, digest, license):
+        """forget the file ID for a hash"""
+        self.execute(
+            "DELETE FROM upload_cache WHERE hash = ? AND license = ?",
+            (digest, license),
+        )
+
+    def is_live(self, file_id):
+        """
+        Asks the API whether `file_id` still exists.  Each ID is only
+        asked about once per `UploadCache`.
+        """
+        if file_id in self.checked:
+            return True
+        try:
+            check_result = status_poller.query([file_id])[file_id]
+        except Exception:
+            return False
+        if check_result.get("status") != "success":
+            return False
+        self.checked.add(file_id)
+        return True
+
+
+def upload_file_cached(
+    file_path, license, upload_cache, digest=None, bandwidth=None, cancel=None
+):
+    """
+    Like `upload_file`, but reuses the file ID from an earlier upload of
+    the same contents if `upload_cache` has one and it's still live on the
+    server.  A stale entry is dropped and the file is uploaded again.
+    `digest` is the file's `hash_file` hash, if the caller already has it.
+    `bandwidth` and `cancel` are passed on to `upload_file`.
+    """
+    if digest is None:
+        digest = hash_file(file_path)
+    file_id = upload_cache.get(digest, license)
+    if file_id is not None:
+        if upload_cache.is_live(file_id):
+            report("upload_cached", file_id=file_id)
+            if metrics is not None:
+                metrics.add("unmixer_upload_cache_hits_total")
+            return file_id
+        upload_cache.delete(digest, license)
+
+    file_id = upload_file(file_path, license, bandwidth=bandwidth, cancel=cancel)
+    upload_cache.set(digest, license, file_id)
+    return file_id
 
 
 def split_file(file_id, license, stem, filter_type, splitter):
@@ -101,11 +1351,17 @@ def split_file(file_id, license, stem, filter_type, splitter):
     The `splitter` parameter specifies the type of neural network to use
     for the separation.
 
-    Raises a `RuntimeError` with the API error message on failure.
+    Returns the ID to poll with `check_file`: the task ID if the API hands
+    one back, so concurrent splits of the same file can be told apart,
+    else the file ID.
+
+    The request goes out under the shared `request_policy`.  Raises an
+    `APIError` with the API error message on failure.
     """
     url_for_split = URL_API + "split/"
     headers = {
         "Authorization": f"license {license}",
+        "Content-Type": "application/x-www-form-urlencoded",
     }
     query_args = {
         "id": file_id,
@@ -114,53 +1370,450 @@ def split_file(file_id, license, stem, filter_type, splitter):
         "splitter": splitter,
     }
     encoded_args = urlencode(query_args).encode("utf-8")
-    request = Request(url_for_split, encoded_args, headers=headers)
-    with urlopen(request) as response:
-        split_result = json.load(response)
-        if split_result["status"] == "error":
-            print(f"%split_result_error {split_result}")
-            raise RuntimeError(split_result["error"])
+    split_result = request_policy.call(
+        lambda: fetch_json("POST", url_for_split, encoded_args, headers)
+    )
+    if split_result["status"] == "error":
+        report("split_result_error", result=split_result)
+        raise APIError(split_result["error"])
+    return split_result.get("task_id", file_id)
 
 
-def check_file(stem, file_id):
+def get_license_limits(license):
     """
-    Checks the status of a file submitted for stem separation by the
-    Lalal.ai API.  Polls the API for updates until processing is complete,
-    periodically printing progress.
+    Asks the Lalal.ai billing API about `license` and returns its reply,
+    which includes the minutes of processing left on it as
+    "process_duration_left".
 
-    Returns URLs for extracted stem and backing tracks (if any) on success.
-    Raises a `RuntimeError` with API error message on processing error.
+    Raises a `RuntimeError` with the API error message on failure.
     """
-    url_for_check = URL_API + "check/?"
-    query_args = {"id": file_id}
-    encoded_args = urlencode(query_args)
+    encoded_args = urlencode({"key": license})
+    url = urljoin(URL_API, "../billing/get-limits/?" + encoded_args)
+    limits = request_policy.call(lambda: fetch_json("GET", url))
+    if limits.get("status") != "success":
+        raise RuntimeError(limits.get("error", "couldn't get license limits"))
+    return limits
 
-    while True:
-        with urlopen(url_for_check + encoded_args) as response:
-            check_result = json.load(response)
 
-        if check_result["status"] == "error":
-            raise RuntimeError(check_result["error"])
+def mask_license(license):
+    """returns `license` with all but its last four characters hidden"""
+    return "..." + license[-4:]
 
-        task_state = check_result["task"]["state"]
 
-        if task_state == "error":
-            raise RuntimeError(check_result["task"]["error"])
+class LicensePool:
+    """
+    Several license keys, shared out among the jobs of a batch so that
+    their accounts' queues work in parallel.  Each job gets the key with
+    the most minutes left per job already running on it, as reported by
+    the billing API at most every `limits_ttl` seconds.  A key that runs
+    out of minutes is taken out of rotation with a `license_exhausted`
+    event.
 
-        if task_state == "progress":
-            progress = int(check_result["task"]["progress"])
-            if progress == 0:
-                print(f"%split_waiting {stem}")
+    A pool can be passed wherever a license is, and a job given a pool
+    holds one key from upload to download, since the file IDs the API
+    hands out only work with the key that uploaded the file.
+    """
+
+    def __init__(self, licenses, limits_ttl=LICENSE_LIMITS_TTL):
+        self.licenses = list(dict.fromkeys(licenses))
+        self.limits_ttl = limits_ttl
+        self.minutes_left = {}
+        self.fetched = {}
+        self.in_flight = dict.fromkeys(self.licenses, 0)
+        self.exhausted = set()
+        self.lock = threading.Lock()
+
+    def refresh(self, license, force=False):
+        """
+        Returns the minutes left on `license`, asking the billing API if
+        what we know is older than `limits_ttl` or `force` is true, or
+        None if that isn't known.
+        """
+        with self.lock:
+            fresh = time.monotonic() - self.fetched.get(license, -math.inf)
+            if not force and fresh < self.limits_ttl:
+                return self.minutes_left.get(license)
+        try:
+            minutes = float(get_license_limits(license)["process_duration_left"])
+        except (OSError, http.client.HTTPException, RuntimeError, KeyError, ValueError):
+            minutes = None
+        with self.lock:
+            self.fetched[license] = time.monotonic()
+            if minutes is not None:
+                self.minutes_left[license] = minutes
+            return self.minutes_left.get(license)
+
+    def retire(self, license):
+        """takes `license` out of rotation"""
+        with self.lock:
+            if license in self.exhausted:
+                return
+            self.exhausted.add(license)
+        report("license_exhausted", license=mask_license(license))
+
+    def acquire(self, prefer=None):
+        """
+        Picks a key for a job and counts the job against it until it's
+        passed to `release`.  `prefer` is taken if it's still in rotation,
+        so that a resumed job keeps the key its file was uploaded with.
+        Raises a `RuntimeError` if every key is out of minutes.
+        """
+        for license in self.licenses:
+            if license not in self.exhausted:
+                minutes = self.refresh(license)
+                if minutes is not None and minutes <= 0:
+                    self.retire(license)
+
+        with self.lock:
+            active = [lic for lic in self.licenses if lic not in self.exhausted]
+            if not active:
+                raise RuntimeError("every license is out of minutes")
+            if prefer in active:
+                license = prefer
             else:
-                print(f"%split_progress {stem} {progress}%")
+                # keys we couldn't get the minutes of are assumed to have
+                # plenty, and spread by load alone
+                license = max(
+                    active,
+                    key=lambda lic: (
+                        self.minutes_left.get(lic, math.inf)
+                        / (1 + self.in_flight[lic]),
+                        -self.in_flight[lic],
+                    ),
+                )
+            self.in_flight[license] += 1
+        return license
+
+    def release(self, license):
+        """stops counting a job against `license`"""
+        with self.lock:
+            self.in_flight[license] -= 1
+
+    def check_exhausted(self, license):
+        """
+        Asks the billing API whether `license` has run out of minutes, and
+        if so takes it out of rotation and returns True.
+        """
+        minutes = self.refresh(license, force=True)
+        if minutes is not None and minutes <= 0:
+            self.retire(license)
+            return True
+        return False
+
+
+async def async_process_with_pool(
+    pool,
+    input_path,
+    output_path,
+    stems,
+    backing_tracks,
+    filter_type,
+    splitter,
+    journal=None,
+    job_id=None,
+    **kwargs,
+):
+    """
+    Runs `async_batch_process_multiple_stems` with a key from the
+    `LicensePool` `pool`.  If the job fails because its key ran out of
+    minutes, the key leaves rotation and the job carries on with another
+    one.  The file is uploaded again under the new key, but the tracks
+    already downloaded aren't fetched again, thanks to the journal or the
+    output directory's manifest.  Only a failure that `license_refused`
+    could be is checked with the billing API; anything else is raised as
+    it is.
+    """
+    prefer = None
+    if journal is not None:
+        if job_id is None:
+            job_id = journal.create_job(
+                input_path,
+                output_path,
+                stems,
+                backing_tracks,
+                filter_type,
+                splitter,
+                {
+                    "trim_silence": kwargs.get("trim_silence", False),
+                    "compress_uploads": kwargs.get("compress_uploads", False),
+                },
+            )
+        else:
+            prefer = journal.get_job(job_id)["license"]
+
+    while True:
+        license = await asyncio.to_thread(pool.acquire, prefer)
+        try:
+            return await async_batch_process_multiple_stems(
+                license,
+                input_path,
+                output_path,
+                stems,
+                backing_tracks,
+                filter_type,
+                splitter,
+                journal=journal,
+                job_id=job_id,
+                **kwargs,
+            )
+        except Exception as e:
+            if not license_refused(e):
+                raise
+            if not await asyncio.to_thread(pool.check_exhausted, license):
+                raise
+        finally:
+            pool.release(license)
+        prefer = None
+
+
+class PolledTask:
+    """A split being watched by a `StatusPoller`."""
+
+    def __init__(self, stem, check_id):
+        self.stem = stem
+        self.check_id = check_id
+        self.context = contextvars.copy_context()
+        self.future = Future()
+        self.started = self.next_poll = time.monotonic()
+        self.running_since = None
+        self.queued_interval = POLL_MIN_INTERVAL
+        self.last_progress = None
+        self.last_progress_time = None
+        self.mismatches = 0
+        self.failures = 0
+
+    def schedule(self, progress):
+        """
+        Works out when to poll this task next from its reported progress.
+        Queued tasks (0%) are polled again soon, backing off geometrically
+        the longer they stay queued; running tasks are polled at the
+        estimated time of completion, so the poll that sees 100% lands
+        soon after the server finishes.
+        """
+        now = time.monotonic()
+        if progress == 0:
+            delay = self.queued_interval
+            self.queued_interval = min(
+                self.queued_interval * POLL_QUEUED_BACKOFF, POLL_MAX_INTERVAL
+            )
+        elif self.last_progress is None:
+            # no rate to estimate from until the next poll
+            delay = POLL_MIN_INTERVAL
+        elif progress <= self.last_progress:
+            delay = POLL_QUEUED_INTERVAL
+        else:
+            rate = (progress - self.last_progress) / (now - self.last_progress_time)
+            delay = (100 - progress) / rate
+
+        # the rate is estimated from running progress only, as time spent
+        # queued would make a split look slower than it is
+        if progress and progress != self.last_progress:
+            self.last_progress = progress
+            self.last_progress_time = now
+        self.next_poll = now + min(max(delay, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+
+
+class StatusPoller:
+    """
+    Watches any number of in-flight splits from a single thread.  Each
+    pass sends one `check/` request for all the tasks that are due, with
+    the IDs comma separated, falling back to one request per ID if the
+    API won't take a list.  A check that fails with a retryable error
+    isn't retried on the spot, which would hold up every other task, but
+    its tasks are put off by the `request_policy` backoff and checked on
+    a later pass, up to the policy's number of retries.
+    """
+
+    def __init__(self, batch_size=POLL_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.batch_supported = True
+        self.tasks = {}
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def watch(self, stem, check_id):
+        """
+        Starts watching the split of `stem` identified by `check_id`.
+        Returns a `Future` that resolves to the stem and backing track
+        URLs, or raises a `RuntimeError` if the split fails.  Cancelling
+        the future stops the watch.
+        """
+        task = PolledTask(stem, check_id)
+        with self.cond:
+            self.tasks[(check_id, stem)] = task
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        task.future.add_done_callback(
+            lambda future: future.cancelled() and self.forget(task)
+        )
+        return task.future
+
+    def forget(self, task):
+        """stops watching `task`"""
+        with self.cond:
+            if self.tasks.get((task.check_id, task.stem)) is task:
+                del self.tasks[(task.check_id, task.stem)]
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    due = [t for t in self.tasks.values() if t.next_poll <= now]
+                    if due:
+                        break
+                    if self.tasks:
+                        wake = min(t.next_poll for t in self.tasks.values())
+                        self.cond.wait(wake - now)
+                    else:
+                        self.cond.wait()
+
+            for i in range(0, len(due), self.batch_size):
+                self.poll(due[i : i + self.batch_size])
+
+    def poll(self, tasks):
+        """Checks on `tasks` and resolves any that have finished."""
+        try:
+            results = self.query(list(dict.fromkeys(t.check_id for t in tasks)))
+        except Exception as e:
+            for task in tasks:
+                task.failures += 1
+                if not is_retryable(e) or task.failures > request_policy.retries:
+                    self.finish(task, exception=e)
+                    continue
+                delay = request_policy.backoff(task.failures, e)
+                task.context.run(
+                    report,
+                    "api_retry",
+                    stem=task.stem,
+                    attempt=task.failures,
+                    seconds=round(delay, 1),
+                )
+                with self.cond:
+                    task.next_poll = time.monotonic() + delay
+            return
+
+        for task in tasks:
+            task.failures = 0
+            try:
+                task.context.run(self.update, task, results[task.check_id])
+            except Exception as e:
+                self.finish(task, exception=e)
+
+    def query(self, check_ids):
+        """
+        Asks `check/` about `check_ids`, under the shared `request_policy`
+        but without its retries (see `poll`), and returns a dict of the
+        per-ID results.
+        """
+        if len(check_ids) > 1 and not self.batch_supported:
+            results = {}
+            for check_id in check_ids:
+                results.update(self.query([check_id]))
+            return results
+
+        encoded_args = urlencode({"id": ",".join(check_ids)})
+        check_result = request_policy.call(
+            lambda: fetch_json("GET", URL_API + "check/?" + encoded_args), retries=0
+        )
+
+        if "result" in check_result:
+            return check_result["result"]
+        if len(check_ids) == 1:
+            return {check_ids[0]: check_result}
+
+        # the API answered a list of IDs as if it were one, so it doesn't
+        # do batches; ask again one at a time
+        self.batch_supported = False
+        return self.query(check_ids)
+
+    def update(self, task, check_result):
+        if check_result["status"] == "error":
+            raise RuntimeError(check_result["error"])
+
+        # without task IDs, concurrent splits of one file share a check ID
+        # and the result only describes one of them
+        split_stem = (check_result.get("split") or {}).get("stem", task.stem)
+        if split_stem != task.stem:
+            task.mismatches += 1
+            if task.mismatches > POLL_MISMATCH_LIMIT:
+                raise RuntimeError(
+                    f"the split of {task.stem} was never reported; "
+                    f"{check_result['split']['stem']} was reported instead"
+                )
+            with self.cond:
+                task.schedule(0)
+            return
+        task.mismatches = 0
+
+        task_state = check_result["task"]["state"]
+
+        if task_state == "error":
+            raise RuntimeError(check_result["task"]["error"])
 
         if task_state == "success":
-            print(f"%split_progress {stem} 100%")
+            report("split_progress", stem=task.stem, percent=100)
+            if metrics is not None:
+                # as seen by the polls, so only as precise as their timing
+                now = time.monotonic()
+                running_since = task.running_since or now
+                for phase, seconds in [
+                    ("queue", running_since - task.started),
+                    ("split", now - running_since),
+                ]:
+                    metrics.observe(
+                        "unmixer_phase_seconds", seconds, phase=phase, stem=task.stem
+                    )
             stem_track_url = check_result["split"]["stem_track"]
             back_track_url = check_result["split"]["back_track"]
-            return stem_track_url, back_track_url
+            self.finish(task, result=(stem_track_url, back_track_url))
+            return
+
+        progress = 0
+        if task_state == "progress":
+            progress = int(check_result["task"]["progress"])
+            if progress == 0:
+                report("split_waiting", stem=task.stem)
+            else:
+                report("split_progress", stem=task.stem, percent=progress)
+                if task.running_since is None:
+                    task.running_since = time.monotonic()
+
+        with self.cond:
+            task.schedule(progress)
 
-        time.sleep(10)
+    def finish(self, task, result=None, exception=None):
+        with self.cond:
+            self.tasks.pop((task.check_id, task.stem), None)
+        try:
+            if exception is not None:
+                task.future.set_exception(exception)
+            else:
+                task.future.set_result(result)
+        except InvalidStateError:
+            # cancelled while it was being polled
+            pass
+
+
+status_poller = StatusPoller()
+
+# whether split/ has handed back a task ID, so that splits of the same
+# file can be polled apart; see async_split_and_wait
+split_task_ids_seen = False
+
+
+def check_file(stem, file_id):
+    """
+    Checks the status of a file submitted for stem separation by the
+    Lalal.ai API.  Waits on the shared `status_poller` until processing
+    is complete, periodically printing progress.
+
+    Returns URLs for extracted stem and backing tracks (if any) on success.
+    Raises a `RuntimeError` with API error message on processing error.
+    """
+    return status_poller.watch(stem, file_id).result()
 
 
 def get_filename_from_content_disposition(header):
@@ -174,23 +1827,887 @@ def get_filename_from_content_disposition(header):
         raise ValueError("Invalid header Content-Disposition")
 
 
-def download_file(url_for_download, output_path):
-    with urlopen(url_for_download) as response:
-        filename = get_filename_from_content_disposition(
-            response.headers["Content-Disposition"]
+def download_filename(headers):
+    """
+    Works out the local filename for a download from its response headers,
+    dropping Lalal.ai's "_split_by_lalalai" decoration.
+    """
+    filename = get_filename_from_content_disposition(headers["Content-Disposition"])
+    filename = filename.replace("_split_by_lalalai", "")
+    filename = filename.replace("_no_", "_all_but_", 1)
+    filename = filename.replace(".aiff", ".aif", 1)
+    return filename
+
+
+def content_total(response):
+    """
+    Returns the full size of the resource a (possibly partial) response is
+    for, or None if the server didn't say.
+    """
+    if response.status == 206:
+        match = re.search(r"/(\d+)\s*$", response.headers.get("Content-Range", ""))
+        return int(match.group(1)) if match else None
+    length = response.headers.get("Content-Length")
+    return int(length) if length else None
+
+
+download_buffers = threading.local()
+
+# downloads in progress, by .part path, so that two downloads of the same
+# file in one process take turns rather than writing over each other
+part_locks = {}
+part_locks_lock = threading.Lock()
+
+
+def lock_part(part_path):
+    """returns the lock for downloading into `part_path`"""
+    with part_locks_lock:
+        return part_locks.setdefault(part_path, threading.Lock())
+
+
+def receive_into_part(
+    response, part_path, offset, total, stem, track_type, cancel=None
+):
+    """
+    Appends the body of `response` to `part_path` from `offset` on, using
+    a per-thread buffer, and returns the number of bytes now in the file.
+    Reports a `download_progress` event at most every
+    DOWNLOAD_PROGRESS_INTERVAL seconds.  Raises `TransferCancelled` if
+    the `cancel` event is set, leaving what was received in the file.
+    """
+    if not hasattr(download_buffers, "view"):
+        download_buffers.view = memoryview(bytearray(DOWNLOAD_BUFFER_SIZE))
+    view = download_buffers.view
+
+    preallocate = DOWNLOAD_PREALLOCATE and total and offset == 0
+    written = offset
+    start = last_report = time.monotonic()
+    with open(part_path, "r+b" if offset else "wb") as f:
+        f.seek(offset)
+        if preallocate and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, total)
+        try:
+            while n := response.readinto(view):
+                if cancel is not None and cancel.is_set():
+                    raise TransferCancelled(part_path)
+                f.write(view[:n])
+                written += n
+                now = time.monotonic()
+                if stem is not None and now - last_report >= DOWNLOAD_PROGRESS_INTERVAL:
+                    last_report = now
+                    report(
+                        "download_progress",
+                        track_type=track_type,
+                        stem=stem,
+                        percent=100 * written // total if total else None,
+                        bytes_per_second=(written - offset) / (now - start),
+                        bytes=written,
+                    )
+        finally:
+            # with preallocation, the file's size is only meaningful once
+            # it's cut back to what was actually written
+            if preallocate:
+                f.truncate(written)
+    return written
+
+
+def download_file(
+    url_for_download, output_path, stem=None, track_type=None, cancel=None
+):
+    """
+    Downloads `url_for_download` into the `output_path` directory and
+    returns the path of the downloaded file.  The data goes to a ".part"
+    file that is renamed into place once its size has been checked, so a
+    file with the final name is always complete.  A dropped connection is
+    resumed with a Range request, as is a ".part" file left behind by an
+    earlier run.  If `stem` and `track_type` are given, progress and
+    throughput are reported with `download_progress` events.  If the
+    `cancel` event is set, the download stops with `TransferCancelled`,
+    keeping its ".part" file to resume from.
+    """
+    file_path = None
+    part_path = None
+    part_lock = None
+    failures = 0
+    start = time.monotonic()
+    resumed_from = None
+    try:
+        while True:
+            headers = {}
+            offset = 0
+            if part_path is not None and os.path.exists(part_path):
+                offset = os.path.getsize(part_path)
+                if offset:
+                    headers["Range"] = f"bytes={offset}-"
+            try:
+                with http_pool.request(
+                    "GET", url_for_download, None, headers
+                ) as response:
+                    if file_path is None:
+                        file_path = os.path.join(
+                            output_path, download_filename(response.headers)
+                        )
+                        part_path = file_path + ".part"
+                        part_lock = lock_part(part_path)
+                        if not part_lock.acquire(blocking=False):
+                            # another thread is downloading a file of the
+                            # same name; wait for it, then start over
+                            response.close()
+                            part_lock.acquire()
+                            continue
+                        if (
+                            os.path.exists(part_path)
+                            and response.headers.get("Accept-Ranges") == "bytes"
+                        ):
+                            # an earlier run left part of this file behind;
+                            # ask again for just the rest of it
+                            continue
+                    if response.status != 206:
+                        offset = 0
+                    total = content_total(response)
+                    if resumed_from is None:
+                        resumed_from = offset
+                    written = receive_into_part(
+                        response, part_path, offset, total, stem, track_type, cancel
+                    )
+                if total is not None and written != total:
+                    raise ConnectionError(
+                        f"download truncated at {written} of {total}"
+                    )
+                break
+            except HTTPError as e:
+                if e.code != 416:
+                    raise
+                # the range we asked for is past the end; start over
+                os.remove(part_path)
+            except (ConnectionError, TimeoutError, http.client.HTTPException):
+                # only the transfer is retried; a ".part" file that can't
+                # be written won't do any better after a wait
+                failures += 1
+                if failures > DOWNLOAD_RETRIES:
+                    raise
+                sleep_unless_cancelled(min(2**failures, 30), cancel, url_for_download)
+
+        os.replace(part_path, file_path)
+    finally:
+        if part_lock is not None:
+            part_lock.release()
+    if metrics is not None:
+        metrics.observe_transfer(
+            "download",
+            time.monotonic() - start,
+            written - resumed_from,
+            stem=stem,
+            track_type=track_type,
+        )
+    return file_path
+
+
+class JobJournal:
+    """
+    A durable record, in SQLite, of the steps each unmixing job has gotten
+    through: the file ID it was uploaded as, and how the upload was
+    prepared, the splits requested and the URLs they produced, and which
+    tracks have been downloaded.  A job that was interrupted by a crash or
+    a quit can be picked up where it left off with `resume_job`, with the
+    settings it was started with.
+
+    Unlike `KeyValueStore`, a journal is shared by the worker threads of
+    a batch, so its connection is guarded by a lock.
+    """
+
+    def __init__(self, db_file):
+        """initialize database connection and ensure the tables exist"""
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.create_tables()
+
+    def create_tables(self):
+        """create the job tables if they don't exist"""
+        self.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id integer PRIMARY KEY AUTOINCREMENT,
+                input_path text NOT NULL,
+                output_path text NOT NULL,
+                stems text NOT NULL,
+                backing_tracks text NOT NULL,
+                filter_type integer NOT NULL,
+                splitter text NOT NULL,
+                file_id text,
+                license text,
+                settings text,
+                upload text,
+                state text NOT NULL,
+                created real NOT NULL,
+                updated real NOT NULL
+            );
+        """
+        )
+        self.execute(
+            """
+            CREATE TABLE IF NOT EXISTS job_stems (
+                job_id integer NOT NULL,
+                stem text NOT NULL,
+                check_id text,
+                stem_track_url text,
+                back_track_url text,
+                stem_downloaded integer NOT NULL DEFAULT 0,
+                back_track_downloaded integer NOT NULL DEFAULT 0,
+                PRIMARY KEY (job_id, stem)
+            );
+        """
+        )
+        # journals from before jobs recorded their license, settings and
+        # how their upload was prepared
+        columns = [row[1] for row in self.execute("PRAGMA table_info(jobs)")]
+        for column in ("license", "settings", "upload"):
+            if column not in columns:
+                self.execute(f"ALTER TABLE jobs ADD COLUMN {column} text")
+
+    def execute(self, sql, args=()):
+        """run a statement, commit, and return any rows it produced"""
+        with self.lock:
+            cursor = self.conn.execute(sql, args)
+            rows = cursor.fetchall()
+            self.conn.commit()
+        return rows
+
+    def create_job(
+        self,
+        input_path,
+        output_path,
+        stems,
+        backing_tracks,
+        filter_type,
+        splitter,
+        settings=None,
+    ):
+        """
+        Records a new job and returns its ID.  `settings` is a dict of the
+        keyword arguments to `async_batch_process_multiple_stems` that the
+        job has to be resumed with, such as `trim_silence` and
+        `compress_uploads`.
+        """
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                """
+                INSERT INTO jobs
+                (input_path, output_path, stems, backing_tracks, filter_type,
+                 splitter, settings, state, created, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 'running', ?, ?)
+            """,
+                (
+                    input_path,
+                    output_path,
+                    json.dumps(stems),
+                    json.dumps(backing_tracks),
+                    filter_type,
+                    splitter,
+                    json.dumps(settings or {}),
+                    now,
+                    now,
+                ),
+            )
+            self.conn.commit()
+        return cursor.lastrowid
+
+    def set_file_id(self, job_id, file_id, license=None, upload=None):
+        """
+        Records the file ID the job's input was uploaded as, the license it
+        was uploaded with, and `upload`, a dict of how the upload was
+        prepared, which the tracks have to be undone by.
+        """
+        self.execute(
+            """
+            UPDATE jobs SET file_id = ?, license = ?, upload = ?, updated = ?
+            WHERE job_id = ?
+        """,
+            (file_id, license, json.dumps(upload or {}), time.time(), job_id),
+        )
+
+    def split_requested(self, job_id, stem, check_id):
+        """record that a split was requested and the ID to poll it with"""
+        self.execute(
+            """
+            INSERT OR REPLACE INTO job_stems (job_id, stem, check_id)
+            VALUES (?, ?, ?)
+        """,
+            (job_id, stem, check_id),
+        )
+
+    def split_done(self, job_id, stem, stem_track_url, back_track_url):
+        """record the URLs of a finished split"""
+        self.execute(
+            """
+            UPDATE job_stems SET stem_track_url = ?, back_track_url = ?
+            WHERE job_id = ? AND stem = ?
+        """,
+            (stem_track_url, back_track_url, job_id, stem),
+        )
+
+    def downloaded(self, job_id, stem, track_type):
+        """record that the stem or back_track of a split was downloaded"""
+        column = f"{track_type}_downloaded"
+        self.execute(
+            f"UPDATE job_stems SET {column} = 1 WHERE job_id = ? AND stem = ?",
+            (job_id, stem),
+        )
+
+    def finish_job(self, job_id):
+        """mark a job complete"""
+        self.execute(
+            "UPDATE jobs SET state = 'complete', updated = ? WHERE job_id = ?",
+            (time.time(), job_id),
+        )
+
+    def get_job(self, job_id):
+        """
+        Returns a dict describing a job, with the progress of each of its
+        splits under "splits", keyed by stem.
+        """
+        rows = self.execute(
+            """
+            SELECT input_path, output_path, stems, backing_tracks,
+                   filter_type, splitter, file_id, state, license,
+                   settings, upload
+            FROM jobs WHERE job_id = ?
+        """,
+            (job_id,),
+        )
+        if not rows:
+            raise KeyError(f"no such job: {job_id}")
+        row = rows[0]
+        job = {
+            "job_id": job_id,
+            "input_path": row[0],
+            "output_path": row[1],
+            "stems": json.loads(row[2]),
+            "backing_tracks": json.loads(row[3]),
+            "filter_type": row[4],
+            "splitter": row[5],
+            "file_id": row[6],
+            "state": row[7],
+            "license": row[8],
+            "settings": json.loads(row[9] or "{}"),
+            "upload": json.loads(row[10]) if row[10] else None,
+            "splits": {},
+        }
+        for row in self.execute(
+            """
+            SELECT stem, check_id, stem_track_url, back_track_url,
+                   stem_downloaded, back_track_downloaded
+            FROM job_stems WHERE job_id = ?
+        """,
+            (job_id,),
+        ):
+            job["splits"][row[0]] = {
+                "check_id": row[1],
+                "stem_track_url": row[2],
+                "back_track_url": row[3],
+                "stem_downloaded": bool(row[4]),
+                "back_track_downloaded": bool(row[5]),
+            }
+        return job
+
+    def unfinished_jobs(self):
+        """return the IDs of jobs that never completed, oldest first"""
+        rows = self.execute(
+            "SELECT job_id FROM jobs WHERE state = 'running' ORDER BY job_id"
+        )
+        return [row[0] for row in rows]
+
+
+class Scheduler:
+    """
+    The limits a batch runs under: how many uploads may run at once (and,
+    optionally, at what combined rate in bytes per second), how many
+    splits may be in flight, and how many downloads may run, as asyncio
+    semaphores.  Files processed with the same scheduler share its limits.
+    A scheduler belongs to the event loop it is first used in.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_uploads=DEFAULT_MAX_CONCURRENT_UPLOADS,
+        max_concurrent_splits=DEFAULT_MAX_CONCURRENT_SPLITS,
+        max_concurrent_downloads=DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+        max_upload_rate=None,
+    ):
+        self.upload_slots = asyncio.Semaphore(max(1, max_concurrent_uploads))
+        self.split_slots = asyncio.Semaphore(max(1, max_concurrent_splits))
+        self.download_slots = asyncio.Semaphore(max(1, max_concurrent_downloads))
+        self.bandwidth = BandwidthLimiter(max_upload_rate) if max_upload_rate else None
+        # file ID -> (lock, number of splits using it); see split_turn
+        self.split_turns = {}
+
+    @contextlib.asynccontextmanager
+    async def split_turn(self, file_id):
+        """
+        Waits for the other splits of `file_id` holding or waiting for a
+        turn, for when the API may not hand back task IDs, in which case
+        concurrent splits of one file can't be told apart when polled.
+        """
+        lock, users = self.split_turns.get(file_id, (asyncio.Lock(), 0))
+        self.split_turns[file_id] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self.split_turns[file_id]
+            if users == 1:
+                del self.split_turns[file_id]
+            else:
+                self.split_turns[file_id] = (lock, users - 1)
+
+
+async def run_cancellable(fn, *args, **kwargs):
+    """
+    Runs the blocking transfer fn(*args, **kwargs) on a worker thread,
+    passing it a `cancel` event that is set if the awaiting task is
+    cancelled, so the transfer stops at its next block.
+    """
+    cancel = threading.Event()
+    try:
+        return await asyncio.to_thread(fn, *args, cancel=cancel, **kwargs)
+    except asyncio.CancelledError:
+        cancel.set()
+        raise
+
+
+async def async_upload_file(file_path, license, **kwargs):
+    """The asyncio version of `upload_file`."""
+    return await run_cancellable(upload_file, file_path, license, **kwargs)
+
+
+async def async_upload_file_cached(file_path, license, upload_cache, **kwargs):
+    """The asyncio version of `upload_file_cached`."""
+    return await run_cancellable(
+        upload_file_cached, file_path, license, upload_cache, **kwargs
+    )
+
+
+async def async_compress_upload(file_path, directory):
+    """
+    Encodes the PCM file at `file_path` losslessly as FLAC in `directory`
+    for uploading, on a worker thread, while a connection to the API is
+    opened alongside so that the upload won't wait for the handshake
+    either.  Returns the FLAC file's path and the seconds the encoding
+    took, or None if it couldn't be encoded or came out no smaller.
+    """
+    name = os.path.splitext(os.path.basename(file_path))[0] + ".flac"
+    flac_path = os.path.join(directory, name)
+    report("compressing")
+    start = time.monotonic()
+    with trace_span("compress", "upload"):
+        error, _ = await asyncio.gather(
+            run_cancellable(lalalai_audio.encode_flac, file_path, flac_path),
+            asyncio.to_thread(http_pool.warm, URL_API),
+            return_exceptions=True,
+        )
+    if isinstance(error, Exception):
+        report("compression_failed", message=str(error))
+        return None
+    seconds = time.monotonic() - start
+    if metrics is not None:
+        metrics.observe("unmixer_phase_seconds", seconds, phase="compress")
+
+    size = os.path.getsize(file_path)
+    compressed_size = os.path.getsize(flac_path)
+    report(
+        "compressed",
+        ratio=round(size / max(compressed_size, 1), 2),
+        seconds=round(seconds, 3),
+    )
+    if compressed_size >= size:
+        os.remove(flac_path)
+        return None
+    return flac_path, seconds
+
+
+async def async_split_file(file_id, license, stem, filter_type, splitter):
+    """The asyncio version of `split_file`."""
+    return await asyncio.to_thread(
+        split_file, file_id, license, stem, filter_type, splitter
+    )
+
+
+async def async_check_file(stem, file_id):
+    """
+    The asyncio version of `check_file`.  The split is watched by the
+    shared `status_poller`, so waiting on it ties up no thread; if the
+    awaiting task is cancelled, the poller stops watching it.
+    """
+    return await asyncio.wrap_future(status_poller.watch(stem, file_id))
+
+
+async def async_download_file(
+    url_for_download, output_path, stem=None, track_type=None
+):
+    """The asyncio version of `download_file`."""
+    return await run_cancellable(
+        download_file, url_for_download, output_path, stem, track_type
+    )
+
+
+async def async_split_and_wait(
+    file_id,
+    license,
+    stem,
+    filter_type,
+    splitter,
+    journal=None,
+    job_id=None,
+    check_id=None,
+    scheduler=None,
+):
+    """
+    Requests a split of `file_id` for `stem` and waits until the split
+    is done.  Returns the stem and backing track URLs.
+
+    If `check_id` is given, the split was already requested by an earlier
+    run and is polled rather than requested again, unless the API no
+    longer knows about it.
+
+    Until the API is seen to hand back task IDs, splits of one file
+    sharing `scheduler` take turns: without them, all the splits of a
+    file are polled by its file ID, and the API only reports the latest.
+    """
+    global split_task_ids_seen
+    report("split_start", stem=stem)
+    if check_id is not None:
+        try:
+            with trace_span("poll", stem, check_id=check_id):
+                urls = await async_check_file(stem, check_id)
+        except RuntimeError:
+            check_id = None
+
+    if check_id is None:
+        if split_task_ids_seen or scheduler is None:
+            turn = contextlib.nullcontext()
+        else:
+            turn = scheduler.split_turn(file_id)
+        async with turn:
+            with trace_span("split", stem):
+                check_id = await async_split_file(
+                    file_id, license, stem, filter_type, splitter
+                )
+            if journal is not None:
+                journal.split_requested(job_id, stem, check_id)
+            if check_id != file_id:
+                # a task ID, so the other splits needn't wait after all
+                split_task_ids_seen = True
+            else:
+                with trace_span("poll", stem, check_id=check_id):
+                    urls = await async_check_file(stem, check_id)
+        if check_id != file_id:
+            with trace_span("poll", stem, check_id=check_id):
+                urls = await async_check_file(stem, check_id)
+
+    if journal is not None:
+        journal.split_done(job_id, stem, *urls)
+    return urls
+
+
+class OutputManifest:
+    """
+    A record, kept in a JSON file in an output directory, of each track
+    downloaded there: the hash of the input it was split from, its stem,
+    track type, filter and splitter, and the hash of the output file
+    itself.  Lets a batch skip the tracks the directory already holds.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.path = os.path.join(output_path, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)["tracks"]
+        except (OSError, ValueError, KeyError):
+            self.entries = []
+
+    @staticmethod
+    def key(entry):
+        return (
+            entry["input_hash"],
+            entry["stem"],
+            entry["track_type"],
+            entry["filter"],
+            entry["splitter"],
         )
-        filename = filename.replace("_split_by_lalalai", "")
-        filename = filename.replace("_no_", "_all_but_", 1)
-        filename = filename.replace(".aiff", ".aif", 1)
-        file_path = os.path.join(output_path, filename)
-        with open(file_path, "wb") as f:
-            while chunk := response.read(8196):
-                f.write(chunk)
+
+    def satisfied(self, input_hash, stem, track_type, filter_type, splitter):
+        """
+        Returns True if the directory holds the track, unchanged since it
+        was downloaded.
+        """
+        key = (input_hash, stem, track_type, filter_type, splitter)
+        for entry in self.entries:
+            if self.key(entry) != key:
+                continue
+            file_path = os.path.join(self.output_path, entry["file"])
+            if os.path.isfile(file_path) and hash_file(file_path) == entry["sha256"]:
+                return True
+        return False
+
+    def record(self, input_hash, stem, track_type, filter_type, splitter, file_path):
+        """records a downloaded track, replacing any earlier entry for it"""
+        entry = {
+            "input_hash": input_hash,
+            "stem": stem,
+            "track_type": track_type,
+            "filter": filter_type,
+            "splitter": splitter,
+            "file": os.path.basename(file_path),
+            "sha256": hash_file(file_path),
+        }
+        with self.lock:
+            self.entries = [e for e in self.entries if self.key(e) != self.key(entry)]
+            self.entries.append(entry)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"tracks": self.entries}, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+def wanted_track_types(stem, stems, backing_tracks):
+    """
+    Returns which of "stem" and "back_track" are wanted for `stem`.
+    """
+    wanted = []
+    if stem in stems:
+        wanted.append("stem")
+    if stem in backing_tracks:
+        wanted.append("back_track")
+    return wanted
+
+
+def synthesize_backing_track(back_track_url, input_path, stem_path, output_path):
+    """
+    Makes the backing track of a split locally, as the input minus the
+    stem track at `stem_path`, saving it under the name the server would
+    have given it.  Returns its path, or None if it couldn't be made or
+    didn't pass `lalalai_audio.subtract_stem`'s residual check, in which
+    case it should be downloaded.
+    """
+    try:
+        with http_pool.request("HEAD", back_track_url) as response:
+            file_path = os.path.join(output_path, download_filename(response.headers))
+    except (OSError, http.client.HTTPException):
+        return None
+
+    part_path = file_path + ".part"
+    try:
+        made = lalalai_audio.subtract_stem(input_path, stem_path, part_path)
+    except (EOFError, ValueError, wave.Error):
+        made = False
+    if not made:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return None
+    os.replace(part_path, file_path)
     return file_path
 
 
-def batch_process_multiple_stems(
-    api_key, input_path, output_path, stems, backing_tracks, filter_type, splitter
+async def async_download_split(
+    stem,
+    stem_track_url,
+    back_track_url,
+    output_path,
+    stems,
+    backing_tracks,
+    scheduler,
+    done=(),
+    on_downloaded=None,
+    input_path=None,
+    synthesize_backing=False,
+    trim=None,
+    flac_sample_width=None,
+):
+    """
+    Downloads the stem track and/or backing track of a finished split,
+    according to whether `stem` is in `stems` and/or `backing_tracks`,
+    each download taking one of the `scheduler`'s download slots.  Track
+    types listed in `done` were already downloaded and are skipped.
+    `on_downloaded`, if given, is called (on a worker thread) with the
+    stem, track type and file path of each download.
+
+    If `synthesize_backing` is true and NumPy is installed, the backing
+    track is made from the input at `input_path` minus the stem track
+    instead of being downloaded, halving what is fetched; the stem track
+    is downloaded for it even if it isn't wanted, and deleted after.  If
+    that doesn't work out, the backing track is downloaded after all.
+
+    If the input was trimmed of silence before it was uploaded, `trim` is
+    the `lalalai_audio.SilenceTrim` that says how, and the silence is put
+    back around each track as it's downloaded.  If it was uploaded as
+    FLAC, `flac_sample_width` is the bytes per sample of the PCM input,
+    and FLAC tracks are decoded back to the input's format first.
+    """
+
+    async def decode(file_path):
+        extension = os.path.splitext(input_path)[1].lower().replace(".aiff", ".aif")
+        pcm_path = os.path.splitext(file_path)[0] + extension
+        await run_cancellable(
+            lalalai_audio.decode_flac, file_path, pcm_path, flac_sample_width
+        )
+        os.remove(file_path)
+        return pcm_path
+
+    async def fetch(track_type, url, directory):
+        async with scheduler.download_slots:
+            report("download_start", track_type=track_type, stem=stem)
+            with trace_span(f"download {track_type}", stem):
+                file_path = await async_download_file(
+                    url, directory, stem, track_type
+                )
+        if flac_sample_width is not None and file_path.endswith(".flac"):
+            try:
+                file_path = await decode(file_path)
+            except (OSError, RuntimeError) as e:
+                report(
+                    "decompression_failed",
+                    track_type=track_type,
+                    stem=stem,
+                    message=str(e),
+                )
+                return file_path
+        if trim is not None:
+            restored = await asyncio.to_thread(
+                lalalai_audio.restore_silence, file_path, trim
+            )
+            if not restored:
+                report("silence_not_restored", track_type=track_type, stem=stem)
+        return file_path
+
+    async def downloaded(track_type, file_path):
+        if on_downloaded is not None:
+            await asyncio.to_thread(on_downloaded, stem, track_type, file_path)
+        report("download_complete", track_type=track_type, stem=stem)
+
+    want_stem = stem in stems and "stem" not in done
+    want_back = stem in backing_tracks and "back_track" not in done
+    synthesize = (
+        synthesize_backing
+        and want_back
+        and input_path is not None
+        and "stem" not in done
+        and lalalai_audio.numpy_available()
+    )
+
+    scratch = None
+    try:
+        stem_path = None
+        if want_stem or synthesize:
+            directory = output_path
+            if not want_stem:
+                scratch = tempfile.mkdtemp(prefix=".unmixer-", dir=output_path)
+                directory = scratch
+            stem_path = await fetch("stem", stem_track_url, directory)
+            if want_stem:
+                await downloaded("stem", stem_path)
+
+        if want_back:
+            file_path = None
+            if synthesize:
+                with trace_span("synthesize back_track", stem):
+                    file_path = await asyncio.to_thread(
+                        synthesize_backing_track,
+                        back_track_url,
+                        input_path,
+                        stem_path,
+                        output_path,
+                    )
+                if file_path is not None:
+                    report("backing_synthesized", stem=stem)
+                else:
+                    report("backing_synthesis_failed", stem=stem)
+            if file_path is None:
+                file_path = await fetch("back_track", back_track_url, output_path)
+            await downloaded("back_track", file_path)
+    finally:
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    report("split_complete", stem=stem)
+
+
+async def gather_or_cancel(coroutines):
+    """
+    Runs `coroutines` as concurrent tasks.  If one of them fails, the rest
+    are cancelled and the first exception is raised.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def plan_downloads(
+    input_path,
+    output_path,
+    stems,
+    backing_tracks,
+    filter_type,
+    splitter,
+    splits,
+    skip_existing,
+):
+    """
+    Works out which tracks of each wanted stem are already done, from a
+    resumed job's `splits` or from the output directory's manifest.
+    Returns the input's hash (if it was needed), the `OutputManifest`
+    (if `skip_existing`), and a dict mapping each wanted stem to the
+    track types it already has.
+    """
+    digest = None
+    manifest = None
+    if skip_existing:
+        digest = hash_file(input_path)
+        manifest = OutputManifest(output_path)
+
+    done = {}
+    for stem in stem_types:
+        wanted = wanted_track_types(stem, stems, backing_tracks)
+        if not wanted:
+            continue
+        split = splits.get(stem, {})
+        done[stem] = [
+            track_type
+            for track_type in wanted
+            if split.get(f"{track_type}_downloaded")
+            or manifest is not None
+            and manifest.satisfied(digest, stem, track_type, filter_type, splitter)
+        ]
+    return digest, manifest, done
+
+
+async def async_batch_process_multiple_stems(
+    api_key,
+    input_path,
+    output_path,
+    stems,
+    backing_tracks,
+    filter_type,
+    splitter,
+    max_concurrent_splits=DEFAULT_MAX_CONCURRENT_SPLITS,
+    max_concurrent_downloads=DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+    upload_cache=None,
+    journal=None,
+    job_id=None,
+    skip_existing=True,
+    scheduler=None,
+    synthesize_backing=False,
+    trim_silence=False,
+    compress_uploads=False,
+    segment_seconds=None,
 ):
     """
     Processes an audio file specified by `input_path` and splits it into
@@ -201,8 +2718,52 @@ def batch_process_multiple_stems(
     specified by `splitter`, and applies a filter of mild, normal, or
     aggressive strength as specified by `filter_type`.
 
+    Each stem is a task on the running event loop.  Up to
+    `max_concurrent_splits` splits are kept in flight at once, and
+    finished splits are downloaded, up to `max_concurrent_downloads` at
+    a time, while the remaining splits are still processing.  If a
+    `Scheduler` is given as `scheduler`, its limits, shared with whatever
+    else is using it, apply instead.  A stem that fails is reported with
+    a `stem_failed` event and doesn't stop the others; once they are all
+    done, a `RuntimeError` naming the failed stems is raised, and the
+    job is left unfinished in `journal` so it can be resumed.  If the
+    task running this is cancelled, all the stems are cancelled.
+
+    `api_key` is the license to use, or a `LicensePool` to take one from.
+
+    If an `UploadCache` is given as `upload_cache`, a file whose contents
+    were already uploaded is not sent again.
+
+    If a `JobJournal` is given as `journal`, each step is recorded in it as
+    a new job, or, if `job_id` is given, as a continuation of that job,
+    skipping the steps it already got through.
+
+    If `skip_existing` is true, an `OutputManifest` in `output_path`
+    records each download, and stem and backing tracks that the directory
+    already holds from the same input and settings aren't split or
+    downloaded again.
+
     The resulting stem tracks and backing tracks (if specified) are
-    downloaded to the `output_path` directory.
+    downloaded to the `output_path` directory.  If `synthesize_backing` is
+    true, backing tracks are made locally from the input and the stem
+    where that works, rather than downloaded; see `async_download_split`.
+
+    If `trim_silence` is true and the input is a WAV file, its leading and
+    trailing silence isn't uploaded, saving upload time and minutes, and
+    is put back around each track as it's downloaded so that the tracks
+    line up with the input sample for sample.  The journal records how
+    the upload was trimmed, for the tracks of a resumed job.
+
+    If `compress_uploads` is true and `flac` or `ffmpeg` is installed, an
+    uncompressed WAV or AIFF input is uploaded as losslessly compressed
+    FLAC, encoded while the upload's connection is set up, and the FLAC
+    tracks that come back are decoded to the input's format, a resumed
+    job's as the journal says its upload was made.
+
+    If `segment_seconds` is given, NumPy is installed and the input is a
+    WAV file longer than that, it's processed in overlapping segments of
+    about that length, with `async_process_segmented`, instead of all at
+    once.  Segmented jobs aren't recorded in `journal`.
     """
     # Validate stems and backing_tracks
     invalid_stem = validate_stems(stems)
@@ -213,56 +2774,841 @@ def batch_process_multiple_stems(
     if invalid_track:
         raise ValueError(f"Unrecognized backing track: {invalid_track}")
 
-    # Upload the file
-    print(f'%uploading "{input_path}"')
-    file_id = upload_file(file_path=input_path, license=api_key)
-    # print(f"The file has been successfully uploaded (file id: {file_id})")
-    print(f"%uploaded {file_id}")
+    if segment_seconds and job_id is None and lalalai_audio.numpy_available():
+        segments = await asyncio.to_thread(
+            plan_input_segments, input_path, segment_seconds
+        )
+        if len(segments) > 1:
+            return await async_process_segmented(
+                api_key,
+                input_path,
+                output_path,
+                stems,
+                backing_tracks,
+                filter_type,
+                splitter,
+                segments,
+                max_concurrent_splits=max_concurrent_splits,
+                max_concurrent_downloads=max_concurrent_downloads,
+                upload_cache=upload_cache,
+                skip_existing=skip_existing,
+                scheduler=scheduler,
+                synthesize_backing=synthesize_backing,
+                trim_silence=trim_silence,
+                compress_uploads=compress_uploads,
+            )
 
+    if isinstance(api_key, LicensePool):
+        return await async_process_with_pool(
+            api_key,
+            input_path,
+            output_path,
+            stems,
+            backing_tracks,
+            filter_type,
+            splitter,
+            max_concurrent_splits=max_concurrent_splits,
+            max_concurrent_downloads=max_concurrent_downloads,
+            upload_cache=upload_cache,
+            journal=journal,
+            job_id=job_id,
+            skip_existing=skip_existing,
+            scheduler=scheduler,
+            synthesize_backing=synthesize_backing,
+            trim_silence=trim_silence,
+            compress_uploads=compress_uploads,
+        )
+
+    file_id = None
+    uploaded = None
+    splits = {}
+    if journal is not None:
+        if job_id is None:
+            job_id = journal.create_job(
+                input_path,
+                output_path,
+                stems,
+                backing_tracks,
+                filter_type,
+                splitter,
+                {
+                    "trim_silence": trim_silence,
+                    "compress_uploads": compress_uploads,
+                },
+            )
+        else:
+            job = journal.get_job(job_id)
+            splits = job["splits"]
+            # a file ID is only good with the license that uploaded it
+            if job["license"] in (None, api_key):
+                file_id = job["file_id"]
+                uploaded = job["upload"]
+
+    # work out which tracks of each stem we already have, from the journal
+    # or from the manifest, and drop the stems that need nothing more
+    digest, manifest, done = await asyncio.to_thread(
+        plan_downloads,
+        input_path,
+        output_path,
+        stems,
+        backing_tracks,
+        filter_type,
+        splitter,
+        splits,
+        skip_existing,
+    )
     want = []
-    for candidate in [
-        "vocals",
-        "drum",
-        "bass",
-        "piano",
-        "electric_guitar",
-        "acoustic_guitar",
-        "synthesizer",
-        "voice",
-        "strings",
-        "wind",
-    ]:
-        if candidate in stems or candidate in backing_tracks:
-            want.append(candidate)
-
-    # Split the file for each stem
-    for i in range(len(want)):
-        stem = want[i]
-        # print(f'Processing the file for stem "{stem}"...')
-        print(f"%split_start {stem}")
-        if i == 0:
-            split_file(file_id, api_key, stem, filter_type, splitter)
-
-        stem_track_url, back_track_url = check_file(stem, file_id)
-
-        if i + 1 < len(stems):
-            next_stem = want[i + 1]
-            # print(f'Early start processing of next stem extraction "{next_stem}"...')
-            print(f"%split_start {next_stem}")
-            split_file(file_id, api_key, next_stem, filter_type, splitter)
-
-        if stem in stems:
-            # print(f'Downloading stem {stem} "{stem_track_url}"')
-            print(f"%download_start stem {stem}")
-            downloaded_file = download_file(stem_track_url, output_path)
-            print(f"%download_complete stem {stem}")
-
-        if stem in backing_tracks:
-            # print(f'Downloading backing track {stem} "{back_track_url}"')
-            print(f"%download_start back_track {stem}")
-            downloaded_file = download_file(back_track_url, output_path)
-            print(f"%download_complete back_track {stem}")
-
-        # print(f'The file has been successfully split for stem "{stem}"')
-        print(f"%split_complete {stem}")
-    print(f"%unmixing_complete")
+    for stem, done_track_types in done.items():
+        wanted = wanted_track_types(stem, stems, backing_tracks)
+        if len(done_track_types) == len(wanted):
+            report("already_extracted", stem=stem)
+        else:
+            want.append(stem)
+
+    if not want:
+        if journal is not None:
+            journal.finish_job(job_id)
+        report("unmixing_complete")
+        return
+
+    def downloaded(stem, track_type, file_path):
+        if journal is not None:
+            journal.downloaded(job_id, stem, track_type)
+        if manifest is not None:
+            manifest.record(digest, stem, track_type, filter_type, splitter, file_path)
+
+    if scheduler is None:
+        scheduler = Scheduler(
+            max_concurrent_splits=max_concurrent_splits,
+            max_concurrent_downloads=max_concurrent_downloads,
+        )
+
+    async def upload(upload_path, upload_digest):
+        """returns the file ID and the seconds the upload itself took"""
+        async with scheduler.upload_slots:
+            report("uploading", path=input_path)
+            start = time.monotonic()
+            with trace_span("upload", "upload", path=input_path):
+                if upload_cache is None:
+                    file_id = await async_upload_file(
+                        upload_path, api_key, bandwidth=scheduler.bandwidth
+                    )
+                else:
+                    file_id = await async_upload_file_cached(
+                        upload_path,
+                        api_key,
+                        upload_cache,
+                        digest=upload_digest,
+                        bandwidth=scheduler.bandwidth,
+                    )
+            return file_id, time.monotonic() - start
+
+    # only the audible part of the input is uploaded if it's trimmed; the
+    # tracks that come back are padded out again as they're downloaded
+    # (a resumed job's tracks come back from the upload it already made,
+    # so they're padded out as the journal says that was trimmed)
+    trim = None
+    if file_id is not None and uploaded is not None:
+        if uploaded.get("trim") is not None:
+            trim = lalalai_audio.SilenceTrim(**uploaded["trim"])
+    elif trim_silence and lalalai_audio.numpy_available():
+        if await asyncio.to_thread(lalalai_audio.is_wav, input_path):
+            trim = await asyncio.to_thread(lalalai_audio.measure_silence, input_path)
+
+    # and PCM inputs are uploaded as FLAC, if there's an encoder, with the
+    # tracks decoded back to the input's format as they're downloaded
+    flac_sample_width = None
+    if file_id is not None and uploaded is not None:
+        flac_sample_width = uploaded.get("flac_sample_width")
+    elif compress_uploads and lalalai_audio.flac_encoder() is not None:
+        sample_width = await asyncio.to_thread(
+            lalalai_audio.pcm_sample_width, input_path
+        )
+        if sample_width and sample_width <= lalalai_audio.FLAC_MAX_SAMPLE_WIDTH:
+            flac_sample_width = sample_width
+
+    # Upload the file, preparing any trimmed or compressed copy in a
+    # scratch directory; the compression overlaps waiting for an upload
+    # slot as well as setting up the connection
+    if file_id is None:
+        scratch = None
+        if trim is not None or flac_sample_width is not None:
+            scratch = tempfile.mkdtemp(prefix=".unmixer-", dir=output_path)
+        try:
+            upload_path, upload_digest = input_path, digest
+            if trim is not None:
+                upload_path = os.path.join(scratch, os.path.basename(input_path))
+                await asyncio.to_thread(
+                    lalalai_audio.write_trimmed, input_path, trim, upload_path
+                )
+                report(
+                    "silence_trimmed",
+                    seconds=round(trim.seconds_saved, 3),
+                    bytes=trim.bytes_saved,
+                )
+                upload_digest = None
+
+            compressed = None
+            if flac_sample_width is not None:
+                compressed = await async_compress_upload(upload_path, scratch)
+            if compressed is None:
+                flac_sample_width = None
+                file_id, _ = await upload(upload_path, upload_digest)
+            else:
+                flac_path, encode_seconds = compressed
+                file_id, upload_seconds = await upload(flac_path, None)
+                # what sending the PCM would have taken at the rate the
+                # FLAC went, less the time spent encoding it
+                ratio = os.path.getsize(upload_path) / os.path.getsize(flac_path)
+                report(
+                    "compression_saved",
+                    seconds=round(upload_seconds * (ratio - 1) - encode_seconds, 2),
+                )
+        finally:
+            if scratch is not None:
+                shutil.rmtree(scratch, ignore_errors=True)
+        if journal is not None:
+            upload_info = {
+                "trim": None if trim is None else vars(trim),
+                "flac_sample_width": flac_sample_width,
+            }
+            journal.set_file_id(job_id, file_id, api_key, upload_info)
+    # print(f"The file has been successfully uploaded (file id: {file_id})")
+    report("uploaded", file_id=file_id)
+
+    async def process_stem(stem):
+        try:
+            await split_and_download(stem)
+        except Exception as e:
+            report("stem_failed", stem=stem, message=str(e))
+            if metrics is not None:
+                metrics.add("unmixer_stems_total", outcome="failed")
+            return e
+        if metrics is not None:
+            metrics.add("unmixer_stems_total", outcome="complete")
+        return None
+
+    async def split_and_download(stem):
+        # splits that a resumed job already finished go straight to
+        # downloading; the others hold a split slot until they're done
+        split = splits.get(stem, {})
+        if split.get("stem_track_url"):
+            urls = split["stem_track_url"], split["back_track_url"]
+        else:
+            async with scheduler.split_slots:
+                urls = await async_split_and_wait(
+                    file_id,
+                    api_key,
+                    stem,
+                    filter_type,
+                    splitter,
+                    journal,
+                    job_id,
+                    split.get("check_id"),
+                    scheduler,
+                )
+        await async_download_split(
+            stem,
+            *urls,
+            output_path,
+            stems,
+            backing_tracks,
+            scheduler,
+            done[stem],
+            downloaded,
+            input_path,
+            synthesize_backing,
+            trim,
+            flac_sample_width,
+        )
+
+    results = await gather_or_cancel(process_stem(stem) for stem in want)
+    failures = [
+        f"{stem}: {exception}"
+        for stem, exception in zip(want, results)
+        if exception is not None
+    ]
+    if failures:
+        error = RuntimeError(
+            f"{len(failures)} of {len(want)} stems failed: " + "; ".join(failures)
+        )
+        # raised from a refusal of the license, if there was one, so that
+        # async_process_with_pool can tell
+        for exception in results:
+            if exception is not None and license_refused(exception):
+                raise error from exception
+        raise error
+
+    if journal is not None:
+        journal.finish_job(job_id)
+    report("unmixing_complete")
+
+
+def plan_input_segments(input_path, segment_seconds):
+    """
+    Returns the (start frame, frame count) pairs of the segments of about
+    `segment_seconds` that the input should be processed in, overlapping
+    by SEGMENT_OVERLAP_SECONDS, or an empty list if it isn't a WAV file.
+    """
+    if not lalalai_audio.is_wav(input_path):
+        return []
+    total_frames, framerate = lalalai_audio.wav_length(input_path)
+    return lalalai_audio.plan_segments(
+        total_frames,
+        int(segment_seconds * framerate),
+        int(SEGMENT_OVERLAP_SECONDS * framerate),
+    )
+
+
+async def async_process_segmented(
+    api_key,
+    input_path,
+    output_path,
+    stems,
+    backing_tracks,
+    filter_type,
+    splitter,
+    segments,
+    max_concurrent_splits=DEFAULT_MAX_CONCURRENT_SPLITS,
+    max_concurrent_downloads=DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+    skip_existing=True,
+    scheduler=None,
+    **kwargs,
+):
+    """
+    Runs `async_batch_process_multiple_stems` on each of the overlapping
+    `segments` of the WAV file at `input_path`, given as (start frame,
+    frame count) pairs, all at once under one `Scheduler`, then stitches
+    each track back together from the segments' copies of it with
+    `lalalai_audio.stitch_segments`.  While one segment uploads, those
+    before it are splitting and downloading, so the first results come
+    much sooner than for the whole file; the time until the first
+    segment is done is reported with a `first_segment` event.  Progress
+    events about a segment carry its 1-based `segment` number.
+
+    A segment that fails is retried on its own, up to SEGMENT_RETRIES
+    times, fetching only the tracks it's still missing.  The segments are
+    worked on in a scratch directory in `output_path`, which is removed
+    once the tracks are stitched.  If a segment still fails, the others
+    are seen through, the scratch directory is kept so that running the
+    job again carries on where it left off, and a `RuntimeError` is
+    raised.  Other keyword arguments are passed on for each segment.
+    """
+    digest, manifest, done = await asyncio.to_thread(
+        plan_downloads,
+        input_path,
+        output_path,
+        stems,
+        backing_tracks,
+        filter_type,
+        splitter,
+        {},
+        skip_existing,
+    )
+    for stem, done_track_types in done.items():
+        wanted = wanted_track_types(stem, stems, backing_tracks)
+        if len(done_track_types) == len(wanted):
+            report("already_extracted", stem=stem)
+    stems = [stem for stem in stems if "stem" not in done[stem]]
+    backing_tracks = [
+        stem for stem in backing_tracks if "back_track" not in done[stem]
+    ]
+    if not stems and not backing_tracks:
+        report("unmixing_complete")
+        return
+
+    if scheduler is None:
+        scheduler = Scheduler(
+            max_concurrent_splits=max_concurrent_splits,
+            max_concurrent_downloads=max_concurrent_downloads,
+        )
+
+    name = os.path.basename(input_path)
+    scratch = os.path.join(output_path, f".unmixer-segments-{name}")
+    start_time = time.monotonic()
+    first_done = False
+    report("segmenting", count=len(segments))
+
+    def segment_directory(number):
+        return os.path.join(scratch, f"part{number:03d}")
+
+    async def process_segment(number, start, nframes):
+        nonlocal first_done
+        current_segment.set(number)
+        directory = segment_directory(number)
+        segment_path = os.path.join(directory, name)
+        await asyncio.to_thread(
+            os.makedirs, os.path.join(directory, "tracks"), exist_ok=True
+        )
+        await asyncio.to_thread(
+            lalalai_audio.write_frames, input_path, start, nframes, segment_path
+        )
+        for attempt in range(SEGMENT_RETRIES + 1):
+            try:
+                await async_batch_process_multiple_stems(
+                    api_key,
+                    segment_path,
+                    os.path.join(directory, "tracks"),
+                    stems,
+                    backing_tracks,
+                    filter_type,
+                    splitter,
+                    scheduler=scheduler,
+                    **kwargs,
+                )
+                break
+            except Exception as e:
+                if attempt == SEGMENT_RETRIES:
+                    report("segment_failed", message=str(e))
+                    return e
+                report("segment_retry", attempt=attempt + 1, message=str(e))
+
+        report("segment_complete", count=len(segments))
+        if not first_done:
+            first_done = True
+            seconds = time.monotonic() - start_time
+            report("first_segment", seconds=round(seconds, 3))
+            if metrics is not None:
+                metrics.observe("unmixer_phase_seconds", seconds, phase="first_segment")
+        return None
+
+    results = await gather_or_cancel(
+        process_segment(number, start, nframes)
+        for number, (start, nframes) in enumerate(segments, 1)
+    )
+    failures = [exception for exception in results if exception is not None]
+    if failures:
+        raise RuntimeError(
+            f"{len(failures)} of {len(segments)} segments failed: {failures[0]}"
+        )
+
+    def segment_tracks(number):
+        # the tracks split from this segment as it is now, by stem and
+        # track type, from the manifest its run kept
+        directory = segment_directory(number)
+        segment_digest = hash_file(os.path.join(directory, name))
+        segment_manifest = OutputManifest(os.path.join(directory, "tracks"))
+        return {
+            (entry["stem"], entry["track_type"]): os.path.join(
+                segment_manifest.output_path, entry["file"]
+            )
+            for entry in segment_manifest.entries
+            if entry["input_hash"] == segment_digest
+            and entry["filter"] == filter_type
+            and entry["splitter"] == splitter
+        }
+
+    tracks = [
+        await asyncio.to_thread(segment_tracks, number)
+        for number in range(1, len(segments) + 1)
+    ]
+    for stem in stem_types:
+        for track_type in wanted_track_types(stem, stems, backing_tracks):
+            paths = [segment.get((stem, track_type)) for segment in tracks]
+            if None in paths:
+                raise RuntimeError(f"a segment is missing the {stem} {track_type}")
+            file_path = os.path.join(output_path, os.path.basename(paths[0]))
+            with trace_span(f"stitch {track_type}", stem):
+                stitched = await asyncio.to_thread(
+                    lalalai_audio.stitch_segments, paths, segments, file_path
+                )
+            if not stitched:
+                raise RuntimeError(
+                    f"couldn't stitch the segments of {os.path.basename(file_path)}"
+                )
+            if manifest is not None:
+                await asyncio.to_thread(
+                    manifest.record,
+                    digest,
+                    stem,
+                    track_type,
+                    filter_type,
+                    splitter,
+                    file_path,
+                )
+            report("stitched", track_type=track_type, stem=stem)
+
+    await asyncio.to_thread(shutil.rmtree, scratch, ignore_errors=True)
+    report("unmixing_complete")
+
+
+def batch_process_multiple_stems(*args, trace_path=None, **kwargs):
+    """
+    Runs `async_batch_process_multiple_stems` to completion on an event
+    loop of its own.  Must not be called from a running event loop.  If
+    `trace_path` is given, a Chrome trace of the run is written there.
+    """
+    if trace_path is None:
+        return asyncio.run(async_batch_process_multiple_stems(*args, **kwargs))
+    with tracing(trace_path):
+        return asyncio.run(async_batch_process_multiple_stems(*args, **kwargs))
+
+
+async def async_resume_job(api_key, journal, job_id, **kwargs):
+    """
+    Picks up the job `job_id` recorded in `journal` at its first
+    unfinished step: uploading, splitting, polling or downloading.
+    Keyword arguments are passed on to `async_batch_process_multiple_stems`,
+    except that the settings the job was started with, as journaled,
+    override them.
+    """
+    job = journal.get_job(job_id)
+    kwargs.update(job["settings"])
+    await async_batch_process_multiple_stems(
+        api_key,
+        job["input_path"],
+        job["output_path"],
+        job["stems"],
+        job["backing_tracks"],
+        job["filter_type"],
+        job["splitter"],
+        journal=journal,
+        job_id=job_id,
+        **kwargs,
+    )
+
+
+def resume_job(*args, **kwargs):
+    """Runs `async_resume_job` to completion on an event loop of its own."""
+    return asyncio.run(async_resume_job(*args, **kwargs))
+
+
+def collect_input_files(paths):
+    """
+    Expands a list of files and directories into a sorted list of audio
+    files, searching directories recursively for AUDIO_EXTENSIONS.
+    """
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        found = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in filenames:
+                if filename.lower().endswith(AUDIO_EXTENSIONS):
+                    found.append(os.path.join(dirpath, filename))
+        files.extend(sorted(found))
+    return files
+
+
+async def process_one_of_many(
+    file_index, file_count, api_key, input_path, *args, **kwargs
+):
+    """
+    Runs `async_batch_process_multiple_stems` for one file of a batch,
+    tagging its progress events with its position in the batch.  Returns
+    None on success, else the exception that stopped it.
+    """
+    current_file_index.set(file_index)
+    report("file_start", file_count=file_count, path=input_path)
+    try:
+        await async_batch_process_multiple_stems(api_key, input_path, *args, **kwargs)
+    except Exception as e:
+        report("file_failed", message=str(e))
+        return e
+    report("file_complete")
+    return None
+
+
+async def async_batch_process_multiple_files(
+    api_key,
+    input_paths,
+    output_path,
+    stems,
+    backing_tracks,
+    filter_type,
+    splitter,
+    max_concurrent_uploads=DEFAULT_MAX_CONCURRENT_UPLOADS,
+    max_concurrent_splits=DEFAULT_MAX_CONCURRENT_SPLITS,
+    max_concurrent_downloads=DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+    max_upload_rate=None,
+    **kwargs,
+):
+    """
+    Runs `async_batch_process_multiple_stems` for each of `input_paths`,
+    which may include directories of audio files, saving everything into
+    `output_path`.  Uploads, splits and downloads of all the files share
+    one `Scheduler`, so the limits apply to the batch as a whole, and
+    while one file uploads others are splitting and downloading.  Each
+    file's progress events carry its 1-based `file_index`.
+
+    A file that fails is reported with a `file_failed` event and doesn't
+    stop the others.  Returns a dict mapping each failed path to its
+    exception.  Other keyword arguments are passed on to
+    `async_batch_process_multiple_stems`.
+    """
+    input_paths = await asyncio.to_thread(collect_input_files, input_paths)
+    scheduler = Scheduler(
+        max_concurrent_uploads=max_concurrent_uploads,
+        max_concurrent_splits=max_concurrent_splits,
+        max_concurrent_downloads=max_concurrent_downloads,
+        max_upload_rate=max_upload_rate,
+    )
+
+    # enough files are worked on at once to keep every upload slot and
+    # split slot busy; the rest wait their turn
+    file_slots = asyncio.Semaphore(
+        max(1, max_concurrent_uploads + max_concurrent_splits)
+    )
+
+    async def process_file(file_index, input_path):
+        async with file_slots:
+            return await process_one_of_many(
+                file_index,
+                len(input_paths),
+                api_key,
+                input_path,
+                output_path,
+                stems,
+                backing_tracks,
+                filter_type,
+                splitter,
+                scheduler=scheduler,
+                **kwargs,
+            )
+
+    results = await gather_or_cancel(
+        process_file(file_index, input_path)
+        for file_index, input_path in enumerate(input_paths, 1)
+    )
+    failures = {
+        input_path: exception
+        for input_path, exception in zip(input_paths, results)
+        if exception is not None
+    }
+
+    report("batch_complete", file_count=len(input_paths), failed=len(failures))
+    return failures
+
+
+def batch_process_multiple_files(*args, trace_path=None, **kwargs):
+    """
+    Runs `async_batch_process_multiple_files` to completion on an event
+    loop of its own.  Must not be called from a running event loop.  If
+    `trace_path` is given, a Chrome trace of the run is written there.
+    """
+    if trace_path is None:
+        return asyncio.run(async_batch_process_multiple_files(*args, **kwargs))
+    with tracing(trace_path):
+        return asyncio.run(async_batch_process_multiple_files(*args, **kwargs))
+
+
+def parse_stem_list(value):
+    """Parses a comma-separated list of stems from the command line."""
+    return [stem.strip() for stem in value.split(",") if stem.strip()]
+
+
+def main():
+    """
+    Command-line entry point, for running without the GUI.  Progress is
+    written to stdout as JSON lines by default.
+    """
+    global progress_handler, URL_API
+    filters = {"mild": 0, "normal": 1, "aggressive": 2}
+
+    parser = ArgumentParser(description="Split audio into stems with Lalal.ai")
+    parser.add_argument(
+        "--license",
+        default=os.environ.get("LALALAI_LICENSE"),
+        help="license key, or comma-separated keys to share the work among "
+        "(default: $LALALAI_LICENSE)",
+    )
+    parser.add_argument(
+        "--api-url",
+        default=URL_API,
+        help=f"the API's base URL (default: $LALALAI_API_URL or {URL_API})",
+    )
+    parser.add_argument(
+        "--input",
+        nargs="+",
+        help="audio files, or directories of them, to split (not needed with "
+        "--resume)",
+    )
+    parser.add_argument(
+        "--output", default=".", help="directory to save tracks to (default: .)"
+    )
+    parser.add_argument(
+        "--stems",
+        type=parse_stem_list,
+        default=[],
+        help=f"comma-separated stems to extract: {', '.join(stem_types)}",
+    )
+    parser.add_argument(
+        "--backing-tracks",
+        type=parse_stem_list,
+        default=[],
+        help="comma-separated stems whose backing tracks to extract",
+    )
+    parser.add_argument("--filter", choices=filters, default="normal")
+    parser.add_argument(
+        "--splitter", choices=["phoenix", "cassiopeia"], default="phoenix"
+    )
+    parser.add_argument(
+        "--max-concurrent-uploads", type=int, default=DEFAULT_MAX_CONCURRENT_UPLOADS
+    )
+    parser.add_argument(
+        "--max-upload-rate",
+        type=float,
+        metavar="BYTES_PER_SECOND",
+        help="cap on the combined upload rate",
+    )
+    parser.add_argument(
+        "--max-concurrent-splits", type=int, default=DEFAULT_MAX_CONCURRENT_SPLITS
+    )
+    parser.add_argument(
+        "--max-concurrent-downloads",
+        type=int,
+        default=DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+    )
+    parser.add_argument(
+        "--upload-cache", metavar="DB_FILE", help="SQLite file to cache uploads in"
+    )
+    parser.add_argument(
+        "--journal", metavar="DB_FILE", help="SQLite file to journal the job in"
+    )
+    parser.add_argument(
+        "--resume",
+        type=int,
+        metavar="JOB_ID",
+        help="resume a job from --journal instead of starting a new one",
+    )
+    parser.add_argument(
+        "--no-skip-existing",
+        action="store_true",
+        help="split and download even tracks already in the output directory",
+    )
+    parser.add_argument(
+        "--synthesize-backing-tracks",
+        action="store_true",
+        help="make backing tracks locally from the input and stem, if NumPy is "
+        "installed, instead of downloading them",
+    )
+    parser.add_argument(
+        "--trim-silence",
+        action="store_true",
+        help="upload WAV inputs without their leading and trailing silence, "
+        "padding the tracks out again after (needs NumPy)",
+    )
+    parser.add_argument(
+        "--compress-uploads",
+        action="store_true",
+        help="upload WAV and AIFF inputs as lossless FLAC, decoding the tracks "
+        "back after (needs flac or ffmpeg)",
+    )
+    parser.add_argument(
+        "--segment-minutes",
+        type=float,
+        metavar="MINUTES",
+        help="process WAV inputs longer than this in overlapping segments, "
+        "split in parallel and crossfaded back together (needs NumPy)",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help="record metrics and write them to FILE during and after the run",
+    )
+    parser.add_argument(
+        "--metrics-format",
+        choices=["prometheus", "json"],
+        help="format of --metrics (default: json for *.json, else prometheus)",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="write a Chrome trace of the run to FILE, for chrome://tracing",
+    )
+    parser.add_argument(
+        "--progress",
+        choices=["json", "text"],
+        default="json",
+        help="progress format: JSON lines, or UnMixer's %%-prefixed lines",
+    )
+    args = parser.parse_args()
+
+    URL_API = args.api_url
+    if args.progress == "json":
+        progress_handler = print_progress_json
+
+    if not args.license:
+        parser.error("a license key is required (--license or $LALALAI_LICENSE)")
+    if args.resume is not None and not args.journal:
+        parser.error("--resume requires --journal")
+
+    # a resumed job's input and stems come from the journal
+    input_paths = []
+    if args.resume is None:
+        if not args.input:
+            parser.error("--input is required unless resuming a job with --resume")
+        if not args.stems and not args.backing_tracks:
+            parser.error("at least one of --stems or --backing-tracks is required")
+        input_paths = collect_input_files(args.input)
+        if not input_paths:
+            parser.error("no audio files found in --input")
+
+    licenses = [key.strip() for key in args.license.split(",") if key.strip()]
+    license = licenses[0] if len(licenses) == 1 else LicensePool(licenses)
+    upload_cache = UploadCache(args.upload_cache) if args.upload_cache else None
+    journal = JobJournal(args.journal) if args.journal else None
+    options = {
+        "max_concurrent_splits": args.max_concurrent_splits,
+        "max_concurrent_downloads": args.max_concurrent_downloads,
+        "upload_cache": upload_cache,
+        "skip_existing": not args.no_skip_existing,
+        "synthesize_backing": args.synthesize_backing_tracks,
+        "trim_silence": args.trim_silence,
+        "compress_uploads": args.compress_uploads,
+        "segment_seconds": args.segment_minutes and args.segment_minutes * 60,
+    }
+
+    if args.metrics:
+        enable_metrics()
+        stop_metrics_writer = start_metrics_writer(args.metrics, args.metrics_format)
+
+    trace = tracing(args.trace) if args.trace else contextlib.nullcontext()
+    with trace:
+        try:
+            if args.resume is not None:
+                resume_job(license, journal, args.resume, **options)
+            elif len(input_paths) > 1:
+                os.makedirs(args.output, exist_ok=True)
+                failures = batch_process_multiple_files(
+                    license,
+                    input_paths,
+                    args.output,
+                    args.stems,
+                    args.backing_tracks,
+                    filters[args.filter],
+                    args.splitter,
+                    max_concurrent_uploads=args.max_concurrent_uploads,
+                    max_upload_rate=args.max_upload_rate,
+                    journal=journal,
+                    **options,
+                )
+                return 1 if failures else 0
+            else:
+                os.makedirs(args.output, exist_ok=True)
+                batch_process_multiple_stems(
+                    license,
+                    input_paths[0],
+                    args.output,
+                    args.stems,
+                    args.backing_tracks,
+                    filters[args.filter],
+                    args.splitter,
+                    journal=journal,
+                    **options,
+                )
+        except Exception as e:
+            report("error", message=str(e))
+            return 1
+        finally:
+            if args.metrics:
+                stop_metrics_writer.set()
+                metrics.write(args.metrics, args.metrics_format)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
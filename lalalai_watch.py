@@ -0,0 +1,669 @@
+"""
+A watch-folder daemon for lalalai_splitter: each audio file that lands in
+one of the watched directories is split with
+`async_batch_process_multiple_stems`, using that folder's stems, backing
+tracks, filter and splitter, once its size and modification time have
+stopped changing.  Directories are watched with inotify on Linux and
+polled elsewhere.  Handled files are recorded in an SQLite ledger, so a
+restarted daemon only picks up what's new.
+
+Usage:
+    python3 lalalai_watch.py --folder ~/Bounces --output ~/Stems --stems vocals
+    python3 lalalai_watch.py --config watch.json
+
+where watch.json holds a preset for each folder, any key of which but
+"path" may be left out to use the command line's value:
+
+    {"folders": [{"path": "~/Bounces/vocals", "output": "~/Stems",
+                  "stems": ["vocals"], "backing_tracks": ["vocals"],
+                  "filter": "normal", "splitter": "phoenix"}]}
+"""
+
+import asyncio
+import contextlib
+import ctypes
+import ctypes.util
+import json
+import os
+import signal
+import sqlite3
+import stat
+import struct
+import sys
+import time
+from argparse import ArgumentParser
+
+import lalalai_splitter
+
+# how long a file's size and modification time must stay the same before
+# it's taken to be completely written, and how often that's checked, in
+# seconds
+SETTLE_SECONDS = 5.0
+SETTLE_CHECK_INTERVAL = 1.0
+
+# how often the folders are rescanned when inotify isn't available
+POLL_INTERVAL = 10.0
+
+# a file whose split couldn't be run at all is tried again after
+# RETRY_SECONDS, doubling with each failure in a row up to RETRY_MAX_SECONDS
+RETRY_SECONDS = 30.0
+RETRY_MAX_SECONDS = 3600.0
+
+# how many settled files may wait for a worker before the daemon stops
+# queueing more
+WORK_QUEUE_SIZE = 16
+
+# where handled files are recorded unless --ledger says otherwise
+DEFAULT_LEDGER = os.path.expanduser("~/.unmixer_watch.sqlite3")
+
+FILTERS = {"mild": 0, "normal": 1, "aggressive": 2}
+
+# from <sys/inotify.h>: a file written and closed, or moved in, and the
+# event queue having overflowed; IN_NONBLOCK and IN_CLOEXEC are the same
+# as the open(2) flags
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct("iIII")
+INOTIFY_READ_SIZE = 64 * 1024
+
+
+def load_inotify():
+    """returns the C library if it has inotify, as on Linux, else None"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class InotifyWatcher:
+    """
+    Watches directories with inotify, calling `on_path` with the path of
+    each file that is written and closed in, or moved into, one of them,
+    and `on_overflow` if events were lost, so the directories must be
+    rescanned.  Its descriptor is read by the event loop, so it needs no
+    thread of its own.
+    """
+
+    def __init__(self, libc, directories, on_path, on_overflow):
+        self.libc = libc
+        self.directories = directories
+        self.on_path = on_path
+        self.on_overflow = on_overflow
+        self.watches = {}
+        self.fd = None
+
+    def start(self, loop):
+        """start watching, raising OSError if inotify can't be set up"""
+        fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.fd = fd
+        for directory in self.directories:
+            wd = self.libc.inotify_add_watch(
+                fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO
+            )
+            if wd < 0:
+                errno = ctypes.get_errno()
+                self.close(None)
+                raise OSError(errno, os.strerror(errno), directory)
+            self.watches[wd] = directory
+        loop.add_reader(fd, self.read)
+
+    def read(self):
+        """pass on the events waiting on the descriptor"""
+        try:
+            data = os.read(self.fd, INOTIFY_READ_SIZE)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.on_overflow()
+            elif name and wd in self.watches:
+                self.on_path(os.path.join(self.watches[wd], os.fsdecode(name)))
+
+    def close(self, loop):
+        """stop watching"""
+        if self.fd is None:
+            return
+        if loop is not None:
+            loop.remove_reader(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+
+class FolderPreset:
+    """
+    A watched directory and what to do with the audio files that land in
+    it: where to save their tracks, and the stems, backing tracks, filter
+    and splitter to split them with.
+    """
+
+    def __init__(self, path, output, stems, backing_tracks, filter_type, splitter):
+        self.path = os.path.realpath(os.path.expanduser(path))
+        self.output = os.path.realpath(os.path.expanduser(output))
+        self.stems = stems
+        self.backing_tracks = backing_tracks
+        self.filter_type = filter_type
+        self.splitter = splitter
+
+        if not os.path.isdir(self.path):
+            raise ValueError(f"{path} is not a directory")
+        if self.output == self.path:
+            # the tracks would be picked up and split in turn
+            raise ValueError(f"{path} can't be its own output directory")
+        if not stems and not backing_tracks:
+            raise ValueError(f"{path} has no stems or backing tracks to extract")
+        invalid = lalalai_splitter.validate_stems(stems + backing_tracks)
+        if invalid is not None:
+            raise ValueError(f"{path} has an unknown stem: {invalid}")
+
+    @classmethod
+    def from_config(cls, entry, defaults):
+        """
+        Makes a preset from one entry of a config file's "folders" list,
+        taking anything it leaves out from the `defaults` dict.
+        """
+        if "path" not in entry:
+            raise ValueError("a folder preset needs a path")
+        settings = {**defaults, **entry}
+        if "output" not in settings:
+            raise ValueError(f"{settings['path']} has no output directory")
+        stems = settings.get("stems", [])
+        backing_tracks = settings.get("backing_tracks", [])
+        if isinstance(stems, str):
+            stems = lalalai_splitter.parse_stem_list(stems)
+        if isinstance(backing_tracks, str):
+            backing_tracks = lalalai_splitter.parse_stem_list(backing_tracks)
+        filter_type = settings.get("filter", "normal")
+        if filter_type not in FILTERS:
+            raise ValueError(f"unknown filter: {filter_type}")
+        return cls(
+            settings["path"],
+            settings["output"],
+            stems,
+            backing_tracks,
+            FILTERS[filter_type],
+            settings.get("splitter", "phoenix"),
+        )
+
+
+def load_presets(config_path, defaults):
+    """reads the folder presets from the JSON file at `config_path`"""
+    with open(config_path) as f:
+        config = json.load(f)
+    return [FolderPreset.from_config(entry, defaults) for entry in config["folders"]]
+
+
+class WatchLedger:
+    """
+    The files the daemon has handled, in an SQLite table keyed by path,
+    size and modification time, so that a file is split once however
+    often the daemon is restarted, and again only if it's replaced.
+    Failures are recorded too, but only stop a file being retried until
+    the daemon is next started.
+    """
+
+    def __init__(self, db_file):
+        """initialize database connection and load the handled files"""
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.create_table()
+        self.handled = {
+            tuple(row)
+            for row in self.execute(
+                "SELECT path, size, mtime_ns FROM watched_files WHERE status = 'done'"
+            )
+        }
+
+    def execute(self, sql, args=()):
+        """run a statement, commit, and return any rows it produced"""
+        cursor = self.conn.execute(sql, args)
+        rows = cursor.fetchall()
+        self.conn.commit()
+        return rows
+
+    def create_table(self):
+        """create the watched files table if it doesn't exist"""
+        self.execute(
+            """
+            CREATE TABLE IF NOT EXISTS watched_files (
+                path text NOT NULL,
+                size integer NOT NULL,
+                mtime_ns integer NOT NULL,
+                status text NOT NULL,
+                message text,
+                finished real NOT NULL,
+                PRIMARY KEY (path, size, mtime_ns)
+            );
+        """
+        )
+
+    @staticmethod
+    def key(path, stat_result):
+        """the key a file is recorded under"""
+        return (path, stat_result.st_size, stat_result.st_mtime_ns)
+
+    def is_handled(self, key):
+        """whether the file with `key` has been handled"""
+        return key in self.handled
+
+    def record(self, key, status, message=None):
+        """record that the file with `key` is done, or has failed"""
+        self.execute(
+            """
+            INSERT OR REPLACE INTO watched_files
+            (path, size, mtime_ns, status, message, finished)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """,
+            (*key, status, message, time.time()),
+        )
+        # only once it's on disk, so that a file whose outcome couldn't be
+        # recorded is tried again
+        self.handled.add(key)
+
+
+class WatchDaemon:
+    """
+    Feeds the settled audio files of every preset's folder into one
+    bounded work queue, which `workers` tasks drain by splitting them
+    with `async_batch_process_multiple_stems` under a shared `Scheduler`,
+    recording each in `ledger` when it's finished.  A file that fails
+    before its outcome is recorded is tried again after a backoff.  Other
+    keyword arguments are passed on to `async_batch_process_multiple_stems`.
+    """
+
+    def __init__(
+        self,
+        api_key,
+        presets,
+        ledger,
+        workers,
+        scheduler,
+        use_inotify=True,
+        settle_seconds=SETTLE_SECONDS,
+        queue_size=WORK_QUEUE_SIZE,
+        **kwargs,
+    ):
+        self.api_key = api_key
+        self.presets = {preset.path: preset for preset in presets}
+        self.ledger = ledger
+        self.workers = max(1, workers)
+        self.scheduler = scheduler
+        self.use_inotify = use_inotify
+        self.settle_seconds = settle_seconds
+        self.queue = asyncio.Queue(maxsize=max(1, queue_size))
+        self.kwargs = kwargs
+        # path -> (preset, ledger key, when the key last changed) for files
+        # waiting to settle, and the paths queued or being split
+        self.pending = {}
+        self.busy = set()
+        # path -> failures in a row, and path -> when to try it again, for
+        # files that failed without their outcome being recorded
+        self.failures = {}
+        self.retries = {}
+        self.file_count = 0
+
+    def candidate(self, path):
+        """note a file that may be new, to be queued once it has settled"""
+        if path in self.pending or path in self.busy or path in self.retries:
+            return
+        name = os.path.basename(path)
+        if name.startswith(".") or not name.lower().endswith(
+            lalalai_splitter.AUDIO_EXTENSIONS
+        ):
+            return
+        preset = self.presets.get(os.path.dirname(path))
+        if preset is None:
+            return
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            self.failures.pop(path, None)
+            return
+        if not stat.S_ISREG(stat_result.st_mode):
+            return
+        key = self.ledger.key(path, stat_result)
+        if not self.ledger.is_handled(key):
+            self.pending[path] = (preset, key, time.monotonic())
+
+    def scan(self):
+        """note every file in the watched folders"""
+        for folder in self.presets:
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        self.candidate(entry.path)
+            except OSError as e:
+                lalalai_splitter.report("scan_failed", path=folder, message=str(e))
+
+    async def poll(self):
+        """rescan the folders every POLL_INTERVAL seconds"""
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            self.scan()
+
+    async def settle(self):
+        """
+        Queue each pending file once its size and modification time have
+        stayed the same for `settle_seconds`, so files still being
+        written aren't split half-done, and take back the failed files
+        that are due to be tried again.  While the queue is full, no more
+        are queued.
+        """
+        while True:
+            await asyncio.sleep(SETTLE_CHECK_INTERVAL)
+            now = time.monotonic()
+            for path, due in list(self.retries.items()):
+                if now >= due:
+                    del self.retries[path]
+                    self.candidate(path)
+            for path, (preset, key, since) in list(self.pending.items()):
+                try:
+                    current = self.ledger.key(path, os.stat(path))
+                except OSError:
+                    del self.pending[path]
+                    continue
+                if current != key:
+                    self.pending[path] = (preset, current, now)
+                    continue
+                if now - since < self.settle_seconds:
+                    continue
+                del self.pending[path]
+                if self.ledger.is_handled(key):
+                    continue
+                self.busy.add(path)
+                lalalai_splitter.report("file_settled", path=path)
+                await self.queue.put((path, preset, key))
+
+    async def work(self):
+        """split the files from the queue one after another"""
+        while True:
+            path, preset, key = await self.queue.get()
+            try:
+                await self.split(path, preset, key)
+            except Exception as e:
+                # the file isn't recorded, so it's tried again after a
+                # backoff, and the other files carry on
+                delay = self.retry_later(path)
+                lalalai_splitter.report(
+                    "file_failed", path=path, message=str(e), retry_seconds=delay
+                )
+            finally:
+                self.busy.discard(path)
+                self.queue.task_done()
+
+    def retry_later(self, path):
+        """
+        Puts a file that failed on the retry list, to be noticed again once
+        the backoff for its failures in a row is over.  Returns the backoff.
+        """
+        failures = self.failures[path] = self.failures.get(path, 0) + 1
+        delay = min(RETRY_MAX_SECONDS, RETRY_SECONDS * 2 ** (failures - 1))
+        self.retries[path] = time.monotonic() + delay
+        return delay
+
+    async def split(self, path, preset, key):
+        """split one file with its folder's preset and record the outcome"""
+        self.file_count += 1
+        os.makedirs(preset.output, exist_ok=True)
+        error = await lalalai_splitter.process_one_of_many(
+            self.file_count,
+            None,
+            self.api_key,
+            path,
+            preset.output,
+            preset.stems,
+            preset.backing_tracks,
+            preset.filter_type,
+            preset.splitter,
+            scheduler=self.scheduler,
+            **self.kwargs,
+        )
+        if error is None:
+            self.ledger.record(key, "done")
+        else:
+            self.ledger.record(key, "failed", str(error))
+        self.failures.pop(path, None)
+
+    async def run(self):
+        """
+        Watches the folders until cancelled.  A file being split when the
+        daemon stops isn't recorded, so it's split again on restart.
+        """
+        loop = asyncio.get_running_loop()
+        watcher = None
+        libc = load_inotify() if self.use_inotify else None
+        if libc is not None:
+            watcher = InotifyWatcher(
+                libc, list(self.presets), self.candidate, self.scan
+            )
+            try:
+                watcher.start(loop)
+            except OSError as e:
+                lalalai_splitter.report("inotify_failed", message=str(e))
+                watcher = None
+
+        lalalai_splitter.report(
+            "watching",
+            folders=len(self.presets),
+            method="polling" if watcher is None else "inotify",
+        )
+        self.scan()
+        tasks = [asyncio.create_task(self.settle())]
+        tasks.extend(asyncio.create_task(self.work()) for _ in range(self.workers))
+        if watcher is None:
+            tasks.append(asyncio.create_task(self.poll()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if watcher is not None:
+                watcher.close(loop)
+
+
+async def run_until_signalled(daemon):
+    """runs `daemon` until SIGINT or SIGTERM"""
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        # not available on Windows, where Ctrl-C still interrupts
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(signum, task.cancel)
+    try:
+        await daemon.run()
+    except asyncio.CancelledError:
+        lalalai_splitter.report("watch_stopped")
+
+
+def main():
+    """Command-line entry point."""
+    parser = ArgumentParser(
+        description="Split audio files with Lalal.ai as they land in folders"
+    )
+    parser.add_argument(
+        "--license",
+        default=os.environ.get("LALALAI_LICENSE"),
+        help="license key, or comma-separated keys to share the work among "
+        "(default: $LALALAI_LICENSE)",
+    )
+    parser.add_argument(
+        "--api-url",
+        default=lalalai_splitter.URL_API,
+        help="the API's base URL "
+        f"(default: $LALALAI_API_URL or {lalalai_splitter.URL_API})",
+    )
+    parser.add_argument(
+        "--config", metavar="FILE", help="JSON file of per-folder presets"
+    )
+    parser.add_argument(
+        "--folder",
+        action="append",
+        default=[],
+        help="a directory to watch with the options below; may be repeated",
+    )
+    parser.add_argument(
+        "--output", help="directory to save tracks to, for folders without one"
+    )
+    parser.add_argument(
+        "--stems", type=lalalai_splitter.parse_stem_list, help="comma-separated"
+    )
+    parser.add_argument(
+        "--backing-tracks", type=lalalai_splitter.parse_stem_list, help="likewise"
+    )
+    parser.add_argument("--filter", choices=FILTERS)
+    parser.add_argument("--splitter", choices=["phoenix", "cassiopeia"])
+    parser.add_argument(
+        "--ledger",
+        metavar="DB_FILE",
+        default=DEFAULT_LEDGER,
+        help=f"SQLite file of the files handled (default: {DEFAULT_LEDGER})",
+    )
+    parser.add_argument(
+        "--settle-seconds",
+        type=float,
+        default=SETTLE_SECONDS,
+        help="how long a file must stay unchanged before it's split",
+    )
+    parser.add_argument(
+        "--poll", action="store_true", help="poll the folders instead of inotify"
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=WORK_QUEUE_SIZE,
+        help="settled files that may wait for a worker",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="files split at once (default: uploads plus splits in flight)",
+    )
+    parser.add_argument(
+        "--max-concurrent-uploads",
+        type=int,
+        default=lalalai_splitter.DEFAULT_MAX_CONCURRENT_UPLOADS,
+    )
+    parser.add_argument(
+        "--max-upload-rate",
+        type=float,
+        metavar="BYTES_PER_SECOND",
+        help="cap on the combined upload rate",
+    )
+    parser.add_argument(
+        "--max-concurrent-splits",
+        type=int,
+        default=lalalai_splitter.DEFAULT_MAX_CONCURRENT_SPLITS,
+    )
+    parser.add_argument(
+        "--max-concurrent-downloads",
+        type=int,
+        default=lalalai_splitter.DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+    )
+    parser.add_argument(
+        "--upload-cache", metavar="DB_FILE", help="SQLite file to cache uploads in"
+    )
+    parser.add_argument(
+        "--trim-silence",
+        action="store_true",
+        help="as for lalalai_splitter",
+    )
+    parser.add_argument(
+        "--compress-uploads",
+        action="store_true",
+        help="as for lalalai_splitter",
+    )
+    parser.add_argument(
+        "--segment-minutes",
+        type=float,
+        metavar="MINUTES",
+        help="as for lalalai_splitter",
+    )
+    parser.add_argument(
+        "--progress",
+        choices=["json", "text"],
+        default="json",
+        help="progress format: JSON lines, or UnMixer's %%-prefixed lines",
+    )
+    args = parser.parse_args()
+
+    lalalai_splitter.URL_API = args.api_url
+    if args.progress == "json":
+        lalalai_splitter.progress_handler = lalalai_splitter.print_progress_json
+
+    if not args.license:
+        parser.error("a license key is required (--license or $LALALAI_LICENSE)")
+    if not args.config and not args.folder:
+        parser.error("at least one of --config or --folder is required")
+
+    defaults = {
+        name: value
+        for name, value in (
+            ("output", args.output),
+            ("stems", args.stems),
+            ("backing_tracks", args.backing_tracks),
+            ("filter", args.filter),
+            ("splitter", args.splitter),
+        )
+        if value is not None
+    }
+    try:
+        presets = load_presets(args.config, defaults) if args.config else []
+        for folder in args.folder:
+            presets.append(FolderPreset.from_config({"path": folder}, defaults))
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(f"bad folder preset: {e}")
+
+    licenses = [key.strip() for key in args.license.split(",") if key.strip()]
+    if len(licenses) == 1:
+        license = licenses[0]
+    else:
+        license = lalalai_splitter.LicensePool(licenses)
+    upload_cache = (
+        lalalai_splitter.UploadCache(args.upload_cache) if args.upload_cache else None
+    )
+    scheduler = lalalai_splitter.Scheduler(
+        max_concurrent_uploads=args.max_concurrent_uploads,
+        max_concurrent_splits=args.max_concurrent_splits,
+        max_concurrent_downloads=args.max_concurrent_downloads,
+        max_upload_rate=args.max_upload_rate,
+    )
+    workers = args.workers or args.max_concurrent_uploads + args.max_concurrent_splits
+
+    daemon = WatchDaemon(
+        license,
+        presets,
+        WatchLedger(args.ledger),
+        workers,
+        scheduler,
+        use_inotify=not args.poll,
+        settle_seconds=args.settle_seconds,
+        queue_size=args.queue_size,
+        upload_cache=upload_cache,
+        trim_silence=args.trim_silence,
+        compress_uploads=args.compress_uploads,
+        segment_seconds=args.segment_minutes and args.segment_minutes * 60,
+    )
+    asyncio.run(run_until_signalled(daemon))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
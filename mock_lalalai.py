@@ -0,0 +1,440 @@
+"""
+A stand-in for the Lalal.ai API, for running and measuring
+lalalai_splitter without a network or a license.  It implements
+upload/, split/ and check/, the billing limits, and downloads of the
+"split" tracks, which are just the uploaded file sent back.
+
+The server's behavior can be tuned: how long splits wait in the queue
+and take to process, the shape of their progress, how often requests
+fail, and how fast tracks download.  It counts the requests and bytes
+it handles, for benchmarks.
+
+Usage:
+    python3 mock_lalalai.py --port 8765 --split-time 5 --error-rate 0.1
+    LALALAI_API_URL=http://127.0.0.1:8765/api/ python3 -m lalalai_splitter ...
+"""
+
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# how long a split waits at 0% and then takes to process, by default
+DEFAULT_QUEUE_DELAY = 1.0
+DEFAULT_SPLIT_TIME = 3.0
+
+# minutes a license starts out with, and what each split costs
+DEFAULT_MINUTES = 1000.0
+MINUTES_PER_SPLIT = 1.0
+
+# the block size downloads are written in, and so throttled by
+DOWNLOAD_BLOCK_SIZE = 64 * 1024
+
+
+def progress_curve(name, fraction):
+    """
+    Maps how far through its processing time a split is (0 to 1) to the
+    percentage it reports, according to the curve `name`: "linear",
+    "ease" (slow at both ends), or "stall" (stuck at 50% for a while).
+    """
+    if name == "ease":
+        fraction = fraction * fraction * (3 - 2 * fraction)
+    elif name == "stall":
+        if fraction < 0.25:
+            fraction = fraction * 2
+        elif fraction < 0.75:
+            fraction = 0.5
+        else:
+            fraction = 0.5 + (fraction - 0.75) * 2
+    return min(99, int(100 * fraction))
+
+
+def parse_minutes(value):
+    """parses a comma-separated list of KEY=MINUTES pairs into a dict"""
+    minutes = {}
+    for item in value.split(","):
+        if item:
+            license, _, amount = item.partition("=")
+            minutes[license] = float(amount)
+    return minutes
+
+
+class MockLalalai:
+    """
+    The state of the stand-in API, the settings it runs with, and its
+    statistics.  `error_rate` is the chance that an API request fails
+    with `error_status` (and a `Retry-After` of `retry_after` seconds),
+    `fail_stems` are stems whose splits are refused, and
+    `download_rate` caps each download's bytes per second.  `minutes`
+    maps license keys to their starting minutes.
+    """
+
+    def __init__(
+        self,
+        queue_delay=DEFAULT_QUEUE_DELAY,
+        split_time=DEFAULT_SPLIT_TIME,
+        curve="linear",
+        error_rate=0.0,
+        error_status=503,
+        retry_after=1,
+        fail_stems=(),
+        download_rate=None,
+        minutes=None,
+    ):
+        self.queue_delay = queue_delay
+        self.split_time = split_time
+        self.curve = curve
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.fail_stems = set(fail_stems)
+        self.download_rate = download_rate
+        self.minutes = dict(minutes or {})
+        self.lock = threading.Lock()
+        self.files = {}
+        self.tasks = {}
+        self.latest_task = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        """zero the request and byte counts"""
+        with self.lock:
+            self.stats = {"requests": {}, "errors": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def count(self, endpoint, bytes_in=0, bytes_out=0):
+        """count a request to `endpoint` and the bytes it moved"""
+        with self.lock:
+            requests = self.stats["requests"]
+            requests[endpoint] = requests.get(endpoint, 0) + 1
+            self.stats["bytes_in"] += bytes_in
+            self.stats["bytes_out"] += bytes_out
+
+    def inject_error(self):
+        """decide whether this request fails, counting it if so"""
+        if self.error_rate and random.random() < self.error_rate:
+            with self.lock:
+                self.stats["errors"] += 1
+            return True
+        return False
+
+    def upload(self, filename, data):
+        """store an uploaded file and return its ID"""
+        file_id = uuid.uuid4().hex[:16]
+        with self.lock:
+            self.files[file_id] = (filename, data)
+        return file_id
+
+    def split(self, license, file_id, stem):
+        """start a split and return the API's reply"""
+        with self.lock:
+            if file_id not in self.files:
+                return {"status": "error", "error": "File not found"}
+            if stem in self.fail_stems:
+                return {"status": "error", "error": f"Can't split {stem}"}
+            minutes = self.minutes.get(license, DEFAULT_MINUTES)
+            if minutes < MINUTES_PER_SPLIT:
+                return {"status": "error", "error": "Not enough minutes left"}
+            self.minutes[license] = minutes - MINUTES_PER_SPLIT
+            task_id = uuid.uuid4().hex[:16]
+            self.tasks[task_id] = (file_id, stem, time.monotonic())
+            self.latest_task[file_id] = task_id
+        return {"status": "success", "task_id": task_id}
+
+    def check(self, check_id, base_url):
+        """return the state of the split identified by `check_id`"""
+        with self.lock:
+            task_id = check_id if check_id in self.tasks else None
+            task_id = task_id or self.latest_task.get(check_id)
+            if task_id is None:
+                if check_id in self.files:
+                    return {"status": "success", "split": None, "task": None}
+                return {"status": "error", "error": "File not found"}
+            file_id, stem, started = self.tasks[task_id]
+
+        elapsed = time.monotonic() - started
+        split = {
+            "stem": stem,
+            "stem_track": f"{base_url}media/{task_id}/stem",
+            "back_track": f"{base_url}media/{task_id}/back",
+        }
+        if elapsed < self.queue_delay:
+            task = {"state": "progress", "progress": 0}
+        elif elapsed < self.queue_delay + self.split_time:
+            fraction = (elapsed - self.queue_delay) / self.split_time
+            progress = max(1, progress_curve(self.curve, fraction))
+            task = {"state": "progress", "progress": progress}
+        else:
+            task = {"state": "success"}
+        return {"status": "success", "split": split, "task": task}
+
+    def track(self, task_id, kind):
+        """return the file name and contents of a split's track"""
+        with self.lock:
+            file_id, stem, _ = self.tasks[task_id]
+            filename, data = self.files[file_id]
+        base, ext = os.path.splitext(filename)
+        if kind == "stem":
+            return f"{base}_{stem}{ext}", data
+        return f"{base}_no_{stem}{ext}", data
+
+    def limits(self, license):
+        """return the billing API's reply for `license`"""
+        with self.lock:
+            minutes = self.minutes.get(license, DEFAULT_MINUTES)
+        return {"status": "success", "process_duration_left": minutes}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Serves the requests of a `MockServer`, on keep-alive connections."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def api(self):
+        return self.server.api
+
+    def base_url(self):
+        return f"http://{self.headers.get('Host')}/"
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def send_injected_error(self):
+        body = b"Service unavailable"
+        self.send_response(self.api.error_status)
+        self.send_header("Retry-After", str(self.api.retry_after))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            chunks = []
+            while size := int(self.rfile.readline().strip(), 16):
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            self.rfile.readline()
+            return b"".join(chunks)
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def license(self):
+        authorization = self.headers.get("Authorization") or ""
+        return authorization.partition(" ")[2]
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = self.read_body()
+        endpoint = path.rstrip("/").rsplit("/", 1)[-1]
+        if self.api.inject_error():
+            self.api.count(endpoint, bytes_in=len(body))
+            self.send_injected_error()
+            return
+
+        if endpoint == "upload":
+            disposition = self.headers.get("Content-Disposition") or ""
+            filename = "upload.wav"
+            if "filename*=utf-8''" in disposition:
+                filename = unquote(disposition.split("filename*=utf-8''")[1])
+            elif 'filename="' in disposition:
+                filename = disposition.split('filename="')[1].split('"')[0]
+            file_id = self.api.upload(os.path.basename(filename), body)
+            reply = {"status": "success", "id": file_id}
+        elif endpoint == "split":
+            query = parse_qs(body.decode("utf-8"))
+            reply = self.api.split(
+                self.license(), query["id"][0], query.get("stem", ["vocals"])[0]
+            )
+        else:
+            reply = {"status": "error", "error": f"Unknown endpoint {path}"}
+        sent = self.send_json(reply)
+        self.api.count(endpoint, bytes_in=len(body), bytes_out=sent)
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        if parts.path.startswith("/media/"):
+            self.send_track(*parts.path.split("/")[2:4])
+            return
+        if parts.path == "/mock/stats":
+            with self.api.lock:
+                self.send_json(self.api.stats)
+            return
+
+        endpoint = parts.path.rstrip("/").rsplit("/", 1)[-1]
+        if self.api.inject_error():
+            self.api.count(endpoint)
+            self.send_injected_error()
+            return
+        if endpoint == "check":
+            ids = query["id"][0].split(",")
+            results = {i: self.api.check(i, self.base_url()) for i in ids}
+            sent = self.send_json({"status": "success", "result": results})
+        elif endpoint == "get-limits":
+            sent = self.send_json(self.api.limits(query["key"][0]))
+        else:
+            sent = self.send_json({"status": "error", "error": "Not found"}, 404)
+        self.api.count(endpoint, bytes_out=sent)
+
+    def do_HEAD(self):
+        parts = urlsplit(self.path)
+        if parts.path.startswith("/media/"):
+            self.send_track(*parts.path.split("/")[2:4], head=True)
+            return
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_track(self, task_id, kind, head=False):
+        try:
+            filename, data = self.api.track(task_id, kind)
+        except KeyError:
+            self.send_json({"status": "error", "error": "Not found"}, 404)
+            return
+
+        start = 0
+        byte_range = self.headers.get("Range")
+        if byte_range:
+            start = int(byte_range.split("=")[1].split("-")[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        if head:
+            return
+
+        view = memoryview(data)[start:]
+        began = time.monotonic()
+        for offset in range(0, len(view), DOWNLOAD_BLOCK_SIZE):
+            self.wfile.write(view[offset : offset + DOWNLOAD_BLOCK_SIZE])
+            if self.api.download_rate:
+                # hold back to keep to the rate from the start of the download
+                due = began + (offset + DOWNLOAD_BLOCK_SIZE) / self.api.download_rate
+                time.sleep(max(0, due - time.monotonic()))
+        self.api.count("media", bytes_out=len(view))
+
+
+class MockServer(ThreadingHTTPServer):
+    """An HTTP server for a `MockLalalai`."""
+
+    daemon_threads = True
+
+    def __init__(self, address, api):
+        super().__init__(address, MockHandler)
+        self.api = api
+
+    @property
+    def url_api(self):
+        """the base URL to use as lalalai_splitter's URL_API"""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/"
+
+
+def start_mock_server(port=0, host="127.0.0.1", **settings):
+    """
+    Starts a `MockServer` on a background thread, on `port` (0 picks a
+    free one), and returns it.  `settings` are passed to `MockLalalai`.
+    """
+    server = MockServer((host, port), MockLalalai(**settings))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = ArgumentParser(description="Stand-in Lalal.ai API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--queue-delay",
+        type=float,
+        default=DEFAULT_QUEUE_DELAY,
+        help="seconds each split waits at 0%%",
+    )
+    parser.add_argument(
+        "--split-time",
+        type=float,
+        default=DEFAULT_SPLIT_TIME,
+        help="seconds each split takes to process",
+    )
+    parser.add_argument(
+        "--curve", choices=["linear", "ease", "stall"], default="linear"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="chance that an API request fails",
+    )
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument(
+        "--retry-after",
+        type=int,
+        default=1,
+        help="seconds of Retry-After to send with failed requests",
+    )
+    parser.add_argument(
+        "--minutes",
+        type=parse_minutes,
+        default={},
+        metavar="KEY=MINUTES,...",
+        help=f"minutes each license starts with (others get {DEFAULT_MINUTES:g}); "
+        f"a split costs {MINUTES_PER_SPLIT:g}",
+    )
+    parser.add_argument(
+        "--fail-stems", default="", help="comma-separated stems to refuse"
+    )
+    parser.add_argument(
+        "--download-rate",
+        type=float,
+        metavar="BYTES_PER_SECOND",
+        help="cap on each download's rate",
+    )
+    args = parser.parse_args()
+
+    server = MockServer(
+        (args.host, args.port),
+        MockLalalai(
+            queue_delay=args.queue_delay,
+            split_time=args.split_time,
+            curve=args.curve,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            retry_after=args.retry_after,
+            fail_stems=[stem for stem in args.fail_stems.split(",") if stem],
+            download_rate=args.download_rate,
+            minutes=args.minutes,
+        ),
+    )
+    print(f"serving the Lalal.ai API at {server.url_api}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
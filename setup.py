@@ -8,7 +8,7 @@ Usage:
 from setuptools import setup
 
 APP = ["UnMixer.py"]
-DATA_FILES = ["unmix.py", "lalalai_splitter.py"]
+DATA_FILES = ["unmix.py", "lalalai_splitter.py", "lalalai_audio.py"]
 OPTIONS = {
     "iconfile": "support/unmixer.icns",
     "packages": ['tkinter'],
@@ -0,0 +1,387 @@
+"""
+Tests of lalalai_audio's stem alignment and subtraction, its trimming
+of silence, dividing an input into segments and stitching their tracks
+back together, and its FLAC encoding.  The ones that read and write audio
+need NumPy, and the FLAC round trip needs flac or ffmpeg; they're
+skipped without them.
+
+Run with `python -m pytest` or `python -m unittest`.
+"""
+
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import wave
+from unittest import mock
+
+import lalalai_audio
+from lalalai_audio import np
+
+RATE = 44100
+
+
+def write_wav(path, samples, sample_width=2, rate=RATE):
+    """writes an int array of shape (frames, channels) as a WAV file"""
+    dtype = {1: np.uint8, 2: "<i2", 4: "<i4"}[sample_width]
+    with wave.open(path, "wb") as writer:
+        writer.setnchannels(samples.shape[1])
+        writer.setsampwidth(sample_width)
+        writer.setframerate(rate)
+        writer.writeframes(samples.astype(dtype).tobytes())
+
+
+def read_wav(path):
+    """reads a 16-bit WAV file as an int array of shape (frames, channels)"""
+    with wave.open(path, "rb") as reader:
+        data = reader.readframes(reader.getnframes())
+        return np.frombuffer(data, dtype="<i2").reshape(-1, reader.getnchannels())
+
+
+@unittest.skipUnless(lalalai_audio.numpy_available(), "needs NumPy")
+class AudioTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.rng = np.random.default_rng(1)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def noise(self, frames, channels=2, amplitude=8000):
+        return self.rng.integers(-amplitude, amplitude, size=(frames, channels))
+
+
+class EstimateLagTest(AudioTestCase):
+    def setUp(self):
+        super().setUp()
+        self.original = self.noise(RATE)
+        write_wav(self.path("original.wav"), self.original)
+
+    def lag_of(self, stem):
+        write_wav(self.path("stem.wav"), stem)
+        return lalalai_audio.estimate_lag(
+            self.path("original.wav"), self.path("stem.wav")
+        )
+
+    def test_aligned(self):
+        self.assertEqual(self.lag_of(self.original // 2), 0)
+
+    def test_stem_starts_late(self):
+        stem = np.concatenate([np.zeros((300, 2), dtype=int), self.original])
+        self.assertEqual(self.lag_of(stem), 300)
+
+    def test_stem_starts_early(self):
+        self.assertEqual(self.lag_of(self.original[120:]), -120)
+
+    def test_silent_stem(self):
+        self.assertEqual(self.lag_of(np.zeros_like(self.original)), 0)
+
+
+class SubtractStemTest(AudioTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vocals = self.noise(RATE)
+        self.backing = self.noise(RATE)
+        write_wav(self.path("original.wav"), self.vocals + self.backing)
+
+    def subtract(self, stem):
+        write_wav(self.path("stem.wav"), stem)
+        return lalalai_audio.subtract_stem(
+            self.path("original.wav"), self.path("stem.wav"), self.path("back.wav")
+        )
+
+    def test_exact_subtraction(self):
+        self.assertTrue(self.subtract(self.vocals))
+        np.testing.assert_array_equal(read_wav(self.path("back.wav")), self.backing)
+
+    def test_late_stem_is_lined_up(self):
+        stem = np.concatenate([np.zeros((250, 2), dtype=int), self.vocals])
+        self.assertTrue(self.subtract(stem))
+        np.testing.assert_array_equal(read_wav(self.path("back.wav")), self.backing)
+
+    def test_early_stem_is_lined_up(self):
+        # the frames the stem is missing at the start are left alone
+        self.assertTrue(self.subtract(self.vocals[80:]))
+        back = read_wav(self.path("back.wav"))
+        np.testing.assert_array_equal(back[80:], self.backing[80:])
+        np.testing.assert_array_equal(back[:80], (self.vocals + self.backing)[:80])
+
+    def test_unrelated_stem_fails_check(self):
+        self.assertFalse(self.subtract(self.noise(RATE, amplitude=16000)))
+        self.assertFalse(os.path.exists(self.path("back.wav")))
+
+    def test_different_format(self):
+        write_wav(self.path("stem.wav"), self.vocals[:, :1])
+        made = lalalai_audio.subtract_stem(
+            self.path("original.wav"), self.path("stem.wav"), self.path("back.wav")
+        )
+        self.assertFalse(made)
+
+    def test_not_wav(self):
+        with open(self.path("stem.flac"), "wb") as f:
+            f.write(b"fLaC")
+        made = lalalai_audio.subtract_stem(
+            self.path("original.wav"), self.path("stem.flac"), self.path("back.wav")
+        )
+        self.assertFalse(made)
+
+
+class TrimSilenceTest(AudioTestCase):
+    def setUp(self):
+        super().setUp()
+        self.audible = self.noise(RATE // 2)
+        silence = np.zeros((RATE, 2), dtype=int)
+        self.original = np.concatenate([silence, self.audible, silence])
+        write_wav(self.path("original.wav"), self.original)
+
+    def test_measure_silence(self):
+        trim = lalalai_audio.measure_silence(self.path("original.wav"))
+        margin = int(lalalai_audio.SILENCE_MARGIN_SECONDS * RATE)
+        self.assertEqual(trim.lead_frames, RATE - margin)
+        self.assertEqual(trim.kept_frames, RATE // 2 + 2 * margin)
+        self.assertEqual(trim.total_frames, len(self.original))
+        self.assertEqual(trim.bytes_saved, trim.trimmed_frames * 4)
+        self.assertAlmostEqual(trim.seconds_saved, 2 - 2 * margin / RATE)
+
+    def test_too_little_silence(self):
+        write_wav(self.path("short.wav"), self.original[RATE // 2 : -RATE // 2])
+        self.assertIsNone(lalalai_audio.measure_silence(self.path("short.wav")))
+
+    def test_all_silent(self):
+        write_wav(self.path("silent.wav"), np.zeros((RATE, 2), dtype=int))
+        self.assertIsNone(lalalai_audio.measure_silence(self.path("silent.wav")))
+
+    def test_round_trip(self):
+        trim = lalalai_audio.measure_silence(self.path("original.wav"))
+        lalalai_audio.write_trimmed(self.path("original.wav"), trim, self.path("t.wav"))
+        trimmed = read_wav(self.path("t.wav"))
+        self.assertEqual(len(trimmed), trim.kept_frames)
+
+        self.assertTrue(lalalai_audio.restore_silence(self.path("t.wav"), trim))
+        np.testing.assert_array_equal(read_wav(self.path("t.wav")), self.original)
+
+    def test_restore_pads_short_tracks(self):
+        trim = lalalai_audio.measure_silence(self.path("original.wav"))
+        write_wav(self.path("track.wav"), self.audible[:100])
+        self.assertTrue(lalalai_audio.restore_silence(self.path("track.wav"), trim))
+        track = read_wav(self.path("track.wav"))
+        self.assertEqual(len(track), len(self.original))
+        np.testing.assert_array_equal(
+            track[trim.lead_frames : trim.lead_frames + 100], self.audible[:100]
+        )
+        self.assertFalse(track[trim.lead_frames + 100 :].any())
+
+    def test_restore_8_bit(self):
+        write_wav(self.path("quiet.wav"), np.full((RATE * 3, 1), 128), 1)
+        trim = lalalai_audio.SilenceTrim(RATE, RATE, RATE * 3, RATE, 1)
+        write_wav(self.path("track.wav"), np.full((RATE, 1), 200), 1)
+        self.assertTrue(lalalai_audio.restore_silence(self.path("track.wav"), trim))
+        with wave.open(self.path("track.wav"), "rb") as reader:
+            data = reader.readframes(reader.getnframes())
+        self.assertEqual(data, b"\x80" * RATE + b"\xc8" * RATE + b"\x80" * RATE)
+
+    def test_restore_leaves_other_rates_alone(self):
+        trim = lalalai_audio.measure_silence(self.path("original.wav"))
+        write_wav(self.path("track.wav"), self.audible, rate=48000)
+        self.assertFalse(lalalai_audio.restore_silence(self.path("track.wav"), trim))
+        self.assertEqual(len(read_wav(self.path("track.wav"))), len(self.audible))
+
+
+class PlanSegmentsTest(unittest.TestCase):
+    def check_plan(self, total, segment, overlap):
+        segments = lalalai_audio.plan_segments(total, segment, overlap)
+        self.assertEqual(segments[0][0], 0)
+        self.assertEqual(sum(segments[-1]), total)
+        for start, nframes in segments:
+            self.assertLessEqual(nframes, segment)
+        for (start, nframes), (next_start, _) in zip(segments, segments[1:]):
+            self.assertEqual(start + nframes - next_start, overlap)
+        return segments
+
+    def test_short_input_is_one_segment(self):
+        self.assertEqual(self.check_plan(1000, 5000, 100), [(0, 1000)])
+
+    def test_exact_fit(self):
+        self.assertEqual(
+            self.check_plan(2900, 1000, 50),
+            [(0, 1000), (950, 1000), (1900, 1000)],
+        )
+
+    def test_segments_are_even(self):
+        segments = self.check_plan(10_001, 3000, 200)
+        lengths = [nframes for _, nframes in segments]
+        self.assertLessEqual(max(lengths) - min(lengths), len(segments))
+
+    def test_many_shapes(self):
+        for total in (1, 999, 1000, 1001, 123_457):
+            for segment, overlap in ((1000, 0), (1000, 10), (4096, 1024)):
+                with self.subTest(total=total, segment=segment, overlap=overlap):
+                    if total > segment:
+                        self.check_plan(total, segment, overlap)
+                    else:
+                        self.assertEqual(
+                            lalalai_audio.plan_segments(total, segment, overlap),
+                            [(0, total)],
+                        )
+
+
+class StitchSegmentsTest(AudioTestCase):
+    def split_and_stitch(self, total, segment, overlap, sample_width=2):
+        original = self.noise(total, amplitude=100) + (128 if sample_width == 1 else 0)
+        write_wav(self.path("original.wav"), original, sample_width)
+        segments = lalalai_audio.plan_segments(total, segment, overlap)
+        paths = []
+        for i, (start, nframes) in enumerate(segments):
+            path = self.path(f"segment{i}.wav")
+            lalalai_audio.write_frames(self.path("original.wav"), start, nframes, path)
+            paths.append(path)
+        stitched = self.path("stitched.wav")
+        self.assertTrue(lalalai_audio.stitch_segments(paths, segments, stitched))
+        return segments, stitched
+
+    def assert_same_wav(self, first, second):
+        with wave.open(first, "rb") as a, wave.open(second, "rb") as b:
+            self.assertEqual(a.getparams(), b.getparams())
+            self.assertEqual(a.readframes(a.getnframes()), b.readframes(b.getnframes()))
+
+    def test_bit_exact(self):
+        # crossfading a track into itself changes nothing, so the segments
+        # of the input itself stitch back into the input, bit for bit
+        for total, segment, overlap in (
+            (100_000, 30_000, 2_000),
+            (70_000, 65_536, 4_096),
+            (200_001, 50_000, 1),
+        ):
+            with self.subTest(total=total, segment=segment, overlap=overlap):
+                segments, stitched = self.split_and_stitch(total, segment, overlap)
+                self.assertGreater(len(segments), 1)
+                self.assert_same_wav(self.path("original.wav"), stitched)
+
+    def test_bit_exact_8_bit(self):
+        _, stitched = self.split_and_stitch(50_000, 20_000, 1_000, sample_width=1)
+        self.assert_same_wav(self.path("original.wav"), stitched)
+
+    def test_single_segment(self):
+        _, stitched = self.split_and_stitch(1_000, 5_000, 100)
+        self.assert_same_wav(self.path("original.wav"), stitched)
+
+    def test_crossfade(self):
+        tail = np.ones((5, 1))
+        head = np.zeros((5, 1))
+        faded = lalalai_audio.crossfade(tail, head)[:, 0]
+        self.assertEqual(faded[0], 1)
+        self.assertEqual(faded[-1], 0)
+        self.assertTrue(np.all(np.diff(faded) < 0))
+
+    def test_mismatched_tracks(self):
+        write_wav(self.path("a.wav"), self.noise(1000))
+        write_wav(self.path("b.wav"), self.noise(1000), rate=48000)
+        stitched = self.path("stitched.wav")
+        made = lalalai_audio.stitch_segments(
+            [self.path("a.wav"), self.path("b.wav")], [(0, 600), (500, 500)], stitched
+        )
+        self.assertFalse(made)
+        self.assertFalse(os.path.exists(stitched))
+
+
+def write_aiff(path, sample_width, form_type=b"AIFF"):
+    """writes the header of an AIFF file, with a chunk before the COMM one"""
+    comm = struct.pack(">HIH", 2, 0, sample_width * 8) + bytes(10)
+    chunks = b"FVER" + struct.pack(">I", 3) + b"abc\0"
+    chunks += b"COMM" + struct.pack(">I", len(comm)) + comm
+    with open(path, "wb") as f:
+        f.write(b"FORM" + struct.pack(">I", 4 + len(chunks)) + form_type + chunks)
+
+
+class PcmSampleWidthTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def test_wav(self):
+        for sample_width in (1, 2, 3, 4):
+            with wave.open(self.path("a.wav"), "wb") as writer:
+                writer.setnchannels(2)
+                writer.setsampwidth(sample_width)
+                writer.setframerate(RATE)
+            self.assertEqual(
+                lalalai_audio.pcm_sample_width(self.path("a.wav")), sample_width
+            )
+
+    def test_aiff(self):
+        write_aiff(self.path("a.aiff"), 3)
+        self.assertEqual(lalalai_audio.pcm_sample_width(self.path("a.aiff")), 3)
+
+    def test_compressed_aiff(self):
+        write_aiff(self.path("a.aifc"), 2, b"AIFC")
+        self.assertIsNone(lalalai_audio.pcm_sample_width(self.path("a.aifc")))
+
+    def test_other_files(self):
+        with open(self.path("a.mp3"), "wb") as f:
+            f.write(b"ID3\x04" + bytes(100))
+        self.assertIsNone(lalalai_audio.pcm_sample_width(self.path("a.mp3")))
+        with open(self.path("short"), "wb") as f:
+            f.write(b"FORM")
+        self.assertIsNone(lalalai_audio.pcm_sample_width(self.path("short")))
+
+
+class RunCodecTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.output_path = os.path.join(tmp.name, "out.flac")
+
+    def run_python(self, code, cancel=None):
+        script = f"open({self.output_path!r}, 'w').write('part'); {code}"
+        lalalai_audio.run_codec(
+            [sys.executable, "-c", script], self.output_path, cancel
+        )
+
+    def test_success(self):
+        self.run_python("pass")
+        self.assertTrue(os.path.exists(self.output_path))
+
+    def test_failure(self):
+        code = "import sys; sys.stderr.write('warning\\nbad input\\n'); sys.exit(1)"
+        with self.assertRaisesRegex(RuntimeError, "failed: bad input$"):
+            self.run_python(code)
+        self.assertFalse(os.path.exists(self.output_path))
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        cancel.set()
+        start = time.monotonic()
+        with self.assertRaisesRegex(RuntimeError, "cancelled"):
+            self.run_python("import time; time.sleep(30)", cancel)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertFalse(os.path.exists(self.output_path))
+
+    def test_no_encoder(self):
+        with mock.patch.object(lalalai_audio, "flac_encoder", return_value=None):
+            with self.assertRaisesRegex(RuntimeError, "installed"):
+                lalalai_audio.encode_flac("a.wav", self.output_path)
+            with self.assertRaisesRegex(RuntimeError, "installed"):
+                lalalai_audio.decode_flac(self.output_path, "a.wav", 2)
+
+
+@unittest.skipUnless(lalalai_audio.flac_encoder(), "needs flac or ffmpeg")
+class FlacTest(AudioTestCase):
+    def test_round_trip(self):
+        original = self.noise(RATE) * 2
+        write_wav(self.path("original.wav"), original, 2)
+        lalalai_audio.encode_flac(self.path("original.wav"), self.path("a.flac"))
+        lalalai_audio.decode_flac(self.path("a.flac"), self.path("back.wav"), 2)
+        np.testing.assert_array_equal(read_wav(self.path("back.wav")), original)
+
+
+if __name__ == "__main__":
+    unittest.main()
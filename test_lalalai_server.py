@@ -0,0 +1,341 @@
+"""
+Tests of lalalai_server: the order its FairQueue hands runs out in, the
+routing of progress events to jobs, and jobs submitted, followed,
+fetched and cancelled over HTTP against the mock API.
+
+Run with `python -m pytest` or `python -m unittest`.
+"""
+
+import asyncio
+import http.client
+import json
+import tempfile
+import time
+import unittest
+from unittest import mock
+from urllib.parse import quote
+
+import lalalai_splitter
+import mock_lalalai
+from lalalai_server import FairQueue, Job, JobService, Run, start_job_server
+
+
+class FairQueueTest(unittest.TestCase):
+    def drain(self, queue, count):
+        async def get_all():
+            return [await queue.get() for _ in range(count)]
+
+        return asyncio.run(get_all())
+
+    def test_clients_take_turns(self):
+        queue = FairQueue()
+        for item in ("a0", "a1", "a2"):
+            queue.put("alice", item)
+        queue.put("bob", "b0")
+        queue.put("bob", "b1")
+        self.assertEqual(self.drain(queue, 5), ["a0", "b0", "a1", "b1", "a2"])
+        self.assertEqual(queue.queues, {})
+
+    def test_new_client_goes_first(self):
+        queue = FairQueue()
+        for item in ("a0", "a1", "a2"):
+            queue.put("alice", item)
+        self.assertEqual(self.drain(queue, 1), ["a0"])
+        queue.put("bob", "b0")
+        self.assertEqual(self.drain(queue, 3), ["b0", "a1", "a2"])
+
+    def test_least_recently_served_goes_first(self):
+        queue = FairQueue()
+        queue.put("alice", "a0")
+        queue.put("bob", "b0")
+        self.assertEqual(self.drain(queue, 2), ["a0", "b0"])
+        # bob was served last, so alice goes ahead however they're queued
+        queue.put("bob", "b1")
+        queue.put("alice", "a1")
+        self.assertEqual(self.drain(queue, 2), ["a1", "b1"])
+
+    def test_remove(self):
+        queue = FairQueue()
+        queue.put("alice", "a0")
+        queue.put("alice", "a1")
+        queue.put("bob", "b0")
+        queue.remove("alice", "a0")
+        queue.remove("bob", "b0")
+        queue.remove("bob", "missing")
+        self.assertNotIn("bob", queue.queues)
+        self.assertEqual(self.drain(queue, 1), ["a1"])
+
+    def test_get_waits_for_put(self):
+        queue = FairQueue()
+
+        async def put_later():
+            getter = asyncio.ensure_future(queue.get())
+            await asyncio.sleep(0.01)
+            self.assertFalse(getter.done())
+            queue.put("alice", "a0")
+            return await asyncio.wait_for(getter, 1)
+
+        self.assertEqual(asyncio.run(put_later()), "a0")
+
+
+class RouteEventTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.service = JobService("key", tmp.name, 1, {})
+        self.addCleanup(self.service.loop.close)
+        self.run = Run(1, ("digest", 1, "phoenix"), "alice", "in.wav", tmp.name)
+        self.vocals = Job("alice", "song.wav", ["vocals"], [])
+        self.drums = Job("bob", "song.wav", [], ["drum"])
+        self.run.jobs = [self.vocals, self.drums]
+        self.service.runs[1] = self.run
+
+    def route(self, name, **fields):
+        self.service.route_event(lalalai_splitter.ProgressEvent(name, fields))
+
+    def test_events_go_to_the_jobs_of_their_run(self):
+        self.route("uploaded", file_index=1, file_id="abc", path="/srv/in.wav")
+        self.route("uploaded", file_index=2, file_id="def")
+        self.route("batch_complete")
+        for job in (self.vocals, self.drums):
+            self.assertEqual(job.event_count, 1)
+            record = job.events[0]
+            # the server's own paths and file indexes aren't passed on
+            self.assertEqual(set(record), {"event", "time", "file_id"})
+            self.assertEqual(record["file_id"], "abc")
+
+    def test_stem_events_go_to_the_jobs_that_want_them(self):
+        self.route("split_progress", file_index=1, stem="vocals", percent=50)
+        self.route("split_progress", file_index=1, stem="drum", percent=20)
+        self.route("split_progress", file_index=1, stem="bass", percent=10)
+        self.assertEqual([e["stem"] for e in self.vocals.events], ["vocals"])
+        self.assertEqual([e["stem"] for e in self.drums.events], ["drum"])
+
+    def test_events_since(self):
+        with mock.patch("lalalai_server.JOB_MAX_EVENTS", 3):
+            job = Job("alice", "song.wav", ["vocals"], [])
+        for n in range(5):
+            job.add_event({"n": n})
+        self.assertEqual(job.events_since(0), [{"n": 2}, {"n": 3}, {"n": 4}])
+        self.assertEqual(job.events_since(4), [{"n": 4}])
+        self.assertEqual(job.events_since(5), [])
+
+
+class JobServerTestCase(unittest.TestCase):
+    """
+    Starts a mock API server and a job server with `workers` workers that
+    splits with it, for each test.
+    """
+
+    mock_settings = {"queue_delay": 0, "split_time": 0.5}
+    workers = 2
+
+    def setUp(self):
+        self.api_server = mock_lalalai.start_mock_server(**self.mock_settings)
+        self.addCleanup(self.api_server.server_close)
+        self.addCleanup(self.api_server.shutdown)
+        self.api = self.api_server.api
+        for name, value in (
+            ("URL_API", self.api_server.url_api),
+            ("progress_handler", None),
+            ("request_policy", lalalai_splitter.RequestPolicy()),
+        ):
+            patcher = mock.patch.object(lalalai_splitter, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.service = JobService("key", tmp.name, self.workers, {})
+        self.server = start_job_server(self.service)
+        self.addCleanup(self.stop_service)
+
+    def stop_service(self):
+        self.server.shutdown()
+        self.server.server_close()
+        lalalai_splitter.event_bus.unsubscribe(self.service.route_event)
+
+        async def cancel_tasks():
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        loop = self.service.loop
+        asyncio.run_coroutine_threadsafe(cancel_tasks(), loop).result(10)
+        loop.call_soon_threadsafe(loop.stop)
+
+    def request(self, method, path, body=None, headers=None):
+        """makes a request of the job server, returning the status and body"""
+        connection = http.client.HTTPConnection(*self.server.server_address)
+        try:
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def request_json(self, method, path, body=None, headers=None):
+        status, body = self.request(method, path, body, headers)
+        return status, json.loads(body)
+
+    def submit(self, data=b"some audio", query="stems=vocals", **headers):
+        status, job = self.request_json(
+            "POST", f"/jobs?{query}&filename=My%20Song.wav", data, headers
+        )
+        self.assertEqual(status, 202)
+        return job
+
+    def events(self, job_id, since=0):
+        """the job's events, once it's finished"""
+        status, body = self.request("GET", f"/jobs/{job_id}/events?since={since}")
+        self.assertEqual(status, 200)
+        return [json.loads(line) for line in body.splitlines() if line]
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("timed out")
+            time.sleep(0.02)
+
+
+class JobServerTest(JobServerTestCase):
+    def test_submit(self):
+        job = self.submit(query="stems=vocals&backing_tracks=vocals")
+        self.assertIn(job["status"], ("queued", "running"))
+        self.assertEqual(job["filename"], "My Song.wav")
+        self.assertEqual(job["client"], "127.0.0.1")
+
+        events = [e["event"] for e in self.events(job["id"])]
+        self.assertIn("uploaded", events)
+        self.assertIn("split_complete", events)
+        self.assertEqual(events[-1], "file_complete")
+
+        status, job = self.request_json("GET", f"/jobs/{job['id']}")
+        self.assertEqual(status, 200)
+        self.assertEqual(job["status"], "done")
+        self.assertIsNone(job["error"])
+        self.assertEqual(
+            job["tracks"], ["My Song_all_but_vocals.wav", "My Song_vocals.wav"]
+        )
+        self.assertEqual(job["last_event"]["event"], "file_complete")
+
+        # the mock's tracks are the upload sent back
+        status, body = self.request(
+            "GET", f"/jobs/{job['id']}/tracks/{quote('My Song_vocals.wav')}"
+        )
+        self.assertEqual((status, body), (200, b"some audio"))
+        status, _ = self.request("GET", f"/jobs/{job['id']}/tracks/other.wav")
+        self.assertEqual(status, 404)
+
+    def test_events_since(self):
+        job = self.submit()
+        events = self.events(job["id"])
+        self.assertEqual(self.events(job["id"], since=2), events[2:])
+
+    def test_identical_inputs_share_a_split(self):
+        first = self.submit(**{"X-Client": "alice"})
+        second = self.submit(**{"X-Client": "bob"})
+        self.events(first["id"])
+        self.events(second["id"])
+        self.assertEqual(self.api.stats["requests"].get("upload"), 1)
+        self.assertEqual(self.api.stats["requests"].get("split"), 1)
+        for job in (first, second):
+            _, job = self.request_json("GET", f"/jobs/{job['id']}")
+            self.assertEqual(job["status"], "done")
+            self.assertEqual(job["tracks"], ["My Song_vocals.wav"])
+
+    def test_clients_jobs(self):
+        alice = self.submit(**{"X-Client": "alice"})
+        self.submit(b"other audio", **{"X-Client": "bob"})
+        status, jobs = self.request_json("GET", "/jobs?client=alice")
+        self.assertEqual(status, 200)
+        self.assertEqual([job["id"] for job in jobs], [alice["id"]])
+
+    def test_failed_split(self):
+        self.api.fail_stems.add("vocals")
+        job = self.submit()
+        self.events(job["id"])
+        _, job = self.request_json("GET", f"/jobs/{job['id']}")
+        self.assertEqual(job["status"], "failed")
+        self.assertIn("Can't split vocals", job["error"])
+        self.assertEqual(job["tracks"], [])
+
+    def test_bad_requests(self):
+        for query, message in (
+            ("stems=kazoo", "unknown stem: kazoo"),
+            ("stems=", "at least one of stems or backing_tracks is required"),
+            ("stems=vocals&filter=harsh", "unknown filter: harsh"),
+            ("stems=vocals&splitter=other", "unknown splitter: other"),
+        ):
+            status, body = self.request_json("POST", f"/jobs?{query}", b"audio")
+            self.assertEqual((status, body["error"]), (400, message))
+        status, body = self.request_json(
+            "POST", "/jobs?stems=vocals&filename=notes.txt", b"text"
+        )
+        self.assertEqual((status, body["error"]), (400, "not an audio file: notes.txt"))
+
+        for method, path in (
+            ("GET", "/jobs/missing"),
+            ("GET", "/jobs/missing/events"),
+            ("DELETE", "/jobs/missing"),
+            ("GET", "/other"),
+            ("POST", "/jobs/missing"),
+        ):
+            status, _ = self.request(method, path, b"" if method == "POST" else None)
+            self.assertEqual(status, 404, (method, path))
+        self.assertEqual(self.api.stats["requests"], {})
+
+
+class CancelTest(JobServerTestCase):
+    mock_settings = {"queue_delay": 0, "split_time": 30}
+    workers = 1
+
+    def job_status(self, job_id):
+        return self.request_json("GET", f"/jobs/{job_id}")[1]["status"]
+
+    def test_cancel_running_job(self):
+        job = self.submit()
+        self.wait_for(lambda: self.api.stats["requests"].get("split"))
+        self.assertEqual(self.job_status(job["id"]), "running")
+
+        status, body = self.request_json("DELETE", f"/jobs/{job['id']}")
+        self.assertEqual((status, body["status"]), (200, "cancelled"))
+        # the event stream ends with the job
+        self.events(job["id"])
+        self.wait_for(lambda: not self.service.runs)
+
+    def test_cancel_queued_job(self):
+        running = self.submit()
+        queued = self.submit(b"other audio")
+        self.wait_for(lambda: self.api.stats["requests"].get("split"))
+        self.assertEqual(self.job_status(queued["id"]), "queued")
+
+        self.request("DELETE", f"/jobs/{queued['id']}")
+        self.assertEqual(self.job_status(queued["id"]), "cancelled")
+        self.assertEqual(self.job_status(running["id"]), "running")
+        self.request("DELETE", f"/jobs/{running['id']}")
+        self.wait_for(lambda: not self.service.runs)
+        # the queued job's input was never uploaded
+        self.assertEqual(self.api.stats["requests"]["upload"], 1)
+
+    def test_shared_run_goes_on(self):
+        first = self.submit(**{"X-Client": "alice"})
+        second = self.submit(**{"X-Client": "bob"})
+        self.wait_for(lambda: self.api.stats["requests"].get("split"))
+        self.request("DELETE", f"/jobs/{first['id']}")
+        self.assertEqual(self.job_status(first["id"]), "cancelled")
+        # bob still wants the run, so it isn't stopped
+        self.assertEqual(self.job_status(second["id"]), "running")
+        self.assertEqual(len(self.service.runs), 1)
+
+    def test_cancel_twice(self):
+        job = self.submit()
+        self.request("DELETE", f"/jobs/{job['id']}")
+        status, body = self.request_json("DELETE", f"/jobs/{job['id']}")
+        self.assertEqual((status, body["status"]), (200, "cancelled"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,1809 @@
+"""
+Tests of lalalai_splitter.  The parts that talk to the API run against
+the stand-in in mock_lalalai.
+
+Run with `python -m pytest` or `python -m unittest`.
+"""
+
+import contextvars
+import gzip
+import http.client
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import wave
+from contextlib import redirect_stderr, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.error import HTTPError
+
+import lalalai_splitter
+import mock_lalalai
+from lalalai_splitter import (
+    CircuitBreaker,
+    ConnectionPool,
+    EventBus,
+    JobJournal,
+    LicensePool,
+    Metrics,
+    OutputManifest,
+    ProgressEvent,
+    RequestPolicy,
+    StatusPoller,
+    TokenBucket,
+    UploadBody,
+    UploadCache,
+    escape_label_value,
+    upload_file_cached,
+)
+
+
+class MockAPITestCase(unittest.TestCase):
+    """
+    Starts a mock API server for each test, with `mock_settings` passed to
+    `MockLalalai`, and points the splitter at it, with a request policy
+    of its own and progress reported only on the event bus, collected in
+    `events`.  `tmp` is a scratch directory.
+    """
+
+    mock_settings = {"queue_delay": 0, "split_time": 0.5}
+
+    def setUp(self):
+        self.server = mock_lalalai.start_mock_server(**self.mock_settings)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.api = self.server.api
+        self.patch(lalalai_splitter, "URL_API", self.server.url_api)
+        self.patch(lalalai_splitter, "progress_handler", None)
+        self.patch(lalalai_splitter, "request_policy", lalalai_splitter.RequestPolicy())
+
+        self.events = []
+        lalalai_splitter.event_bus.subscribe(self.events.append)
+        self.addCleanup(lalalai_splitter.event_bus.unsubscribe, self.events.append)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def patch(self, target, name, value):
+        patcher = mock.patch.object(target, name, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def event_names(self):
+        return [event.name for event in self.events]
+
+    def requests(self, endpoint):
+        """the number of requests the mock has had to `endpoint`"""
+        return self.api.stats["requests"].get(endpoint, 0)
+
+    def start_split(self, stem="vocals", data=b"audio", filename="song.wav"):
+        """uploads `data` straight to the mock, splits it, returns the task ID"""
+        file_id = self.api.upload(filename, data)
+        return self.api.split("key", file_id, stem)["task_id"]
+
+
+class StatusPollerTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.poller = StatusPoller()
+
+    def test_resolves_to_track_urls(self):
+        task_id = self.start_split()
+        stem_url, back_url = self.poller.watch("vocals", task_id).result(10)
+        self.assertTrue(stem_url.endswith(f"/media/{task_id}/stem"))
+        self.assertTrue(back_url.endswith(f"/media/{task_id}/back"))
+        self.assertIn("split_progress", self.event_names())
+
+    def test_short_split_is_seen_promptly(self):
+        task_id = self.start_split()
+        start = time.monotonic()
+        self.poller.watch("vocals", task_id).result(10)
+        # not held back to POLL_QUEUED_INTERVAL by the first poll's 0%
+        self.assertLess(time.monotonic() - start, lalalai_splitter.POLL_QUEUED_INTERVAL)
+
+    def test_tasks_due_together_share_a_request(self):
+        task_ids = [self.start_split(stem) for stem in ("vocals", "drum", "bass")]
+        futures = [
+            self.poller.watch(stem, task_id)
+            for stem, task_id in zip(("vocals", "drum", "bass"), task_ids)
+        ]
+        for future in futures:
+            future.result(10)
+        self.assertLess(self.requests("check"), 3 * 3)
+
+    def test_api_error_fails_task(self):
+        with self.assertRaisesRegex(RuntimeError, "File not found"):
+            self.poller.watch("vocals", "no-such-id").result(10)
+
+    def test_cancel_stops_watch(self):
+        future = self.poller.watch("vocals", self.start_split())
+        future.cancel()
+        self.assertEqual(self.poller.tasks, {})
+
+
+class QueuedStatusPollerTest(MockAPITestCase):
+    mock_settings = {"queue_delay": 2.5, "split_time": 0.2}
+
+    def test_queued_task_backs_off(self):
+        task_id = self.start_split()
+        future = StatusPoller().watch("vocals", task_id)
+        future.result(15)
+        # polled after 1, 1.5 and 2.25 seconds, not every second
+        self.assertLessEqual(self.requests("check"), 5)
+        self.assertIn("split_waiting", self.event_names())
+
+    def test_schedule(self):
+        task = lalalai_splitter.PolledTask("vocals", "id")
+        intervals = []
+        for _ in range(4):
+            intervals.append(task.queued_interval)
+            task.schedule(0)
+        self.assertEqual(intervals, [1.0, 1.5, 2.25, 3.375])
+
+        # progress after a long wait in the queue isn't taken as the rate
+        task.schedule(10)
+        self.assertLessEqual(
+            task.next_poll - time.monotonic(), lalalai_splitter.POLL_MIN_INTERVAL
+        )
+
+
+class StatusPollerRetryTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.poller = StatusPoller()
+        self.patch(lalalai_splitter.request_policy, "backoff", lambda attempt, e: 0.1)
+        self.fetch_json = lalalai_splitter.fetch_json
+        self.failures = []
+
+    def fail_checks(self, *exceptions):
+        """makes the next check/ requests raise `exceptions`, in turn"""
+        self.failures.extend(exceptions)
+
+        def fetch_json(method, url, *args, **kwargs):
+            if "check/" in url and self.failures:
+                raise self.failures.pop(0)
+            return self.fetch_json(method, url, *args, **kwargs)
+
+        self.patch(lalalai_splitter, "fetch_json", fetch_json)
+
+    def test_transient_failure_is_retried_on_a_later_pass(self):
+        self.fail_checks(ConnectionResetError(), TimeoutError())
+        future = self.poller.watch("vocals", self.start_split())
+        future.result(10)
+        retries = [e for e in self.events if e.name == "api_retry"]
+        self.assertEqual([e.fields["attempt"] for e in retries], [1, 2])
+        self.assertEqual(retries[0].stem, "vocals")
+
+    def test_failure_doesnt_hold_up_other_tasks(self):
+        # while one task's checks fail, the poller thread isn't asleep in
+        # a retry, so the next task is watched at once
+        self.patch(lalalai_splitter.request_policy, "backoff", lambda attempt, e: 30)
+        self.fail_checks(ConnectionResetError())
+        self.poller.watch("vocals", self.start_split("vocals"))
+        time.sleep(0.2)
+        start = time.monotonic()
+        self.poller.watch("drum", self.start_split("drum")).result(10)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_gives_up_after_retries(self):
+        self.patch(lalalai_splitter.request_policy, "retries", 2)
+        self.fail_checks(*[ConnectionResetError() for _ in range(3)])
+        with self.assertRaises(ConnectionResetError):
+            self.poller.watch("vocals", self.start_split()).result(10)
+
+    def test_other_errors_fail_at_once(self):
+        self.fail_checks(ValueError("bad JSON"))
+        with self.assertRaisesRegex(ValueError, "bad JSON"):
+            self.poller.watch("vocals", self.start_split()).result(10)
+        self.assertNotIn("api_retry", self.event_names())
+
+
+class UploadCacheTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = UploadCache(self.path("cache.sqlite3"))
+        self.input_path = self.path("song.wav")
+        with open(self.input_path, "wb") as f:
+            f.write(b"some audio")
+
+    def test_keyed_by_hash_and_license(self):
+        self.cache.set("h", "key1", "f1")
+        self.assertEqual(self.cache.get("h", "key1"), "f1")
+        self.assertIsNone(self.cache.get("h", "key2"))
+        self.assertIsNone(self.cache.get("other", "key1"))
+        self.cache.set("h", "key1", "f2")
+        self.assertEqual(self.cache.get("h", "key1"), "f2")
+        self.cache.delete("h", "key1")
+        self.assertIsNone(self.cache.get("h", "key1"))
+
+    def test_kept_across_connections(self):
+        self.cache.set("h", "key", "f1")
+        cache = UploadCache(self.path("cache.sqlite3"))
+        self.assertEqual(cache.get("h", "key"), "f1")
+
+    def test_entries_expire(self):
+        cache = UploadCache(self.path("expiring.sqlite3"), ttl=-1)
+        cache.set("h", "key", "f1")
+        self.assertIsNone(cache.get("h", "key"))
+
+    def test_is_live(self):
+        file_id = self.api.upload("song.wav", b"some audio")
+        self.assertTrue(self.cache.is_live(file_id))
+        self.assertFalse(self.cache.is_live("forgotten"))
+        # asked about once
+        checks = self.requests("check")
+        self.assertTrue(self.cache.is_live(file_id))
+        self.assertEqual(self.requests("check"), checks)
+
+    def test_upload_reused(self):
+        first = upload_file_cached(self.input_path, "key", self.cache)
+        second = upload_file_cached(self.input_path, "key", self.cache)
+        self.assertEqual(first, second)
+        self.assertEqual(self.requests("upload"), 1)
+        self.assertIn("upload_cached", self.event_names())
+
+    def test_other_license_uploads_again(self):
+        upload_file_cached(self.input_path, "key1", self.cache)
+        upload_file_cached(self.input_path, "key2", self.cache)
+        self.assertEqual(self.requests("upload"), 2)
+
+    def test_changed_contents_upload_again(self):
+        upload_file_cached(self.input_path, "key", self.cache)
+        with open(self.input_path, "ab") as f:
+            f.write(b" and more")
+        upload_file_cached(self.input_path, "key", self.cache)
+        self.assertEqual(self.requests("upload"), 2)
+
+    def test_stale_entry_uploads_again(self):
+        digest = lalalai_splitter.hash_file(self.input_path)
+        self.cache.set(digest, "key", "gone")
+        self.cache.checked.clear()
+        file_id = upload_file_cached(self.input_path, "key", self.cache)
+        self.assertNotEqual(file_id, "gone")
+        self.assertEqual(self.cache.get(digest, "key"), file_id)
+        self.assertEqual(self.requests("upload"), 1)
+
+
+class JobJournalTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.db_file = os.path.join(tmp.name, "journal.sqlite3")
+
+    def test_round_trip(self):
+        journal = JobJournal(self.db_file)
+        job_id = journal.create_job(
+            "/in/song.wav",
+            "/out",
+            ["vocals", "drum"],
+            ["vocals"],
+            1,
+            "phoenix",
+            settings={"trim_silence": True, "compress_uploads": False},
+        )
+        upload = {
+            "trim": {"lead_frames": 10, "kept_frames": 90, "total_frames": 120},
+            "flac_sample_width": None,
+        }
+        journal.set_file_id(job_id, "f1", license="key", upload=upload)
+        journal.split_requested(job_id, "vocals", "t1")
+        journal.split_done(job_id, "vocals", "http://x/stem", "http://x/back")
+        journal.downloaded(job_id, "vocals", "stem")
+        journal.split_requested(job_id, "drum", "t2")
+
+        # a new connection, as a resumed run would open
+        job = JobJournal(self.db_file).get_job(job_id)
+        self.assertEqual(job["input_path"], "/in/song.wav")
+        self.assertEqual(job["output_path"], "/out")
+        self.assertEqual(job["stems"], ["vocals", "drum"])
+        self.assertEqual(job["backing_tracks"], ["vocals"])
+        self.assertEqual(job["filter_type"], 1)
+        self.assertEqual(job["splitter"], "phoenix")
+        self.assertEqual(job["file_id"], "f1")
+        self.assertEqual(job["license"], "key")
+        self.assertEqual(
+            job["settings"], {"trim_silence": True, "compress_uploads": False}
+        )
+        self.assertEqual(job["upload"], upload)
+        self.assertEqual(job["state"], "running")
+        self.assertEqual(
+            job["splits"]["vocals"],
+            {
+                "check_id": "t1",
+                "stem_track_url": "http://x/stem",
+                "back_track_url": "http://x/back",
+                "stem_downloaded": True,
+                "back_track_downloaded": False,
+            },
+        )
+        self.assertIsNone(job["splits"]["drum"]["stem_track_url"])
+
+    def test_unfinished_jobs(self):
+        journal = JobJournal(self.db_file)
+        first = journal.create_job("a.wav", "/out", ["vocals"], [], 1, "phoenix")
+        second = journal.create_job("b.wav", "/out", ["vocals"], [], 1, "phoenix")
+        third = journal.create_job("c.wav", "/out", ["vocals"], [], 1, "phoenix")
+        journal.finish_job(second)
+        self.assertEqual(journal.unfinished_jobs(), [first, third])
+        self.assertEqual(journal.get_job(second)["state"], "complete")
+
+    def test_defaults_before_upload(self):
+        journal = JobJournal(self.db_file)
+        job_id = journal.create_job("a.wav", "/out", ["vocals"], [], 1, "phoenix")
+        job = journal.get_job(job_id)
+        self.assertIsNone(job["file_id"])
+        self.assertIsNone(job["upload"])
+        self.assertEqual(job["settings"], {})
+        self.assertEqual(job["splits"], {})
+
+    def test_missing_job(self):
+        with self.assertRaises(KeyError):
+            JobJournal(self.db_file).get_job(1)
+
+
+class JobResumeTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.journal = JobJournal(self.path("journal.sqlite3"))
+        self.input_path = self.path("song.wav")
+        with open(self.input_path, "wb") as f:
+            f.write(b"some audio")
+        self.output_path = self.path("out")
+        os.mkdir(self.output_path)
+
+    def create_job(self, stems, backing_tracks=()):
+        return self.journal.create_job(
+            self.input_path,
+            self.output_path,
+            list(stems),
+            list(backing_tracks),
+            1,
+            "phoenix",
+        )
+
+    def test_run_is_journaled(self):
+        lalalai_splitter.batch_process_multiple_stems(
+            "key",
+            self.input_path,
+            self.output_path,
+            ["vocals"],
+            ["vocals"],
+            1,
+            "phoenix",
+            journal=self.journal,
+        )
+        self.assertEqual(self.journal.unfinished_jobs(), [])
+        job = self.journal.get_job(1)
+        self.assertEqual(job["state"], "complete")
+        self.assertEqual(job["license"], "key")
+        self.assertTrue(job["splits"]["vocals"]["stem_downloaded"])
+        self.assertTrue(job["splits"]["vocals"]["back_track_downloaded"])
+
+    def test_resume_after_upload(self):
+        job_id = self.create_job(["vocals"], ["vocals"])
+        file_id = self.api.upload("song.wav", b"some audio")
+        self.journal.set_file_id(job_id, file_id, "key")
+
+        lalalai_splitter.resume_job("key", self.journal, job_id)
+        self.assertEqual(self.requests("upload"), 0)
+        self.assertEqual(self.requests("split"), 1)
+        for name in ("song_vocals.wav", "song_all_but_vocals.wav"):
+            self.assertTrue(os.path.exists(os.path.join(self.output_path, name)))
+        self.assertEqual(self.journal.get_job(job_id)["state"], "complete")
+
+    def test_resume_skips_finished_splits(self):
+        job_id = self.create_job(["vocals", "drum"])
+        file_id = self.api.upload("song.wav", b"some audio")
+        self.journal.set_file_id(job_id, file_id, "key")
+        task_id = self.api.split("key", file_id, "vocals")["task_id"]
+        self.journal.split_requested(job_id, "vocals", task_id)
+
+        lalalai_splitter.resume_job("key", self.journal, job_id)
+        # vocals is polled with the journaled ID rather than split again
+        self.assertEqual(self.requests("split"), 1)
+        for name in ("song_vocals.wav", "song_drum.wav"):
+            self.assertTrue(os.path.exists(os.path.join(self.output_path, name)))
+
+    def test_other_license_uploads_again(self):
+        job_id = self.create_job(["vocals"])
+        self.journal.set_file_id(job_id, "uploaded-by-key1", "key1")
+        lalalai_splitter.resume_job("key2", self.journal, job_id)
+        self.assertEqual(self.requests("upload"), 1)
+        self.assertEqual(self.journal.get_job(job_id)["license"], "key2")
+
+
+class OutputManifestTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.output_path = tmp.name
+        self.track_path = os.path.join(tmp.name, "song_vocals.wav")
+        with open(self.track_path, "wb") as f:
+            f.write(b"track data")
+
+    def test_round_trip(self):
+        manifest = OutputManifest(self.output_path)
+        self.assertFalse(manifest.satisfied("h", "vocals", "stem", 1, "phoenix"))
+        manifest.record("h", "vocals", "stem", 1, "phoenix", self.track_path)
+
+        manifest = OutputManifest(self.output_path)
+        self.assertTrue(manifest.satisfied("h", "vocals", "stem", 1, "phoenix"))
+        self.assertFalse(manifest.satisfied("h", "vocals", "back_track", 1, "phoenix"))
+        self.assertFalse(manifest.satisfied("h", "vocals", "stem", 2, "phoenix"))
+        self.assertFalse(manifest.satisfied("other", "vocals", "stem", 1, "phoenix"))
+
+    def test_changed_track_is_not_satisfied(self):
+        OutputManifest(self.output_path).record(
+            "h", "vocals", "stem", 1, "phoenix", self.track_path
+        )
+        with open(self.track_path, "ab") as f:
+            f.write(b" edited")
+        manifest = OutputManifest(self.output_path)
+        self.assertFalse(manifest.satisfied("h", "vocals", "stem", 1, "phoenix"))
+
+    def test_record_replaces_entry(self):
+        manifest = OutputManifest(self.output_path)
+        manifest.record("h", "vocals", "stem", 1, "phoenix", self.track_path)
+        manifest.record("h", "vocals", "stem", 1, "phoenix", self.track_path)
+        self.assertEqual(len(OutputManifest(self.output_path).entries), 1)
+
+    def test_unreadable_manifest_starts_empty(self):
+        path = os.path.join(self.output_path, lalalai_splitter.MANIFEST_NAME)
+        with open(path, "w") as f:
+            f.write("{not json")
+        self.assertEqual(OutputManifest(self.output_path).entries, [])
+
+
+class SkipExistingTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.input_path = self.path("song.wav")
+        with open(self.input_path, "wb") as f:
+            f.write(b"some audio")
+        self.output_path = self.path("out")
+        os.mkdir(self.output_path)
+
+    def run_batch(self, stems, backing_tracks, filter_type=1):
+        lalalai_splitter.batch_process_multiple_stems(
+            "key",
+            self.input_path,
+            self.output_path,
+            stems,
+            backing_tracks,
+            filter_type,
+            "phoenix",
+        )
+
+    def test_second_run_does_nothing(self):
+        self.run_batch(["vocals"], ["vocals"])
+        self.api.reset_stats()
+        self.run_batch(["vocals"], ["vocals"])
+        self.assertEqual(self.api.stats["requests"], {})
+        self.assertIn("already_extracted", self.event_names())
+
+    def test_only_missing_track_is_downloaded(self):
+        self.run_batch(["vocals"], ["vocals"])
+        os.remove(os.path.join(self.output_path, "song_all_but_vocals.wav"))
+        self.api.reset_stats()
+        self.run_batch(["vocals"], ["vocals"])
+        self.assertEqual(self.requests("split"), 1)
+        self.assertEqual(self.requests("media"), 1)
+
+    def test_other_settings_split_again(self):
+        self.run_batch(["vocals"], [])
+        self.api.reset_stats()
+        self.run_batch(["vocals"], [], filter_type=2)
+        self.assertEqual(self.requests("split"), 1)
+
+
+class ClosingHandler(BaseHTTPRequestHandler):
+    """answers each request, then hangs up without saying it will"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+        self.close_connection = True
+
+
+class ConnectionPoolTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = ConnectionPool()
+        self.url = self.server.url_api.replace("/api/", "/mock/stats")
+
+    def get(self, url=None):
+        with self.pool.request("GET", url or self.url) as response:
+            response.read()
+            return response.conn
+
+    def test_connection_reused(self):
+        first = self.get()
+        self.assertIs(self.get(), first)
+        self.assertEqual(len(self.pool.idle), 1)
+
+    def test_error_status_raises_and_keeps_connection(self):
+        first = self.get()
+        with self.assertRaises(HTTPError) as raised:
+            self.get(self.server.url_api + "nothing/")
+        self.assertEqual(raised.exception.code, 404)
+        self.assertIs(self.get(), first)
+
+    def test_idle_connections_expire(self):
+        self.pool.max_idle = 0
+        first = self.get()
+        self.assertIsNot(self.get(), first)
+
+    def test_unread_response_isnt_reused(self):
+        with self.pool.request("GET", self.url) as response:
+            first = response.conn
+        self.assertIsNot(self.get(), first)
+
+    def test_connection_closed_by_server_is_dropped(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), ClosingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+        first = self.get(url)
+        time.sleep(0.1)
+        self.assertIsNot(self.get(url), first)
+
+    def test_requests_per_host_are_limited(self):
+        self.pool.max_per_host = 1
+        response = self.pool.request("GET", self.url)
+        done = threading.Event()
+        thread = threading.Thread(target=lambda: (self.get(), done.set()))
+        thread.start()
+        self.assertFalse(done.wait(0.2))
+        response.read()
+        response.close()
+        self.assertTrue(done.wait(5))
+        thread.join()
+
+
+class DownloadFileTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(300_000)
+        task_id = self.start_split(data=self.data)
+        host, port = self.server.server_address[:2]
+        self.url = f"http://{host}:{port}/media/{task_id}/stem"
+        self.file_path = self.path("song_vocals.wav")
+
+    def download(self):
+        return lalalai_splitter.download_file(self.url, self.tmp)
+
+    def assert_downloaded(self, path, data=None):
+        self.assertEqual(path, self.file_path)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.data if data is None else data)
+        self.assertFalse(os.path.exists(path + ".part"))
+
+    def test_download(self):
+        self.assert_downloaded(self.download())
+
+    def test_resumes_part_file(self):
+        # what's in the ".part" file is kept, not downloaded again, so
+        # the result is made of it and the rest of the server's data
+        kept = b"x" * 100_000
+        with open(self.file_path + ".part", "wb") as f:
+            f.write(kept)
+        self.assert_downloaded(self.download(), kept + self.data[len(kept) :])
+
+    def test_starts_over_past_end(self):
+        # a ".part" file as long as the track gets a 416, and is replaced
+        with open(self.file_path + ".part", "wb") as f:
+            f.write(b"x" * len(self.data))
+        self.assert_downloaded(self.download())
+
+    def test_dropped_connection_resumes(self):
+        receive_into_part = lalalai_splitter.receive_into_part
+        offsets = []
+
+        def dropping(response, part_path, offset, *args):
+            offsets.append(offset)
+            if len(offsets) == 1:
+                with open(part_path, "wb") as f:
+                    f.write(response.read(50_000))
+                raise ConnectionResetError()
+            return receive_into_part(response, part_path, offset, *args)
+
+        self.patch(lalalai_splitter, "receive_into_part", dropping)
+        self.patch(lalalai_splitter, "sleep_unless_cancelled", lambda *args: None)
+        self.assert_downloaded(self.download())
+        self.assertEqual(offsets, [0, 50_000])
+
+    def test_local_errors_arent_retried(self):
+        sleeps = []
+        self.patch(
+            lalalai_splitter, "sleep_unless_cancelled", lambda *a: sleeps.append(a)
+        )
+        with self.assertRaises(FileNotFoundError):
+            lalalai_splitter.download_file(self.url, self.path("missing"))
+        self.assertEqual(sleeps, [])
+
+
+class UploadTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(2 * lalalai_splitter.UPLOAD_BLOCK_SIZE + 1000)
+        self.input_path = self.path("song.wav")
+        with open(self.input_path, "wb") as f:
+            f.write(self.data)
+
+    def uploaded(self, file_id):
+        """the name and contents the mock holds for `file_id`"""
+        return self.api.files[file_id]
+
+    def test_body_blocks_and_progress(self):
+        with open(self.input_path, "rb") as f:
+            body = UploadBody(f)
+            self.assertEqual(body.size, len(self.data))
+            blocks = list(body)
+            # it starts over each time, for a request sent again
+            self.assertEqual(b"".join(body), self.data)
+        self.assertEqual(b"".join(blocks), self.data)
+        self.assertEqual(len(blocks), 3)
+        progress = [e for e in self.events if e.name == "upload_progress"]
+        self.assertEqual(progress[-1].percent, 100)
+        self.assertEqual(progress[-1].bytes, len(self.data))
+
+    def test_body_cancelled(self):
+        cancel = threading.Event()
+        cancel.set()
+        with open(self.input_path, "rb") as f:
+            with self.assertRaises(lalalai_splitter.TransferCancelled):
+                list(UploadBody(f, cancel=cancel))
+
+    def test_body_bandwidth(self):
+        bandwidth = lalalai_splitter.BandwidthLimiter(len(self.data) * 4)
+        start = time.monotonic()
+        with open(self.input_path, "rb") as f:
+            list(UploadBody(f, bandwidth))
+        # the last block waits for the first two to have gone at the rate
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    def test_upload(self):
+        file_id = lalalai_splitter.upload_file(self.input_path, "key")
+        self.assertEqual(self.uploaded(file_id), ("song.wav", self.data))
+
+    def test_non_ascii_name(self):
+        path = self.path("Café del Mar.wav")
+        os.rename(self.input_path, path)
+        file_id = lalalai_splitter.upload_file(path, "key")
+        self.assertEqual(self.uploaded(file_id)[0], "Café del Mar.wav")
+
+    def test_failed_upload_is_sent_again_whole(self):
+        self.patch(lalalai_splitter.request_policy, "backoff", lambda attempt, e: 0)
+        fetch_json = lalalai_splitter.fetch_json
+        calls = []
+
+        def failing_once(method, url, body=None, *args):
+            calls.append(url)
+            if len(calls) == 1:
+                next(iter(body))
+                raise ConnectionResetError()
+            return fetch_json(method, url, body, *args)
+
+        self.patch(lalalai_splitter, "fetch_json", failing_once)
+        file_id = lalalai_splitter.upload_file(self.input_path, "key")
+        self.assertEqual(self.uploaded(file_id), ("song.wav", self.data))
+        self.assertEqual(len(calls), 2)
+        self.assertIn("upload_retry", self.event_names())
+
+
+class CommandLineTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.input_path = self.path("song.wav")
+        with open(self.input_path, "wb") as f:
+            f.write(b"some audio")
+        self.output_path = self.path("out")
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop("LALALAI_LICENSE", None)
+
+    def run_main(self, *args):
+        """runs the command line, returning its status and output"""
+        argv = ["lalalai_splitter.py", "--api-url", self.server.url_api, *args]
+        stdout = io.StringIO()
+        with mock.patch.object(sys, "argv", argv), redirect_stdout(stdout):
+            status = lalalai_splitter.main()
+        return status, stdout.getvalue()
+
+    def main(self, *args):
+        """runs the command line, returning its status and JSON progress"""
+        status, output = self.run_main(*args)
+        return status, [json.loads(line) for line in output.splitlines()]
+
+    def assert_usage_error(self, *args, message):
+        stderr = io.StringIO()
+        with redirect_stderr(stderr), self.assertRaises(SystemExit) as raised:
+            self.main(*args)
+        self.assertEqual(raised.exception.code, 2)
+        self.assertIn(message, stderr.getvalue())
+
+    def output_files(self):
+        return sorted(
+            name for name in os.listdir(self.output_path) if not name.startswith(".")
+        )
+
+    def test_usage_errors(self):
+        os.mkdir(self.path("empty"))
+        self.assert_usage_error(
+            "--input", self.input_path, "--stems", "vocals", message="license key"
+        )
+        self.assert_usage_error(
+            "--license", "key", "--stems", "vocals", message="--input"
+        )
+        self.assert_usage_error(
+            "--license", "key", "--input", self.input_path, message="--stems"
+        )
+        self.assert_usage_error(
+            "--license", "key", "--resume", "1", message="--journal"
+        )
+        self.assert_usage_error(
+            "--license",
+            "key",
+            "--input",
+            self.path("empty"),
+            "--stems",
+            "vocals",
+            message="no audio files",
+        )
+
+    def test_split(self):
+        status, events = self.main(
+            "--license",
+            "key",
+            "--input",
+            self.input_path,
+            "--output",
+            self.output_path,
+            "--stems",
+            "vocals",
+            "--backing-tracks",
+            "vocals",
+        )
+        self.assertEqual(status, 0)
+        self.assertEqual(
+            self.output_files(), ["song_all_but_vocals.wav", "song_vocals.wav"]
+        )
+        names = [event["event"] for event in events]
+        self.assertIn("uploaded", names)
+        self.assertEqual(names[-1], "unmixing_complete")
+
+    def test_directory_of_inputs(self):
+        os.mkdir(self.path("inputs"))
+        for name in ("a.wav", "b.mp3", "notes.txt"):
+            with open(self.path(os.path.join("inputs", name)), "wb") as f:
+                f.write(name.encode())
+        status, events = self.main(
+            "--license",
+            "key",
+            "--input",
+            self.path("inputs"),
+            "--output",
+            self.output_path,
+            "--stems",
+            "drum",
+        )
+        self.assertEqual(status, 0)
+        self.assertEqual(self.output_files(), ["a_drum.wav", "b_drum.mp3"])
+        self.assertEqual(events[-1]["event"], "batch_complete")
+        self.assertEqual(events[-1]["failed"], 0)
+
+    def test_license_from_environment(self):
+        os.environ["LALALAI_LICENSE"] = "key"
+        status, _ = self.main(
+            "--input", self.input_path, "--output", self.output_path, "--stems", "bass"
+        )
+        self.assertEqual(status, 0)
+
+    def test_resume(self):
+        journal_path = self.path("journal.sqlite3")
+        journal = JobJournal(journal_path)
+        job_id = journal.create_job(
+            self.input_path, self.output_path, ["vocals"], [], 1, "phoenix"
+        )
+        os.mkdir(self.output_path)
+        status, _ = self.main(
+            "--license", "key", "--journal", journal_path, "--resume", str(job_id)
+        )
+        self.assertEqual(status, 0)
+        self.assertEqual(self.output_files(), ["song_vocals.wav"])
+        self.assertEqual(journal.get_job(job_id)["state"], "complete")
+
+    def test_failure(self):
+        self.api.fail_stems.add("vocals")
+        status, events = self.main(
+            "--license",
+            "key",
+            "--input",
+            self.input_path,
+            "--output",
+            self.output_path,
+            "--stems",
+            "vocals",
+        )
+        self.assertEqual(status, 1)
+        self.assertEqual(events[-1]["event"], "error")
+
+    def test_text_progress(self):
+        self.patch(
+            lalalai_splitter, "progress_handler", lalalai_splitter.print_progress
+        )
+        _, output = self.run_main(
+            "--license",
+            "key",
+            "--input",
+            self.input_path,
+            "--output",
+            self.output_path,
+            "--stems",
+            "vocals",
+            "--progress",
+            "text",
+        )
+        self.assertIn("%", output)
+        self.assertNotIn('"event"', output)
+
+
+class MultipleFilesTest(MockAPITestCase):
+    mock_settings = {"queue_delay": 0, "split_time": 1.0}
+
+    def setUp(self):
+        super().setUp()
+        self.output_path = self.path("out")
+        os.mkdir(self.output_path)
+        self.input_paths = []
+        for name in ("a.wav", "b.wav", "c.wav", "d.wav"):
+            self.input_paths.append(self.path(name))
+            with open(self.input_paths[-1], "wb") as f:
+                f.write(name.encode())
+
+    def run_batch(self, input_paths, **kwargs):
+        return lalalai_splitter.batch_process_multiple_files(
+            "key", input_paths, self.output_path, ["vocals"], [], 1, "phoenix", **kwargs
+        )
+
+    def test_files_run_together(self):
+        start = time.monotonic()
+        failures = self.run_batch(self.input_paths, max_concurrent_splits=4)
+        self.assertEqual(failures, {})
+        # one after another, the four splits would take four seconds
+        self.assertLess(time.monotonic() - start, 3)
+        for name in ("a", "b", "c", "d"):
+            path = os.path.join(self.output_path, f"{name}_vocals.wav")
+            self.assertTrue(os.path.exists(path))
+
+    def test_events_carry_file_index(self):
+        self.run_batch(self.input_paths[:2])
+        starts = [e for e in self.events if e.name == "file_start"]
+        self.assertEqual([e.file_index for e in starts], [1, 2])
+        self.assertEqual(starts[0].fields["file_count"], 2)
+        uploaded = {e.file_index for e in self.events if e.name == "uploaded"}
+        self.assertEqual(uploaded, {1, 2})
+        self.assertEqual(self.event_names()[-1], "batch_complete")
+
+    def test_failed_file_doesnt_stop_others(self):
+        missing = self.path("missing.wav")
+        failures = self.run_batch([missing] + self.input_paths[:2])
+        self.assertEqual(list(failures), [missing])
+        failed = [e for e in self.events if e.name == "file_failed"]
+        self.assertEqual([e.file_index for e in failed], [1])
+        self.assertEqual(
+            [e.file_index for e in self.events if e.name == "file_complete"], [2, 3]
+        )
+        self.assertEqual(self.events[-1].fields["failed"], 1)
+
+    def test_limits_are_shared(self):
+        upload_file = lalalai_splitter.upload_file
+        lock = threading.Lock()
+        running = []
+        most = []
+
+        def counted_upload(*args, **kwargs):
+            with lock:
+                running.append(1)
+                most.append(len(running))
+            try:
+                time.sleep(0.1)
+                return upload_file(*args, **kwargs)
+            finally:
+                with lock:
+                    running.pop()
+
+        self.patch(lalalai_splitter, "upload_file", counted_upload)
+        self.run_batch(self.input_paths, max_concurrent_uploads=1)
+        self.assertEqual(len(most), 4)
+        self.assertEqual(max(most), 1)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=10, burst=3)
+        with mock.patch.object(lalalai_splitter.time, "sleep") as sleep:
+            for _ in range(3):
+                bucket.take()
+            sleep.assert_not_called()
+
+            # the fourth token is owed, a tenth of a second away
+            bucket.take()
+            sleep.assert_called_once()
+            self.assertAlmostEqual(sleep.call_args[0][0], 0.1, delta=0.01)
+
+            # and the fifth is owed after that one
+            bucket.take()
+            self.assertAlmostEqual(sleep.call_args[0][0], 0.2, delta=0.01)
+
+    def test_refill_is_capped_at_burst(self):
+        bucket = TokenBucket(rate=1000, burst=2)
+        bucket.take()
+        bucket.take()
+        time.sleep(0.05)
+        bucket.take()
+        self.assertLessEqual(bucket.tokens, 1)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        lalalai_splitter.event_bus.subscribe(self.events.append)
+        patcher = mock.patch.object(lalalai_splitter, "progress_handler", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lalalai_splitter.event_bus.unsubscribe, self.events.append)
+
+    def event_names(self):
+        return [event.name for event in self.events]
+
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+        breaker.failure()
+        self.assertIsNone(breaker.opened)
+        breaker.failure()
+        self.assertIsNotNone(breaker.opened)
+        self.assertEqual(self.event_names(), ["api_paused"])
+        self.assertEqual(self.events[0].fields["seconds"], 60)
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertIsNone(breaker.opened)
+        # closing a circuit that wasn't open isn't reported
+        self.assertEqual(self.event_names(), [])
+
+    def test_wait_holds_callers_until_cooldown(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0.1)
+        breaker.wait()
+        breaker.failure()
+        start = time.monotonic()
+        breaker.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertTrue(breaker.probing)
+
+    def test_only_one_probe(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+        breaker.failure()
+        breaker.wait()
+        # a second caller waits for the probe to finish
+        released = threading.Event()
+
+        def second_caller():
+            breaker.wait()
+            released.set()
+
+        thread = threading.Thread(target=second_caller)
+        thread.start()
+        self.assertFalse(released.wait(0.2))
+        breaker.success()
+        self.assertTrue(released.wait(1))
+        thread.join()
+        self.assertIsNone(breaker.opened)
+
+    def test_probe_failure_reopens(self):
+        breaker = CircuitBreaker(threshold=3, cooldown=0.05)
+        for _ in range(3):
+            breaker.failure()
+        breaker.wait()
+        breaker.failure()
+        self.assertIsNotNone(breaker.opened)
+        self.assertFalse(breaker.probing)
+        self.assertEqual(self.event_names(), ["api_paused", "api_paused"])
+
+    def test_probe_success_closes(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+        breaker.failure()
+        breaker.wait()
+        breaker.success()
+        self.assertIsNone(breaker.opened)
+        self.assertEqual(breaker.failures, 0)
+        self.assertEqual(self.event_names(), ["api_paused", "api_resumed"])
+
+    def test_release_lets_another_probe_through(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+        breaker.failure()
+        breaker.wait()
+        breaker.release()
+        self.assertIsNotNone(breaker.opened)
+        self.assertFalse(breaker.probing)
+        breaker.wait()
+        self.assertTrue(breaker.probing)
+
+
+class RequestPolicyTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(lalalai_splitter, "progress_handler", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.policy = RequestPolicy(rate=1000, burst=1000, retries=2)
+        self.sleeps = []
+        patcher = mock.patch.object(
+            lalalai_splitter, "sleep_unless_cancelled", self.record_sleep
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def record_sleep(self, seconds, cancel, name):
+        self.sleeps.append(seconds)
+
+    def flaky(self, *exceptions, result="ok"):
+        """a request that raises `exceptions` in turn, then returns `result`"""
+        exceptions = list(exceptions)
+
+        def request():
+            if exceptions:
+                raise exceptions.pop(0)
+            return result
+
+        return request
+
+    def http_error(self, code, retry_after=None):
+        headers = {} if retry_after is None else {"Retry-After": retry_after}
+        return HTTPError("http://x/", code, "error", headers, None)
+
+    def test_retryable_errors_are_retried(self):
+        request = self.flaky(ConnectionResetError(), self.http_error(503))
+        self.assertEqual(self.policy.call(request), "ok")
+        self.assertEqual(len(self.sleeps), 2)
+
+    def test_gives_up_after_retries(self):
+        request = self.flaky(*[TimeoutError() for _ in range(3)])
+        with self.assertRaises(TimeoutError):
+            self.policy.call(request)
+        self.assertEqual(len(self.sleeps), 2)
+
+    def test_other_errors_arent_retried(self):
+        with self.assertRaises(HTTPError):
+            self.policy.call(self.flaky(self.http_error(404)))
+        with self.assertRaises(RuntimeError):
+            self.policy.call(self.flaky(RuntimeError("no")))
+        self.assertEqual(self.sleeps, [])
+
+    def test_retry_after_is_honoured(self):
+        self.policy.call(self.flaky(self.http_error(429, retry_after="7")))
+        self.assertGreaterEqual(self.sleeps[0], 7)
+
+    def test_backoff_is_jittered_and_capped(self):
+        for attempt in range(1, 20):
+            delay = RequestPolicy.backoff(attempt, ConnectionResetError())
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, lalalai_splitter.API_BACKOFF_MAX)
+
+    def test_on_retry(self):
+        retries = []
+        self.policy.call(
+            self.flaky(ConnectionResetError()),
+            on_retry=lambda attempt, delay: retries.append(attempt),
+        )
+        self.assertEqual(retries, [1])
+
+    def test_is_retryable(self):
+        is_retryable = lalalai_splitter.is_retryable
+        self.assertTrue(is_retryable(self.http_error(429)))
+        self.assertTrue(is_retryable(self.http_error(502)))
+        self.assertFalse(is_retryable(self.http_error(400)))
+        self.assertTrue(is_retryable(ConnectionRefusedError()))
+        self.assertTrue(is_retryable(http.client.RemoteDisconnected()))
+        self.assertFalse(is_retryable(RuntimeError("Not enough minutes left")))
+
+
+class LicensePoolTest(MockAPITestCase):
+    mock_settings = {
+        "queue_delay": 0,
+        "split_time": 0.2,
+        "minutes": {"key1": 100, "key2": 400, "empty": 0},
+    }
+
+    def test_most_minutes_per_job_first(self):
+        pool = LicensePool(["key1", "key2"])
+        # key2 has four times the minutes, so it takes jobs until its
+        # minutes per job are no more than key1's, ties going to the key
+        # with fewer jobs
+        picks = [pool.acquire() for _ in range(5)]
+        self.assertEqual(picks, ["key2", "key2", "key2", "key1", "key2"])
+        pool.release("key2")
+        self.assertEqual(pool.acquire(), "key2")
+
+    def test_preferred_key(self):
+        pool = LicensePool(["key1", "key2"])
+        self.assertEqual(pool.acquire(prefer="key1"), "key1")
+
+    def test_limits_are_cached(self):
+        pool = LicensePool(["key1", "key2"])
+        for _ in range(3):
+            pool.release(pool.acquire())
+        self.assertEqual(self.requests("get-limits"), 2)
+
+    def test_exhausted_key_is_retired(self):
+        pool = LicensePool(["empty", "key1"])
+        self.assertEqual(pool.acquire(), "key1")
+        self.assertEqual(pool.exhausted, {"empty"})
+        exhausted = [e for e in self.events if e.name == "license_exhausted"]
+        self.assertEqual(len(exhausted), 1)
+        # the key itself isn't reported, only its end
+        self.assertEqual(exhausted[0].fields["license"], "...mpty")
+
+    def test_every_key_exhausted(self):
+        with self.assertRaisesRegex(RuntimeError, "out of minutes"):
+            LicensePool(["empty"]).acquire()
+
+
+class ProcessWithPoolTest(MockAPITestCase):
+    mock_settings = {
+        "queue_delay": 0,
+        "split_time": 0.2,
+        "minutes": {"key1": 1, "key2": 100},
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.input_path = self.path("song.wav")
+        with open(self.input_path, "wb") as f:
+            f.write(b"some audio")
+        self.output_path = self.path("out")
+        os.mkdir(self.output_path)
+        # as last heard, key1 had the most minutes
+        self.pool = LicensePool(["key1", "key2"])
+        self.pool.minutes_left = {"key1": 1000, "key2": 100}
+        self.pool.fetched = dict.fromkeys(self.pool.licenses, time.monotonic())
+
+    def run_batch(self, input_path, stems):
+        lalalai_splitter.batch_process_multiple_stems(
+            self.pool, input_path, self.output_path, stems, [], 1, "phoenix"
+        )
+
+    def test_moves_to_another_key_when_minutes_run_out(self):
+        # key1 has the minutes for one split, so the second is refused
+        self.run_batch(self.input_path, ["vocals", "drum"])
+        self.assertEqual(self.pool.exhausted, {"key1"})
+        self.assertEqual(self.requests("upload"), 2)
+        for name in ("song_vocals.wav", "song_drum.wav"):
+            self.assertTrue(os.path.exists(os.path.join(self.output_path, name)))
+        self.assertEqual(self.pool.in_flight, {"key1": 0, "key2": 0})
+
+    def test_other_failures_are_raised_as_they_are(self):
+        with self.assertRaises(FileNotFoundError):
+            self.run_batch(self.path("missing.wav"), ["vocals"])
+        self.assertEqual(self.requests("get-limits"), 0)
+        self.assertEqual(self.pool.exhausted, set())
+
+    def test_refusal_with_minutes_left_is_raised(self):
+        self.api.fail_stems.add("vocals")
+        with self.assertRaisesRegex(RuntimeError, "Can't split vocals"):
+            self.run_batch(self.input_path, ["vocals"])
+        # the billing API was asked, but key1 isn't out of minutes
+        self.assertEqual(self.requests("get-limits"), 1)
+        self.assertEqual(self.pool.exhausted, set())
+
+    def test_license_refused(self):
+        license_refused = lalalai_splitter.license_refused
+        self.assertTrue(license_refused(lalalai_splitter.APIError("no minutes")))
+        self.assertTrue(license_refused(HTTPError("http://x/", 403, "", {}, None)))
+        self.assertFalse(license_refused(HTTPError("http://x/", 500, "", {}, None)))
+        self.assertFalse(license_refused(ConnectionResetError()))
+        self.assertFalse(license_refused(RuntimeError("1 of 1 stems failed")))
+        try:
+            raise RuntimeError("1 of 1 stems failed") from lalalai_splitter.APIError(
+                "no minutes"
+            )
+        except RuntimeError as e:
+            self.assertTrue(license_refused(e))
+
+
+@unittest.skipUnless(lalalai_splitter.lalalai_audio.numpy_available(), "needs NumPy")
+class SynthesizeBackingTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.input_path = self.path("song.wav")
+        with wave.open(self.input_path, "wb") as writer:
+            writer.setnchannels(2)
+            writer.setsampwidth(2)
+            writer.setframerate(44100)
+            writer.writeframes(random.Random(1).randbytes(4 * 44100))
+        self.output_path = self.path("out")
+        os.mkdir(self.output_path)
+
+    def run_split(self, synthesize_backing):
+        lalalai_splitter.batch_process_multiple_stems(
+            "key",
+            self.input_path,
+            self.output_path,
+            ["vocals"],
+            ["vocals"],
+            1,
+            "phoenix",
+            synthesize_backing=synthesize_backing,
+        )
+        return sorted(os.listdir(self.output_path))
+
+    def test_backing_track_is_made_locally(self):
+        self.assertIn("song_all_but_vocals.wav", self.run_split(True))
+        self.assertIn("backing_synthesized", self.event_names())
+        self.assertNotIn("download back_track", self.event_names())
+        self.assertEqual(self.requests("media"), 1)
+        # the mock's "stem" is the whole input, so the backing track is silent
+        back_path = os.path.join(self.output_path, "song_all_but_vocals.wav")
+        with wave.open(back_path, "rb") as reader:
+            self.assertEqual(reader.getnframes(), 44100)
+            self.assertEqual(reader.readframes(44100).count(0), 4 * 44100)
+
+    def test_downloaded_without_the_option(self):
+        self.assertIn("song_all_but_vocals.wav", self.run_split(False))
+        self.assertNotIn("backing_synthesized", self.event_names())
+        self.assertEqual(self.requests("media"), 2)
+
+
+@unittest.skipUnless(lalalai_splitter.lalalai_audio.numpy_available(), "needs NumPy")
+class TrimSilenceRunTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.input_path = self.path("song.wav")
+        self.audio = random.Random(1).randbytes(4 * 22050)
+        with wave.open(self.input_path, "wb") as writer:
+            writer.setnchannels(2)
+            writer.setsampwidth(2)
+            writer.setframerate(44100)
+            # a second of silence on each side of half a second of noise
+            writer.writeframes(bytes(4 * 44100) + self.audio + bytes(4 * 44100))
+        self.output_path = self.path("out")
+        os.mkdir(self.output_path)
+        self.journal = JobJournal(self.path("journal.sqlite3"))
+
+    def run_split(self, **kwargs):
+        lalalai_splitter.batch_process_multiple_stems(
+            "key",
+            self.input_path,
+            self.output_path,
+            ["vocals"],
+            [],
+            1,
+            "phoenix",
+            journal=self.journal,
+            **kwargs,
+        )
+
+    def track(self):
+        with wave.open(os.path.join(self.output_path, "song_vocals.wav")) as reader:
+            return reader.readframes(reader.getnframes())
+
+    def test_silence_isnt_uploaded(self):
+        self.run_split(trim_silence=True)
+        trimmed = [e for e in self.events if e.name == "silence_trimmed"]
+        self.assertEqual(len(trimmed), 1)
+        self.assertGreater(trimmed[0].fields["seconds"], 1.8)
+        ((filename, data),) = self.api.files.values()
+        self.assertLess(len(data), 4 * 44100)
+        # and the track is padded back out to the input
+        silence = bytes(4 * 44100)
+        self.assertEqual(self.track(), silence + self.audio + silence)
+        upload = self.journal.get_job(1)["upload"]
+        self.assertEqual(upload["trim"]["total_frames"], 2 * 44100 + 22050)
+
+    def test_resume_pads_as_journaled(self):
+        # an upload of the trimmed input, made before the job was interrupted
+        lalalai_audio = lalalai_splitter.lalalai_audio
+        trim = lalalai_audio.measure_silence(self.input_path)
+        lalalai_audio.write_trimmed(self.input_path, trim, self.path("t.wav"))
+        with open(self.path("t.wav"), "rb") as f:
+            file_id = self.api.upload("song.wav", f.read())
+        job_id = self.journal.create_job(
+            self.input_path, self.output_path, ["vocals"], [], 1, "phoenix"
+        )
+        self.journal.set_file_id(job_id, file_id, "key", {"trim": vars(trim)})
+
+        # the tracks are padded out though trim_silence isn't given again
+        lalalai_splitter.resume_job("key", self.journal, job_id)
+        self.assertEqual(self.requests("upload"), 0)
+        self.assertEqual(len(self.track()), 4 * (2 * 44100 + 22050))
+
+    def test_off_by_default(self):
+        self.run_split()
+        self.assertNotIn("silence_trimmed", self.event_names())
+        self.assertEqual(len(self.track()), 4 * (2 * 44100 + 22050))
+
+
+def fake_encode_flac(path, output_path, cancel=None):
+    """stands in for lalalai_audio.encode_flac, with gzip for FLAC"""
+    with open(path, "rb") as f, open(output_path, "wb") as out:
+        out.write(gzip.compress(f.read()))
+
+
+def fake_decode_flac(path, output_path, sample_width, cancel=None):
+    """stands in for lalalai_audio.decode_flac"""
+    with open(path, "rb") as f, open(output_path, "wb") as out:
+        out.write(gzip.decompress(f.read()))
+
+
+class CompressUploadsTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.input_path = self.path("song.wav")
+        with wave.open(self.input_path, "wb") as writer:
+            writer.setnchannels(2)
+            writer.setsampwidth(2)
+            writer.setframerate(44100)
+            writer.writeframes(bytes(4 * 44100))
+        with open(self.input_path, "rb") as f:
+            self.input_data = f.read()
+        self.output_path = self.path("out")
+        os.mkdir(self.output_path)
+        self.journal = JobJournal(self.path("journal.sqlite3"))
+        audio = lalalai_splitter.lalalai_audio
+        self.patch(audio, "flac_encoder", lambda: "/usr/bin/flac")
+        self.patch(audio, "encode_flac", fake_encode_flac)
+        self.patch(audio, "decode_flac", fake_decode_flac)
+
+    def run_split(self, compress_uploads=True):
+        lalalai_splitter.batch_process_multiple_stems(
+            "key",
+            self.input_path,
+            self.output_path,
+            ["vocals"],
+            ["vocals"],
+            1,
+            "phoenix",
+            journal=self.journal,
+            compress_uploads=compress_uploads,
+        )
+
+    def uploaded(self):
+        ((filename, data),) = self.api.files.values()
+        return filename, data
+
+    def assert_tracks_match_input(self):
+        self.assertEqual(
+            sorted(os.listdir(self.output_path)),
+            [".unmixer_manifest.json", "song_all_but_vocals.wav", "song_vocals.wav"],
+        )
+        for name in ("song_vocals.wav", "song_all_but_vocals.wav"):
+            with open(os.path.join(self.output_path, name), "rb") as f:
+                self.assertEqual(f.read(), self.input_data)
+
+    def test_uploaded_as_flac(self):
+        self.run_split()
+        filename, data = self.uploaded()
+        self.assertEqual(filename, "song.flac")
+        self.assertEqual(gzip.decompress(data), self.input_data)
+        self.assertIn("compressed", self.event_names())
+        self.assertIn("compression_saved", self.event_names())
+        self.assert_tracks_match_input()
+        upload = self.journal.get_job(1)["upload"]
+        self.assertEqual(upload["flac_sample_width"], 2)
+
+    def test_no_encoder(self):
+        self.patch(lalalai_splitter.lalalai_audio, "flac_encoder", lambda: None)
+        self.run_split()
+        self.assertEqual(self.uploaded(), ("song.wav", self.input_data))
+        self.assertNotIn("compressing", self.event_names())
+        self.assert_tracks_match_input()
+        self.assertIsNone(self.journal.get_job(1)["upload"]["flac_sample_width"])
+
+    def test_encoder_fails(self):
+        def fail(path, output_path, cancel=None):
+            raise RuntimeError("flac failed: bad input")
+
+        self.patch(lalalai_splitter.lalalai_audio, "encode_flac", fail)
+        self.run_split()
+        self.assertEqual(self.uploaded(), ("song.wav", self.input_data))
+        self.assertIn("compression_failed", self.event_names())
+        self.assert_tracks_match_input()
+        self.assertIsNone(self.journal.get_job(1)["upload"]["flac_sample_width"])
+
+    def test_not_pcm(self):
+        with open(self.input_path, "wb") as f:
+            f.write(b"ID3 an mp3")
+        self.run_split()
+        self.assertEqual(self.uploaded(), ("song.wav", b"ID3 an mp3"))
+        self.assertNotIn("compressing", self.event_names())
+
+    def test_off_by_default(self):
+        self.run_split(compress_uploads=False)
+        self.assertEqual(self.uploaded(), ("song.wav", self.input_data))
+
+    def test_resume_decodes_as_journaled(self):
+        file_id = self.api.upload("song.flac", gzip.compress(self.input_data))
+        job_id = self.journal.create_job(
+            self.input_path, self.output_path, ["vocals"], ["vocals"], 1, "phoenix"
+        )
+        self.journal.set_file_id(job_id, file_id, "key", {"flac_sample_width": 2})
+        lalalai_splitter.resume_job("key", self.journal, job_id)
+        self.assertEqual(self.requests("upload"), 0)
+        self.assert_tracks_match_input()
+
+
+@unittest.skipUnless(lalalai_splitter.lalalai_audio.numpy_available(), "needs NumPy")
+class SegmentedRunTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch(lalalai_splitter, "SEGMENT_OVERLAP_SECONDS", 0.25)
+        self.input_path = self.path("song.wav")
+        self.audio = random.Random(1).randbytes(4 * 3 * 44100)
+        with wave.open(self.input_path, "wb") as writer:
+            writer.setnchannels(2)
+            writer.setsampwidth(2)
+            writer.setframerate(44100)
+            writer.writeframes(self.audio)
+        self.output_path = self.path("out")
+        os.mkdir(self.output_path)
+        self.segments = lalalai_splitter.plan_input_segments(self.input_path, 1.0)
+
+    def run_split(self, segment_seconds):
+        lalalai_splitter.batch_process_multiple_stems(
+            "key",
+            self.input_path,
+            self.output_path,
+            ["vocals"],
+            ["vocals"],
+            1,
+            "phoenix",
+            segment_seconds=segment_seconds,
+        )
+
+    def test_segments_are_stitched(self):
+        self.run_split(1.0)
+        segmenting = [e for e in self.events if e.name == "segmenting"]
+        count = len(self.segments)
+        self.assertEqual(segmenting[0].fields["count"], count)
+        self.assertEqual(self.requests("upload"), count)
+        self.assertEqual(self.requests("split"), count)
+        uploaded = {e.fields["segment"] for e in self.events if e.name == "uploaded"}
+        self.assertEqual(uploaded, set(range(1, count + 1)))
+        self.assertEqual(self.event_names().count("first_segment"), 1)
+        self.assertEqual(self.event_names().count("stitched"), 2)
+        self.assertEqual(self.event_names()[-1], "unmixing_complete")
+
+        # the mock's tracks are the segments sent back, so they stitch
+        # back into the input, with the scratch directory cleared away
+        self.assertEqual(
+            sorted(os.listdir(self.output_path)),
+            [".unmixer_manifest.json", "song_all_but_vocals.wav", "song_vocals.wav"],
+        )
+        for name in ("song_vocals.wav", "song_all_but_vocals.wav"):
+            path = os.path.join(self.output_path, name)
+            with wave.open(path, "rb") as reader:
+                self.assertEqual(reader.readframes(reader.getnframes()), self.audio)
+
+    def test_stitched_tracks_are_skipped(self):
+        self.run_split(1.0)
+        self.api.reset_stats()
+        self.run_split(1.0)
+        self.assertEqual(self.requests("upload"), 0)
+        self.assertIn("already_extracted", self.event_names())
+
+    def test_short_input_isnt_segmented(self):
+        self.run_split(10.0)
+        self.assertNotIn("segmenting", self.event_names())
+        self.assertEqual(self.requests("upload"), 1)
+
+    def test_failed_segments_keep_scratch(self):
+        self.api.fail_stems.add("vocals")
+        count = len(self.segments)
+        with self.assertRaisesRegex(RuntimeError, f"{count} of {count} segments"):
+            self.run_split(1.0)
+        retries = count * lalalai_splitter.SEGMENT_RETRIES
+        self.assertEqual(self.event_names().count("segment_retry"), retries)
+        self.assertEqual(self.event_names().count("segment_failed"), count)
+        scratch = os.path.join(self.output_path, ".unmixer-segments-song.wav")
+        self.assertEqual(len(os.listdir(scratch)), count)
+
+
+class ProgressEventTest(unittest.TestCase):
+    def test_attributes(self):
+        fields = {"stem": "drum", "file_index": 2, "percent": 40, "segment": 1}
+        event = ProgressEvent("split_progress", fields)
+        self.assertEqual(event.name, "split_progress")
+        self.assertIs(event.fields, fields)
+        self.assertEqual((event.stem, event.file_index, event.segment), ("drum", 2, 1))
+        self.assertEqual((event.phase, event.percent), ("split", 40))
+        self.assertIsNone(event.track_type)
+        self.assertIsNone(event.bytes)
+        self.assertAlmostEqual(event.time, time.time(), delta=5)
+
+    def test_phase(self):
+        phases = {
+            "upload_progress": "upload",
+            "uploaded": "upload",
+            "compressing": "compress",
+            "split_complete": "split",
+            "download_start": "download",
+            "segment_retry": "segment",
+            "stitched": "stitch",
+            "unmixing_complete": None,
+        }
+        for name, phase in phases.items():
+            self.assertEqual(ProgressEvent(name, {}).phase, phase, name)
+
+
+class EventBusTest(unittest.TestCase):
+    def test_subscribe(self):
+        bus = EventBus()
+        first, second = [], []
+        bus.subscribe(first.append)
+        callback = bus.subscribe(second.append)
+        bus.publish("uploaded", {"file_id": "abc"})
+        bus.unsubscribe(callback)
+        bus.publish("split_start", {"stem": "vocals"})
+
+        self.assertEqual([e.name for e in first], ["uploaded", "split_start"])
+        self.assertEqual(first[0].fields, {"file_id": "abc"})
+        self.assertEqual([e.name for e in second], ["uploaded"])
+        # each subscriber gets the same event
+        self.assertIs(first[0], second[0])
+
+    def test_subscribe_queue(self):
+        bus = EventBus()
+        events = bus.subscribe_queue()
+        thread = threading.Thread(
+            target=bus.publish, args=("download_progress", {"bytes": 10})
+        )
+        thread.start()
+        thread.join()
+        event = events.get(timeout=1)
+        self.assertEqual((event.name, event.bytes), ("download_progress", 10))
+        bus.unsubscribe(events.put)
+        bus.publish("split_start", {})
+        self.assertTrue(events.empty())
+
+    def test_no_subscribers(self):
+        with mock.patch.object(lalalai_splitter, "ProgressEvent") as event_class:
+            EventBus().publish("uploaded", {})
+        event_class.assert_not_called()
+
+
+class ReportTest(MockAPITestCase):
+    def test_events_carry_segment_and_file(self):
+        def in_segment():
+            lalalai_splitter.current_file_index.set(3)
+            lalalai_splitter.current_segment.set(2)
+            lalalai_splitter.report("split_progress", stem="bass", percent=50)
+
+        contextvars.copy_context().run(in_segment)
+        lalalai_splitter.report("batch_complete")
+        first, second = self.events
+        self.assertEqual((first.file_index, first.segment), (3, 2))
+        self.assertEqual((first.stem, first.percent), ("bass", 50))
+        self.assertEqual(second.fields, {})
+
+    def test_progress_handler_too(self):
+        handled = []
+        self.patch(lalalai_splitter, "progress_handler", lambda *a: handled.append(a))
+        lalalai_splitter.report("uploaded", file_id="abc")
+        self.assertEqual(handled, [("uploaded", {"file_id": "abc"})])
+        self.assertEqual(self.event_names(), ["uploaded"])
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_counters(self):
+        self.metrics.add("unmixer_stems_total", outcome="complete")
+        self.metrics.add("unmixer_stems_total", outcome="complete")
+        self.metrics.add("unmixer_stems_total", outcome="failed")
+        self.assertEqual(
+            self.metrics.prometheus(),
+            "# TYPE unmixer_stems_total counter\n"
+            'unmixer_stems_total{outcome="complete"} 2\n'
+            'unmixer_stems_total{outcome="failed"} 1\n',
+        )
+
+    def test_histogram(self):
+        for seconds in (0.5, 3, 100):
+            self.metrics.observe("unmixer_phase_seconds", seconds, buckets=(1, 10))
+        self.assertEqual(
+            self.metrics.prometheus(),
+            "# TYPE unmixer_phase_seconds histogram\n"
+            'unmixer_phase_seconds_bucket{le="1"} 1\n'
+            'unmixer_phase_seconds_bucket{le="10"} 2\n'
+            'unmixer_phase_seconds_bucket{le="+Inf"} 3\n'
+            "unmixer_phase_seconds_sum 103.5\n"
+            "unmixer_phase_seconds_count 3\n",
+        )
+
+    def test_label_values_are_escaped(self):
+        self.metrics.add("unmixer_x", file='a "b"\\c\nd.wav')
+        self.assertIn(
+            'unmixer_x{file="a \\"b\\"\\\\c\\nd.wav"} 1', self.metrics.prometheus()
+        )
+        self.assertEqual(escape_label_value(3), "3")
+        self.assertEqual(escape_label_value("plain"), "plain")
+
+    def test_transfer(self):
+        self.metrics.observe_transfer("upload", 2.0, 1000, stem="vocals")
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(
+            snapshot["counters"],
+            [
+                {
+                    "name": "unmixer_bytes_total",
+                    "labels": {"phase": "upload"},
+                    "value": 1000,
+                }
+            ],
+        )
+        histograms = {h["name"]: h for h in snapshot["histograms"]}
+        self.assertEqual(histograms["unmixer_bytes_per_second"]["sum"], 500)
+        self.assertEqual(
+            histograms["unmixer_phase_seconds"]["labels"],
+            {"phase": "upload", "stem": "vocals"},
+        )
+
+    def test_write(self):
+        self.metrics.add("unmixer_x")
+        with tempfile.TemporaryDirectory() as tmp:
+            json_path = os.path.join(tmp, "metrics.json")
+            self.metrics.write(json_path)
+            with open(json_path) as f:
+                self.assertEqual(json.load(f)["counters"][0]["value"], 1)
+            prom_path = os.path.join(tmp, "metrics.prom")
+            self.metrics.write(prom_path)
+            with open(prom_path) as f:
+                self.assertEqual(f.read(), self.metrics.prometheus())
+            self.assertEqual(sorted(os.listdir(tmp)), ["metrics.json", "metrics.prom"])
+
+
+class RunMetricsTest(MockAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch(lalalai_splitter, "metrics", Metrics())
+        self.input_path = self.path("song.wav")
+        with open(self.input_path, "wb") as f:
+            f.write(b"some audio")
+
+    def test_run_is_measured(self):
+        lalalai_splitter.batch_process_multiple_stems(
+            "key", self.input_path, self.tmp, ["vocals"], ["vocals"], 1, "phoenix"
+        )
+        snapshot = lalalai_splitter.metrics.snapshot()
+        phases = {
+            h["labels"]["phase"]
+            for h in snapshot["histograms"]
+            if h["name"] == "unmixer_phase_seconds"
+        }
+        self.assertEqual(phases, {"upload", "queue", "split", "download"})
+        stems = [c for c in snapshot["counters"] if c["name"] == "unmixer_stems_total"]
+        self.assertEqual(stems[0]["labels"], {"outcome": "complete"})
+        self.assertEqual(stems[0]["value"], 1)
+        endpoints = {
+            c["labels"]["endpoint"]
+            for c in snapshot["counters"]
+            if c["name"] == "unmixer_http_requests_total"
+        }
+        self.assertEqual(endpoints, {"upload", "split", "check", "download"})
+
+
+class TracerTest(MockAPITestCase):
+    def trace_file(self, tracer):
+        lalalai_splitter.current_file_index.set(2)
+        with lalalai_splitter.trace_span("split", "vocals"):
+            pass
+        tracer.marker("split_progress", "vocals")
+
+    def load_trace(self, path):
+        with open(path) as f:
+            trace = json.load(f)
+        return trace["traceEvents"]
+
+    def test_tracks_and_spans(self):
+        trace_path = self.path("trace.json")
+        with lalalai_splitter.tracing(trace_path) as tracer:
+            with lalalai_splitter.trace_span("upload", "upload", path="a.wav"):
+                pass
+            contextvars.copy_context().run(self.trace_file, tracer)
+        self.assertIsNone(lalalai_splitter.tracer)
+
+        events = self.load_trace(trace_path)
+        names = {
+            (e["name"], e["pid"], e["tid"]): e["args"]["name"]
+            for e in events
+            if e["ph"] == "M"
+        }
+        self.assertEqual(
+            names,
+            {
+                ("process_name", 0, 0): "batch",
+                ("thread_name", 0, 1): "upload",
+                ("process_name", 2, 0): "file 2",
+                ("thread_name", 2, 3): "vocals",
+            },
+        )
+        upload, split, marker = [e for e in events if e["ph"] != "M"]
+        self.assertEqual(
+            (upload["name"], upload["pid"], upload["tid"]), ("upload", 0, 1)
+        )
+        self.assertEqual(upload["args"], {"path": "a.wav"})
+        self.assertGreaterEqual(upload["dur"], 0)
+        self.assertEqual((split["pid"], split["tid"]), (2, 3))
+        self.assertEqual((marker["name"], marker["ph"]), ("split_progress", "i"))
+        self.assertGreaterEqual(marker["ts"], split["ts"])
+
+    def test_segments_have_tracks_of_their_own(self):
+        tracer = lalalai_splitter.Tracer()
+        whole = tracer.track("vocals")
+
+        def in_segment():
+            lalalai_splitter.current_segment.set(1)
+            return tracer.track("vocals")
+
+        part = contextvars.copy_context().run(in_segment)
+        self.assertNotEqual(part, whole)
+        self.assertEqual(part, contextvars.copy_context().run(in_segment))
+        self.assertIn((0, "vocals part 1"), tracer.tracks)
+
+    def test_nested_tracing_writes_the_outer_trace(self):
+        with lalalai_splitter.tracing(self.path("outer.json")) as outer:
+            with lalalai_splitter.tracing(self.path("inner.json")) as inner:
+                self.assertIs(inner, outer)
+            self.assertIs(lalalai_splitter.tracer, outer)
+
+    def test_off_by_default(self):
+        with lalalai_splitter.trace_span("upload", "upload"):
+            pass
+        self.assertIsNone(lalalai_splitter.tracer)
+
+    def test_run_is_traced(self):
+        input_path = self.path("song.wav")
+        with open(input_path, "wb") as f:
+            f.write(b"some audio")
+        trace_path = self.path("trace.json")
+        lalalai_splitter.batch_process_multiple_stems(
+            "key",
+            input_path,
+            self.tmp,
+            ["vocals"],
+            ["vocals"],
+            1,
+            "phoenix",
+            trace_path=trace_path,
+        )
+        spans = {e["name"] for e in self.load_trace(trace_path) if e["ph"] == "X"}
+        self.assertLessEqual({"upload", "split", "download stem"}, spans)
+        markers = {e["name"] for e in self.load_trace(trace_path) if e["ph"] == "i"}
+        self.assertIn("unmixing_complete", markers)
+
+
+if __name__ == "__main__":
+    unittest.main()
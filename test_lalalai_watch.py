@@ -0,0 +1,327 @@
+"""
+Tests of lalalai_watch: its ledger of handled files, how the daemon picks
+out the files to split and waits for them to settle, its retrying of
+files that fail, and a run against the mock API.
+
+Run with `python -m pytest` or `python -m unittest`.
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import lalalai_splitter
+import lalalai_watch
+import mock_lalalai
+from lalalai_watch import FolderPreset, WatchDaemon, WatchLedger
+
+
+class WatchTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.folder = self.path("bounces")
+        os.mkdir(self.folder)
+        self.preset = FolderPreset(
+            self.folder, self.path("stems"), ["vocals"], [], 1, "phoenix"
+        )
+        self.ledger = WatchLedger(self.path("ledger.sqlite3"))
+        self.addCleanup(self.ledger.conn.close)
+        self.events = []
+        lalalai_splitter.event_bus.subscribe(self.events.append)
+        self.addCleanup(lalalai_splitter.event_bus.unsubscribe, self.events.append)
+        for name, value in (
+            ("progress_handler", None),
+            ("request_policy", lalalai_splitter.RequestPolicy()),
+        ):
+            patcher = mock.patch.object(lalalai_splitter, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(lalalai_watch, "SETTLE_CHECK_INTERVAL", 0.05)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def write(self, name, data=b"some audio"):
+        path = os.path.join(self.folder, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def daemon(self, **kwargs):
+        return WatchDaemon(
+            "key",
+            [self.preset],
+            self.ledger,
+            1,
+            lalalai_splitter.Scheduler(),
+            settle_seconds=0.2,
+            **kwargs,
+        )
+
+    def event_names(self):
+        return [event.name for event in self.events]
+
+    async def wait_for(self, condition, timeout=10):
+        """waits for `condition()` to be true, failing after `timeout`"""
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("timed out")
+            await asyncio.sleep(0.02)
+
+    def start(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.addAsyncCleanup(self.stop, task)
+        return task
+
+    async def stop(self, task):
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+class WatchLedgerTest(WatchTestCase):
+    def test_record(self):
+        path = self.write("song.wav")
+        key = self.ledger.key(path, os.stat(path))
+        self.assertFalse(self.ledger.is_handled(key))
+        self.ledger.record(key, "done")
+        self.assertTrue(self.ledger.is_handled(key))
+
+        # a replaced file is new
+        self.write("song.wav", b"another take")
+        self.assertFalse(self.ledger.is_handled(self.ledger.key(path, os.stat(path))))
+
+    def test_restart(self):
+        done_path, failed_path = self.write("a.wav"), self.write("b.wav")
+        done = self.ledger.key(done_path, os.stat(done_path))
+        failed = self.ledger.key(failed_path, os.stat(failed_path))
+        self.ledger.record(done, "done")
+        self.ledger.record(failed, "failed", "no minutes left")
+        self.assertTrue(self.ledger.is_handled(failed))
+
+        ledger = WatchLedger(self.path("ledger.sqlite3"))
+        self.addCleanup(ledger.conn.close)
+        self.assertTrue(ledger.is_handled(done))
+        # failures are only tried again after a restart
+        self.assertFalse(ledger.is_handled(failed))
+        rows = ledger.execute("SELECT status, message FROM watched_files")
+        self.assertIn(("failed", "no minutes left"), rows)
+
+
+class FolderPresetTest(WatchTestCase):
+    def test_from_config(self):
+        preset = FolderPreset.from_config(
+            {"path": self.folder, "stems": "vocals,drum", "filter": "mild"},
+            {"output": self.path("stems"), "stems": ["bass"]},
+        )
+        self.assertEqual(preset.stems, ["vocals", "drum"])
+        self.assertEqual(preset.backing_tracks, [])
+        self.assertEqual(preset.filter_type, 0)
+        self.assertEqual(preset.output, os.path.realpath(self.path("stems")))
+
+    def test_bad_presets(self):
+        defaults = {"output": self.path("stems"), "stems": ["vocals"]}
+        for entry in (
+            {},
+            {"path": self.path("missing")},
+            {"path": self.folder, "output": self.folder},
+            {"path": self.folder, "stems": []},
+            {"path": self.folder, "stems": ["kazoo"]},
+            {"path": self.folder, "filter": "harsh"},
+        ):
+            with self.assertRaises(ValueError, msg=entry):
+                FolderPreset.from_config(entry, defaults)
+
+
+class CandidateTest(WatchTestCase):
+    def test_audio_files(self):
+        daemon = self.daemon()
+        path = self.write("song.wav")
+        daemon.candidate(path)
+        preset, key, _ = daemon.pending[path]
+        self.assertIs(preset, self.preset)
+        self.assertEqual(key, self.ledger.key(path, os.stat(path)))
+
+    def test_others_are_ignored(self):
+        daemon = self.daemon()
+        os.mkdir(os.path.join(self.folder, "take.wav"))
+        elsewhere = self.path("song.wav")
+        with open(elsewhere, "wb") as f:
+            f.write(b"some audio")
+        for path in (
+            self.write(".song.wav"),
+            self.write("notes.txt"),
+            os.path.join(self.folder, "take.wav"),
+            os.path.join(self.folder, "missing.wav"),
+            elsewhere,
+        ):
+            daemon.candidate(path)
+        self.assertEqual(daemon.pending, {})
+
+    def test_handled_files_are_ignored(self):
+        daemon = self.daemon()
+        path = self.write("song.wav")
+        self.ledger.record(self.ledger.key(path, os.stat(path)), "done")
+        daemon.candidate(path)
+        self.assertEqual(daemon.pending, {})
+
+    def test_scan(self):
+        daemon = self.daemon()
+        paths = {self.write("a.wav"), self.write("b.mp3"), self.write("c.txt")}
+        daemon.scan()
+        self.assertEqual(set(daemon.pending), paths - {self.path("bounces/c.txt")})
+
+
+class SettleTest(WatchTestCase):
+    async def test_settled_files_are_queued(self):
+        daemon = self.daemon()
+        path = self.write("song.wav")
+        daemon.candidate(path)
+        start = time.monotonic()
+        self.start(daemon.settle())
+        queued_path, preset, key = await asyncio.wait_for(daemon.queue.get(), 5)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual((queued_path, preset), (path, self.preset))
+        self.assertIn(path, daemon.busy)
+        self.assertEqual(daemon.pending, {})
+        self.assertIn("file_settled", self.event_names())
+
+        # it isn't picked up again while it's being split
+        daemon.candidate(path)
+        self.assertEqual(daemon.pending, {})
+
+    async def test_growing_files_wait(self):
+        daemon = self.daemon()
+        path = self.write("song.wav", b"")
+        daemon.candidate(path)
+        self.start(daemon.settle())
+        data = b""
+        for _ in range(6):
+            data += b"more audio"
+            self.write("song.wav", data)
+            await asyncio.sleep(0.1)
+            self.assertTrue(daemon.queue.empty())
+        _, _, key = await asyncio.wait_for(daemon.queue.get(), 5)
+        self.assertEqual(key[1], len(data))
+
+    async def test_removed_files_are_dropped(self):
+        daemon = self.daemon()
+        path = self.write("song.wav")
+        daemon.candidate(path)
+        os.remove(path)
+        self.start(daemon.settle())
+        await self.wait_for(lambda: not daemon.pending)
+        self.assertTrue(daemon.queue.empty())
+
+
+class RetryTest(WatchTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(lalalai_watch, "RETRY_SECONDS", 0.1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_backoff(self):
+        daemon = self.daemon()
+        with mock.patch.object(lalalai_watch, "RETRY_MAX_SECONDS", 0.5):
+            delays = [daemon.retry_later("song.wav") for _ in range(5)]
+        self.assertEqual(delays, [0.1, 0.2, 0.4, 0.5, 0.5])
+        self.assertEqual(daemon.failures["song.wav"], 5)
+
+    async def test_failed_split_is_retried(self):
+        daemon = self.daemon()
+        calls = []
+
+        async def split(path, preset, key):
+            calls.append(time.monotonic())
+            if len(calls) < 3:
+                raise OSError("disk full")
+            self.ledger.record(key, "done")
+            daemon.failures.pop(path, None)
+
+        daemon.split = split
+        path = self.write("song.wav")
+        daemon.candidate(path)
+        self.start(daemon.settle())
+        self.start(daemon.work())
+        await self.wait_for(lambda: self.ledger.handled)
+
+        self.assertEqual(len(calls), 3)
+        # the second failure waits twice as long as the first
+        self.assertGreater(calls[2] - calls[1], calls[1] - calls[0] + 0.05)
+        failed = [e for e in self.events if e.name == "file_failed"]
+        self.assertEqual([e.fields["retry_seconds"] for e in failed], [0.1, 0.2])
+        self.assertEqual(failed[0].fields["message"], "disk full")
+        self.assertEqual((daemon.failures, daemon.retries), ({}, {}))
+
+    async def test_not_noticed_while_backing_off(self):
+        daemon = self.daemon()
+        path = self.write("song.wav")
+        daemon.retry_later(path)
+        daemon.candidate(path)
+        self.assertEqual(daemon.pending, {})
+
+    async def test_removed_file_is_forgotten(self):
+        daemon = self.daemon()
+        path = self.write("song.wav")
+        daemon.retry_later(path)
+        os.remove(path)
+        self.start(daemon.settle())
+        await self.wait_for(lambda: not daemon.retries)
+        self.assertEqual(daemon.failures, {})
+
+
+class WatchRunTest(WatchTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = mock_lalalai.start_mock_server(queue_delay=0, split_time=0.2)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        patcher = mock.patch.object(lalalai_splitter, "URL_API", self.server.url_api)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def run_daemon(self, use_inotify):
+        daemon = self.daemon(use_inotify=use_inotify)
+        before = self.write("before.wav")
+        self.start(daemon.run())
+        await self.wait_for(lambda: "watching" in self.event_names())
+        after = self.write("after.wav", b"another take")
+        await self.wait_for(lambda: len(self.ledger.handled) == 2)
+        self.assertEqual({key[0] for key in self.ledger.handled}, {before, after})
+        for name in ("before_vocals.wav", "after_vocals.wav"):
+            self.assertTrue(os.path.exists(os.path.join(self.preset.output, name)))
+        return daemon
+
+    @unittest.skipUnless(lalalai_watch.load_inotify(), "needs inotify")
+    async def test_inotify(self):
+        await self.run_daemon(True)
+        watching = [e for e in self.events if e.name == "watching"]
+        self.assertEqual(watching[0].fields["method"], "inotify")
+
+    async def test_polling(self):
+        with mock.patch.object(lalalai_watch, "POLL_INTERVAL", 0.1):
+            await self.run_daemon(False)
+        watching = [e for e in self.events if e.name == "watching"]
+        self.assertEqual(watching[0].fields["method"], "polling")
+
+    async def test_failures_are_recorded(self):
+        self.server.api.fail_stems.add("vocals")
+        daemon = self.daemon()
+        self.write("song.wav")
+        self.start(daemon.run())
+        await self.wait_for(lambda: self.ledger.handled)
+        rows = self.ledger.execute("SELECT status FROM watched_files")
+        self.assertEqual(rows, [("failed",)])
+        self.assertEqual(daemon.retries, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
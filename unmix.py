@@ -1,3 +1,4 @@
+import collections
 import os
 import queue
 import sqlite3
@@ -13,10 +14,27 @@ import lalalai_splitter
 create_console = True
 hide_api_key = False
 
+# the job journal lives in its own database beside the key-value store
+journal_file = os.path.expanduser("~/.unmixer_jobs.sqlite3")
+
 
 # Create a global queue for the threads to write their output to
 output_queue = queue.Queue()
 
+# how often, in milliseconds, the GUI takes in progress events and
+# refreshes the status lines
+PROGRESS_TICK_MS = 100
+
+# the debug console keeps the last CONSOLE_MAX_LINES lines, unless the
+# "console_max_lines" setting says otherwise, and takes in what was
+# written every CONSOLE_TICK_MS milliseconds
+CONSOLE_MAX_LINES = 5000
+CONSOLE_TICK_MS = 100
+
+# the severities of the console's lines, least severe first: what was
+# written to stdout, and to stderr
+SEVERITIES = ("info", "error")
+
 
 class IORedirector(object):
     def __init__(self, text_area):
@@ -26,52 +44,172 @@ class IORedirector(object):
 class QueuedOutputRedirector(IORedirector):
     """A general class for redirecting I/O a python queue."""
 
+    def __init__(self, text_area, severity="info"):
+        super().__init__(text_area)
+        self.severity = severity
+
     def write(self, str):
         # Write output to the queue instead of directly to the text area
-        output_queue.put(str)
+        output_queue.put((self.severity, str))
 
     def flush(self):
         # fake flush because we're not actually buffering anything
         pass
 
 
-def create_console(tk, gui):
-    """Create a console widget that will display stdout and stderr
-    of this app including its child threads."""
-    global console_widget
+class DebugConsole:
+    """
+    The debug console window, showing what the app and its threads write
+    to stdout and stderr.  Only the last `max_lines` lines are kept, in a
+    ring buffer, and only they are shown, so memory stays flat however
+    long the app runs.  Each tick takes in everything written since the
+    last one and renders it with a single insert, showing only the lines
+    at or above the chosen severity.  If a log file is set, every line is
+    appended to it as well, so the full log is kept on disk.
+    """
 
-    root = tk.Tk()
-    root.title("Unmix Debug Console")
-    console_widget = tk.Text(root, wrap="word")
-    console_widget.pack(expand=True, fill="both")
+    def __init__(self, root, max_lines=CONSOLE_MAX_LINES, log_path=None):
+        self.root = root
+        self.lines = collections.deque(maxlen=max_lines)
+        self.partial = {severity: "" for severity in SEVERITIES}
+        self.log_path = log_path
+        self.min_severity = tk.StringVar(root, value=SEVERITIES[0])
+        self.max_lines = tk.StringVar(root, value=str(max_lines))
+
+        controls = tk.Frame(root)
+        controls.pack(fill="x")
+        tk.Label(controls, text="Show").pack(side="left")
+        tk.OptionMenu(
+            controls,
+            self.min_severity,
+            *SEVERITIES,
+            command=lambda severity: self.render_all(),
+        ).pack(side="left")
+        tk.Label(controls, text="Lines").pack(side="left")
+        spinbox = tk.Spinbox(
+            controls,
+            from_=100,
+            to=1000000,
+            increment=1000,
+            width=8,
+            textvariable=self.max_lines,
+            command=self.set_max_lines,
+        )
+        spinbox.bind("<Return>", lambda event: self.set_max_lines())
+        spinbox.pack(side="left")
+        tk.Button(controls, text="Log to File...", command=self.set_log_file).pack(
+            side="left"
+        )
+        self.log_label = tk.Label(controls, text=log_path or "")
+        self.log_label.pack(side="left")
+
+        self.text = tk.Text(root, wrap="word")
+        self.text.pack(expand=True, fill="both")
+        self.text.tag_configure("error", foreground="red")
+
+        root.after(CONSOLE_TICK_MS, self.tick)
+
+    def tick(self):
+        """take in and render everything written since the last tick"""
+        self.root.after(CONSOLE_TICK_MS, self.tick)
+
+        # writes don't line up with lines, so each stream's unfinished
+        # last line waits for the rest of it
+        new_lines = []
+        while True:
+            try:
+                severity, text = output_queue.get_nowait()
+            except queue.Empty:
+                break
+            text = self.partial[severity] + text
+            *complete, self.partial[severity] = text.split("\n")
+            new_lines.extend((severity, line) for line in complete)
+        if not new_lines:
+            return
 
-    sys.stdout = QueuedOutputRedirector(console_widget)
-    sys.stderr = QueuedOutputRedirector(console_widget)
+        if self.log_path is not None:
+            self.spill(new_lines)
+        self.lines.extend(new_lines)
+        self.render(new_lines[-self.lines.maxlen :])
+
+    def shown(self, lines):
+        """the `lines` at or above the chosen severity"""
+        threshold = SEVERITIES.index(self.min_severity.get())
+        return [
+            (severity, line)
+            for severity, line in lines
+            if SEVERITIES.index(severity) >= threshold
+        ]
 
-    # Schedule the first call to the function that checks the queue
-    root.after(100, check_output_queue, gui)
+    def render(self, lines):
+        """append `lines` to the widget in one insert, then trim it"""
+        lines = self.shown(lines)
+        if not lines:
+            return
+        # only follow the output if the view was already at the end of it
+        at_end = self.text.yview()[1] >= 1.0
+        chunks = []
+        for severity, line in lines:
+            chunks.extend((line + "\n", severity))
+        self.text.insert("end", *chunks)
+
+        excess = int(self.text.index("end-1c").split(".")[0]) - 1 - self.lines.maxlen
+        if excess > 0:
+            self.text.delete("1.0", f"{excess + 1}.0")
+        if at_end:
+            self.text.see("end")
+
+    def render_all(self):
+        """render the whole ring buffer afresh, as after a setting changes"""
+        self.text.delete("1.0", "end")
+        self.render(self.lines)
+
+    def set_max_lines(self):
+        try:
+            max_lines = max(1, int(self.max_lines.get()))
+        except ValueError:
+            return
+        self.lines = collections.deque(self.lines, maxlen=max_lines)
+        store.set("console_max_lines", str(max_lines))
+        self.render_all()
+
+    def set_log_file(self):
+        """choose a file to append the full log to, or cancel to stop"""
+        path = filedialog.asksaveasfilename(
+            title="Log Console to File", defaultextension=".log"
+        )
+        self.log_path = path or None
+        store.set("console_log", self.log_path or "")
+        self.log_label.config(text=self.log_path or "")
 
-    return console_widget
+    def spill(self, lines):
+        """append `lines` to the log file"""
+        try:
+            with open(self.log_path, "a") as f:
+                f.write("".join(f"{line}\n" for _, line in lines))
+        except OSError as e:
+            self.log_path = None
+            self.log_label.config(text="")
+            print(f"stopped logging console to file: {e}", file=sys.stderr)
 
 
-def check_output_queue(gui):
-    # Schedule the next call to this function
-    console_widget.after(100, check_output_queue, gui)
+def create_console(tk, gui):
+    """Create a console widget that will display stdout and stderr
+    of this app including its child threads."""
+    global console
 
-    # Check if there's something in the queue
-    while not output_queue.empty():
-        # If there is, write it to the text widget
-        message = output_queue.get()
-        console_widget.insert("end", message)
+    root = tk.Tk()
+    root.title("Unmix Debug Console")
+    console = DebugConsole(
+        root,
+        int(store.get("console_max_lines") or CONSOLE_MAX_LINES),
+        store.get("console_log") or None,
+    )
 
-        try:
-            if message.startswith("%"):
-                handle_progress_message(gui, message)
-        except Exception as e:
-            console_widget.insert(f"exception handling progress message: {e}")
-            console.widget.insert(traceback.format_exc())
+    sys.stdout = QueuedOutputRedirector(console.text)
+    sys.stderr = QueuedOutputRedirector(console.text, "error")
 
-        console_widget.see("end")
+    return console.text
 
 
 class UnmixGUI:
@@ -95,11 +233,29 @@ class UnmixGUI:
         self.tk_output_dir = tk.StringVar()
         self.overall_status = tk.StringVar()
         self.status_messages = {}
+        self.dashboard = JobDashboard()
 
         store = KeyValueStore(os.path.expanduser("~/.unmixer.sqlite3"))
 
         self.tk_input_file = tk.StringVar()
-        self.input_file = None
+        self.input_files = []
+
+        # whether runs write a Chrome trace into the output directory,
+        # whether backing tracks are made locally rather than downloaded and
+        # whether silence is trimmed off inputs and uncompressed ones are
+        # compressed before they're uploaded, and whether long inputs are
+        # processed in segments
+        self.save_trace = tk.BooleanVar(value=store.get("save_trace") == "1")
+        self.synthesize_backing = tk.BooleanVar(
+            value=store.get("synthesize_backing") == "1"
+        )
+        self.trim_silence = tk.BooleanVar(value=store.get("trim_silence") == "1")
+        self.compress_uploads = tk.BooleanVar(
+            value=store.get("compress_uploads") == "1"
+        )
+        self.segment_long_files = tk.BooleanVar(
+            value=store.get("segment_long_files") == "1"
+        )
 
         # Get output directory or set to default
         self.output_dir = store.get("output_dir")
@@ -235,8 +391,13 @@ class UnmixGUI:
         tk.Entry(self.frame2, textvariable=self.tk_input_file, width=16).grid(
             row=next_row, column=1, sticky="we"
         )
-        tk.Button(self.frame2, text="Pick", command=self.set_input_file).grid(
-            row=next_row, column=2
+        input_buttons = tk.Frame(self.frame2)
+        input_buttons.grid(row=next_row, column=2)
+        tk.Button(input_buttons, text="Pick", command=self.set_input_file).pack(
+            side="left"
+        )
+        tk.Button(input_buttons, text="Folder", command=self.set_input_folder).pack(
+            side="left"
         )
         next_row += 1
 
@@ -252,9 +413,47 @@ class UnmixGUI:
         )
         next_row += 1
 
-        tk.Button(self.root, text="Run", command=self.run_program).grid(
-            row=next_row, column=0, columnspan=2
+        self.buttons = tk.Frame(self.root)
+        self.buttons.grid(row=next_row, column=0, columnspan=2)
+        tk.Button(self.buttons, text="Run", command=self.run_program).pack(
+            side="left"
         )
+        tk.Button(self.buttons, text="Resume", command=self.resume_program).pack(
+            side="left"
+        )
+        tk.Button(
+            self.buttons, text="Jobs", command=lambda: self.dashboard.show(self.root)
+        ).pack(side="left")
+        tk.Checkbutton(
+            self.buttons,
+            text="Save Trace",
+            variable=self.save_trace,
+            command=self.set_save_trace,
+        ).pack(side="left")
+        tk.Checkbutton(
+            self.buttons,
+            text="Local Backing Tracks",
+            variable=self.synthesize_backing,
+            command=self.set_synthesize_backing,
+        ).pack(side="left")
+        tk.Checkbutton(
+            self.buttons,
+            text="Trim Silence",
+            variable=self.trim_silence,
+            command=self.set_trim_silence,
+        ).pack(side="left")
+        tk.Checkbutton(
+            self.buttons,
+            text="Compress Uploads",
+            variable=self.compress_uploads,
+            command=self.set_compress_uploads,
+        ).pack(side="left")
+        tk.Checkbutton(
+            self.buttons,
+            text="Segment Long Files",
+            variable=self.segment_long_files,
+            command=self.set_segment_long_files,
+        ).pack(side="left")
         next_row += 1
 
         self.reset_defaults()
@@ -264,6 +463,12 @@ class UnmixGUI:
         else:
             self.api_key.set(self.fetch_api_key())
 
+        # progress comes from lalalai_splitter as events rather than as
+        # lines printed to the console, which is left for logging
+        lalalai_splitter.progress_handler = None
+        self.progress_events = lalalai_splitter.event_bus.subscribe_queue()
+        self.root.after(PROGRESS_TICK_MS, self.check_progress_events)
+
         # Grid column configurations for frame1
         self.frame1.grid_columnconfigure(0, weight=0)  # Column 0 not resizable
         self.frame1.grid_columnconfigure(1, weight=0)  # Column 1 not resizable
@@ -301,6 +506,27 @@ class UnmixGUI:
 
         self.tk_output_dir.set(store.get("output_dir"))
 
+    def check_progress_events(self):
+        """apply the progress events since the last tick in one refresh"""
+        self.root.after(PROGRESS_TICK_MS, self.check_progress_events)
+        status = CoalescedStatus()
+        while True:
+            try:
+                event = self.progress_events.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                handle_progress_event(status, event)
+                self.dashboard.handle(event)
+            except Exception as e:
+                print(f"exception handling progress event {event!r}: {e}")
+                traceback.print_exc()
+            # when the GUI caught up with the event, on a track of its own
+            if lalalai_splitter.tracer is not None:
+                lalalai_splitter.tracer.marker(event.name, "GUI")
+        status.apply(self)
+        self.dashboard.refresh()
+
     def set_stem_status(self, stem, message):
         self.status_messages[stem].set(message)
 
@@ -311,15 +537,22 @@ class UnmixGUI:
         for stem in self.status_messages:
             self.status_messages[stem].set("")
         self.overall_status.set("")
+        self.dashboard.clear()
 
     def save_api_key(self):
-        key = self.api_key.get().strip()
-        if len(key) != 16 or not all(c in "0123456789abcdefABCDEF" for c in key):
-            messagebox.showerror(
-                "Invalid API Key", "API Key must be 16 hexadecimal characters"
-            )
-            return
-        store.set("api_key", key)
+        # several keys can be given, separated by commas or spaces, to
+        # share the work among their accounts
+        keys = self.api_key.get().replace(",", " ").split()
+        for key in keys:
+            if len(key) != 16 or not all(c in "0123456789abcdefABCDEF" for c in key):
+                messagebox.showerror(
+                    "Invalid API Key",
+                    "Each API Key must be 16 hexadecimal characters, "
+                    "with several separated by commas",
+                )
+                return
+        self.api_key.set(",".join(keys))
+        store.set("api_key", ",".join(keys))
 
     def fetch_api_key(self):
         api_key = store.get("api_key")
@@ -327,6 +560,23 @@ class UnmixGUI:
             api_key = ""
         return api_key
 
+    def set_save_trace(self):
+        store.set("save_trace", "1" if self.save_trace.get() else "0")
+
+    def set_synthesize_backing(self):
+        store.set("synthesize_backing", "1" if self.synthesize_backing.get() else "0")
+
+    def set_trim_silence(self):
+        store.set("trim_silence", "1" if self.trim_silence.get() else "0")
+
+    def set_compress_uploads(self):
+        store.set("compress_uploads", "1" if self.compress_uploads.get() else "0")
+
+    def set_segment_long_files(self):
+        store.set(
+            "segment_long_files", "1" if self.segment_long_files.get() else "0"
+        )
+
     def set_output_dir(self):
         self.output_dir = filedialog.askdirectory()
         if self.output_dir:
@@ -334,8 +584,21 @@ class UnmixGUI:
             self.tk_output_dir.set(self.output_dir)
 
     def set_input_file(self):
-        self.input_file = filedialog.askopenfilename()
-        self.tk_input_file.set(self.input_file if self.input_file else "")
+        self.show_input_files(list(filedialog.askopenfilenames()))
+
+    def set_input_folder(self):
+        folder = filedialog.askdirectory()
+        if folder:
+            self.show_input_files(lalalai_splitter.collect_input_files([folder]))
+
+    def show_input_files(self, input_files):
+        self.input_files = input_files
+        if len(input_files) == 1:
+            self.tk_input_file.set(input_files[0])
+        elif len(input_files) > 1:
+            self.tk_input_file.set(f"{len(input_files)} files")
+        else:
+            self.tk_input_file.set("")
 
     def run_program(self):
         self.clear_all_statuses()
@@ -352,13 +615,16 @@ class UnmixGUI:
             messagebox.showerror("No API Key", "Please set an API Key")
             return
 
-        if not self.input_file or self.input_file == "":
+        if len(self.input_files) == 0:
             messagebox.showerror("No Input File", "Please select an input file")
             return
 
-        if not os.path.isfile(self.input_file):
-            messagebox.showerror("No Input File", "Input file doesn't exist.")
-            return
+        for input_file in self.input_files:
+            if not os.path.isfile(input_file):
+                messagebox.showerror(
+                    "No Input File", f"Input file {input_file} doesn't exist."
+                )
+                return
 
         if len(stems) == 0 and len(backing_tracks) == 0:
             messagebox.showerror(
@@ -375,7 +641,7 @@ class UnmixGUI:
         # print("Filter: ", which_filter)
         # print("Splitter: ", splitter)
         run_lalal_in_thread(
-            input_file=self.input_file,
+            input_files=self.input_files,
             stems=stems,
             backing_tracks=backing_tracks,
             which_filter=which_filter,
@@ -383,49 +649,135 @@ class UnmixGUI:
         )
         # self.root.quit()
 
+    def resume_program(self):
+        journal = lalalai_splitter.JobJournal(journal_file)
+        job_ids = journal.unfinished_jobs()
+        if len(job_ids) == 0:
+            messagebox.showinfo("Nothing to Resume", "There are no unfinished jobs.")
+            return
+
+        self.clear_all_statuses()
+        self.progressbar.start()
+        resume_lalal_in_thread(job_ids)
+
 
-def run_lalal_in_thread(input_file, stems, backing_tracks, which_filter, splitter):
+def run_lalal_in_thread(input_files, stems, backing_tracks, which_filter, splitter):
     """Run lalalai extractor in a separate thread so that the GUI doesn't block."""
     print("running lalal in thread")
     t = threading.Thread(
         target=run_trapping_lalal,
-        args=(input_file, stems, backing_tracks, which_filter, splitter),
+        args=(input_files, stems, backing_tracks, which_filter, splitter),
     )
     t.daemon = True
     t.start()
     print("lalal thread started")
 
 
-def run_trapping_lalal(input_file, stems, backing_tracks, which_filter, splitter):
+def run_trapping_lalal(input_files, stems, backing_tracks, which_filter, splitter):
     """Invoke run_lalalai but trap any exceptions that occur and report them."""
     print("run_trapping_lalal is running in a thread")
     try:
-        run_lalal(input_file, stems, backing_tracks, which_filter, splitter)
+        run_lalal(input_files, stems, backing_tracks, which_filter, splitter)
     except Exception as e:
         print(f"exception in thread: {e}")
         traceback.print_exc()
     print("run_trapping_lalal has finished")
 
 
-def run_lalal(input_file, stems, backing_tracks, which_filter, splitter):
+def resume_lalal_in_thread(job_ids):
+    """Resume unfinished jobs in a separate thread so that the GUI doesn't block."""
+    t = threading.Thread(target=run_trapping_resume, args=(job_ids,))
+    t.daemon = True
+    t.start()
+
+
+def run_trapping_resume(job_ids):
+    """Resume each unfinished job in turn, trapping and reporting exceptions."""
+    thread_store = KeyValueStore(store.db_file)
+    api_key = license_from_store(thread_store)
+    journal = lalalai_splitter.JobJournal(journal_file)
+    upload_cache = lalalai_splitter.UploadCache(store.db_file)
+
+    for job_id in job_ids:
+        print(f"resuming job {job_id}")
+        try:
+            lalalai_splitter.resume_job(
+                api_key, journal, job_id, upload_cache=upload_cache
+            )
+        except Exception as e:
+            print(f"exception resuming job {job_id}: {e}")
+            traceback.print_exc()
+
+
+def license_from_store(thread_store):
+    """Return the saved API key, or a pool of them if several are saved."""
+    keys = (thread_store.get("api_key") or "").split(",")
+    if len(keys) > 1:
+        return lalalai_splitter.LicensePool(keys)
+    return keys[0]
+
+
+def run_lalal(input_files, stems, backing_tracks, which_filter, splitter):
     # the thread needs its own KeyValueStore object so that it
     # has its own connection to the database as SQLite doesn't
     # allow multiple threads to use the same connection
     thread_store = KeyValueStore(store.db_file)
 
-    api_key = thread_store.get("api_key")
+    api_key = license_from_store(thread_store)
 
     output_dir = thread_store.get("output_dir")
     os.makedirs(output_dir, exist_ok=True)
 
+    # uploads are cached in the same database, and for the same reason
+    # the cache needs a connection of its own
+    upload_cache = lalalai_splitter.UploadCache(store.db_file)
+    journal = lalalai_splitter.JobJournal(journal_file)
+
+    # a timeline of the run, for chrome://tracing or Perfetto
+    trace_path = None
+    if thread_store.get("save_trace") == "1":
+        trace_path = os.path.join(output_dir, "unmixer_trace.json")
+    synthesize_backing = thread_store.get("synthesize_backing") == "1"
+    trim_silence = thread_store.get("trim_silence") == "1"
+    compress_uploads = thread_store.get("compress_uploads") == "1"
+    segment_seconds = None
+    if thread_store.get("segment_long_files") == "1":
+        segment_seconds = lalalai_splitter.DEFAULT_SEGMENT_SECONDS
+
+    if len(input_files) > 1:
+        lalalai_splitter.batch_process_multiple_files(
+            api_key,
+            input_files,
+            output_dir,
+            stems,
+            backing_tracks,
+            which_filter,
+            splitter,
+            upload_cache=upload_cache,
+            journal=journal,
+            trace_path=trace_path,
+            synthesize_backing=synthesize_backing,
+            trim_silence=trim_silence,
+            compress_uploads=compress_uploads,
+            segment_seconds=segment_seconds,
+        )
+        return
+
     lalalai_splitter.batch_process_multiple_stems(
         api_key,
-        input_file,
+        input_files[0],
         output_dir,
         stems,
         backing_tracks,
         which_filter,
         splitter,
+        upload_cache=upload_cache,
+        journal=journal,
+        trace_path=trace_path,
+        synthesize_backing=synthesize_backing,
+        trim_silence=trim_silence,
+        compress_uploads=compress_uploads,
+        segment_seconds=segment_seconds,
     )
 
 
@@ -475,41 +827,381 @@ class KeyValueStore:
         self.conn.commit()
 
 
-def handle_progress_message(gui, message):
-    """Handle a progress message from lalalai_splitter."""
-    msg = message.split()
-    match msg[0]:
-        case "%uploading":
-            gui.set_overall_status("Uploading...")
-            return
-        case "%uploaded":
-            gui.set_overall_status("Upload complete.")
-            return
-        case "%split_start":
-            gui.set_stem_status(msg[1], "Splitting requested...")
-            gui.set_overall_status("Processing...")
-            return
-        case "%split_waiting":
-            gui.set_stem_status(msg[1], "Waiting for split to start...")
-            return
-        case "%split_progress":
-            gui.set_stem_status(msg[1], f"Splitting: {msg[2]}")
-            return
-        case "%download_start":
-            gui.set_stem_status(msg[2], f"Downloading {msg[1]}...")
+class CoalescedStatus:
+    """
+    The status changes from one tick's worth of progress events, keeping
+    only the last message for each stem and for the overall status, so
+    that the GUI is refreshed once per tick however many events came in.
+    """
+
+    __slots__ = ("stems", "overall", "finished")
+
+    def __init__(self):
+        self.stems = {}
+        self.overall = None
+        self.finished = False
+
+    def set_stem_status(self, stem, message):
+        self.stems[stem] = message
+
+    def set_overall_status(self, message):
+        self.overall = message
+
+    def finish(self):
+        """stop the progress bar once the changes are applied"""
+        self.finished = True
+
+    def apply(self, gui):
+        for stem, message in self.stems.items():
+            gui.set_stem_status(stem, message)
+        if self.overall is not None:
+            gui.set_overall_status(self.overall)
+        if self.finished:
+            gui.progressbar.stop()
+
+
+def field(event, name):
+    """formats a field of a progress event the way the status lines show it"""
+    return lalalai_splitter.format_progress_field(name, event.fields.get(name))
+
+
+def format_duration(seconds):
+    """formats a duration for the dashboard, such as 1h02m, 3m05s or 42s"""
+    seconds = round(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class JobDashboard:
+    """
+    A table of every file of the run, each with a row per stem under it,
+    showing the phase each is in, how far along it is, the estimated
+    time left in the phase, the transfer rate and the latest event.
+
+    Progress events only update the table's model; `refresh`, called
+    once per tick, writes just the cells that changed since the last
+    refresh to the `ttk.Treeview`, which draws only the rows in view, so
+    hundreds of rows stay responsive.  The table has a window of its
+    own, opened with `show`, and is kept up to date whether it's open or
+    not.
+    """
+
+    COLUMNS = ("phase", "percent", "eta", "rate", "status")
+    HEADINGS = ("Phase", "Done", "ETA", "Rate", "Status")
+
+    # the events after which a file or stem has nothing more to do
+    DONE_EVENTS = ("split_complete", "already_extracted", "unmixing_complete")
+
+    # and besides the "..._complete" ones, those that finish a phase
+    FINISHED_EVENTS = ("uploaded", "upload_cached", "already_extracted")
+
+    def __init__(self):
+        self.window = None
+        self.tree = None
+        self.clear()
+
+    def clear(self):
+        """forget every row, as at the start of a run"""
+        # each row's label, values and parent by item ID, in the order
+        # they were added, when its phase started, and which rows changed
+        # since the last refresh and what the tree shows for the rest
+        self.labels = {}
+        self.values = {}
+        self.parents = {}
+        self.phase_started = {}
+        self.dirty = set()
+        self.rendered = {}
+        if self.tree is not None:
+            self.tree.delete(*self.tree.get_children())
+
+    def row(self, file_index, stem=None):
+        """the item ID of a file's row, or its stem's, adding it if it's new"""
+        iid = f"file{file_index or 0}"
+        if iid not in self.values:
+            self.add_row(iid, "", f"file {file_index}" if file_index else "input")
+        if stem is None:
+            return iid
+        parent, iid = iid, f"{iid}/{stem}"
+        if iid not in self.values:
+            self.add_row(iid, parent, stem)
+        return iid
+
+    def add_row(self, iid, parent, label):
+        self.labels[iid] = label
+        self.values[iid] = dict.fromkeys(self.COLUMNS, "")
+        self.parents[iid] = parent
+        self.dirty.add(iid)
+
+    def update(self, iid, **values):
+        row = self.values[iid]
+        for column, value in values.items():
+            if row[column] != value:
+                row[column] = value
+                self.dirty.add(iid)
+
+    def handle(self, event):
+        """update the model with a progress event"""
+        # events that aren't about a file, a stem or a phase of either,
+        # such as the API being paused, are about the whole batch
+        if (
+            event.file_index is None
+            and event.stem is None
+            and event.phase is None
+            and event.name != "unmixing_complete"
+        ):
             return
-        case "%download_complete":
-            gui.set_stem_status(msg[2], f"{msg[1]} downloading complete.")
+        if event.segment is not None and event.name == "unmixing_complete":
             return
-        case "%split_complete":
-            gui.set_stem_status(msg[1], "Split and download complete.")
+        iid = self.row(event.file_index, event.stem)
+
+        path = event.fields.get("path")
+        if event.stem is None and path and event.name in ("file_start", "uploading"):
+            if self.labels[iid] != os.path.basename(path):
+                self.labels[iid] = os.path.basename(path)
+                self.dirty.add(iid)
+
+        status = event.name.replace("_", " ")
+        if "message" in event.fields:
+            status += f": {event.fields['message']}"
+
+        phase = event.phase
+        if event.name in self.DONE_EVENTS:
+            phase = "done"
+        elif phase is not None:
+            if event.track_type is not None:
+                phase += f" {event.track_type}"
+            if event.segment is not None:
+                phase += f" (part {event.segment})"
+        if phase is not None:
+            if self.values[iid]["phase"] != phase:
+                self.phase_started[iid] = event.time
+                self.update(iid, phase=phase, percent="", eta="", rate="")
+
+        values = {"status": status}
+        percent = event.percent
+        if event.name.endswith("complete") or event.name in self.FINISHED_EVENTS:
+            percent = 100
+        if percent is not None:
+            values["percent"] = f"{percent}%"
+            elapsed = event.time - self.phase_started.get(iid, event.time)
+            values["eta"] = ""
+            if 0 < percent < 100:
+                values["eta"] = format_duration(elapsed * (100 - percent) / percent)
+        if "bytes_per_second" in event.fields:
+            values["rate"] = field(event, "bytes_per_second")
+        self.update(iid, **values)
+
+    def show(self, root):
+        """open the dashboard's window, or raise it if it's open"""
+        if self.window is not None:
+            self.window.lift()
             return
-        case "%unmixing_complete":
-            gui.set_overall_status("All Done.")
-            gui.progressbar.stop()
+        self.window = tk.Toplevel(root)
+        self.window.title("Unmixer Jobs")
+        self.window.protocol("WM_DELETE_WINDOW", self.hide)
+
+        self.tree = ttk.Treeview(self.window, columns=self.COLUMNS, height=20)
+        self.tree.heading("#0", text="File / Stem")
+        self.tree.column("#0", width=220)
+        for column, heading in zip(self.COLUMNS, self.HEADINGS):
+            self.tree.heading(column, text=heading)
+            self.tree.column(column, width=80, anchor="e")
+        self.tree.column("phase", width=160, anchor="w")
+        self.tree.column("status", width=260, anchor="w")
+        scrollbar = ttk.Scrollbar(
+            self.window, orient="vertical", command=self.tree.yview
+        )
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side="left", expand=True, fill="both")
+        scrollbar.pack(side="right", fill="y")
+
+        # everything has to be drawn afresh
+        self.rendered = {}
+        self.dirty = set(self.values)
+        self.refresh()
+
+    def hide(self):
+        self.window.destroy()
+        self.window = None
+        self.tree = None
+
+    def refresh(self):
+        """write the rows that changed since the last refresh to the tree"""
+        if self.tree is None or not self.dirty:
             return
+        # rows are added in the order they were created, parents first
+        for iid in [iid for iid in self.values if iid in self.dirty]:
+            values = tuple(self.values[iid].values())
+            rendered = self.rendered.get(iid)
+            if rendered is None:
+                self.tree.insert(
+                    self.parents[iid],
+                    "end",
+                    iid=iid,
+                    text=self.labels[iid],
+                    values=values,
+                    open=True,
+                )
+            else:
+                label, old_values = rendered
+                if label != self.labels[iid]:
+                    self.tree.item(iid, text=self.labels[iid])
+                for column, old, new in zip(self.COLUMNS, old_values, values):
+                    if old != new:
+                        self.tree.set(iid, column, new)
+            self.rendered[iid] = (self.labels[iid], values)
+        self.dirty.clear()
+
+
+def handle_progress_event(status, event):
+    """Handle a progress event from lalalai_splitter."""
+    fields = event.fields
+
+    # events about one file of a batch of files, or one segment of a long
+    # file, say which
+    prefix = ""
+    if event.file_index is not None:
+        prefix = f"[{event.file_index}] "
+    if event.segment is not None:
+        prefix += f"(part {event.segment}) "
+
+    match event.name:
+        case "uploading":
+            status.set_overall_status("Uploading...")
+        case "compressing":
+            status.set_overall_status("Compressing for upload...")
+        case "compressed":
+            status.set_overall_status(
+                f"Compressed {fields['ratio']}x in {fields['seconds']}s."
+            )
+        case "compression_failed":
+            status.set_overall_status(f"Uploading uncompressed: {fields['message']}")
+        case "compression_saved":
+            status.set_overall_status(
+                f"Compression saved {fields['seconds']}s of uploading."
+            )
+        case "upload_cached":
+            status.set_overall_status("Reusing earlier upload.")
+        case "upload_progress":
+            status.set_overall_status(
+                f"Uploading: {field(event, 'percent')} "
+                f"{field(event, 'bytes_per_second')}"
+            )
+        case "upload_retry":
+            status.set_overall_status(f"Retrying upload ({fields['attempt']})...")
+        case "uploaded":
+            status.set_overall_status("Upload complete.")
+        case "already_extracted":
+            status.set_stem_status(event.stem, prefix + "Already extracted.")
+        case "split_start":
+            status.set_stem_status(event.stem, prefix + "Splitting requested...")
+            status.set_overall_status("Processing...")
+        case "split_waiting":
+            status.set_stem_status(
+                event.stem, prefix + "Waiting for split to start..."
+            )
+        case "split_progress":
+            status.set_stem_status(
+                event.stem, prefix + f"Splitting: {field(event, 'percent')}"
+            )
+        case "download_start":
+            status.set_stem_status(
+                event.stem, prefix + f"Downloading {event.track_type}..."
+            )
+        case "download_progress":
+            status.set_stem_status(
+                event.stem,
+                prefix
+                + f"Downloading {event.track_type}: {field(event, 'percent')} "
+                f"{field(event, 'bytes_per_second')}",
+            )
+        case "download_complete":
+            status.set_stem_status(
+                event.stem, prefix + f"{event.track_type} downloading complete."
+            )
+        case "split_complete":
+            status.set_stem_status(event.stem, prefix + "Split and download complete.")
+        case "backing_synthesized":
+            status.set_stem_status(event.stem, prefix + "Backing track made locally.")
+        case "backing_synthesis_failed":
+            status.set_stem_status(event.stem, prefix + "Downloading backing track...")
+        case "silence_trimmed":
+            status.set_overall_status(
+                f"Trimmed {fields['seconds']}s of silence before uploading."
+            )
+        case "silence_not_restored":
+            status.set_stem_status(
+                event.stem,
+                prefix + f"Couldn't pad {event.track_type} back out to full length.",
+            )
+        case "decompression_failed":
+            status.set_stem_status(
+                event.stem,
+                prefix + f"Kept {event.track_type} as FLAC: {fields['message']}",
+            )
+        case "segmenting":
+            status.set_overall_status(
+                prefix + f"Processing in {fields['count']} segments..."
+            )
+        case "segment_complete":
+            status.set_overall_status(
+                prefix + f"Segment {event.segment} of {fields['count']} done."
+            )
+        case "first_segment":
+            status.set_overall_status(
+                prefix + f"First segment done in {fields['seconds']}s."
+            )
+        case "segment_retry":
+            status.set_overall_status(
+                prefix + f"Retrying segment ({fields['attempt']})..."
+            )
+        case "segment_failed":
+            status.set_overall_status(prefix + f"Segment failed: {fields['message']}")
+        case "stitched":
+            status.set_stem_status(
+                event.stem, prefix + f"{event.track_type} stitched together."
+            )
+        case "stem_failed":
+            status.set_stem_status(event.stem, prefix + f"Failed: {fields['message']}")
+        case "api_retry":
+            status.set_overall_status(
+                f"Server busy, retrying in {fields['seconds']}s..."
+            )
+        case "api_paused":
+            status.set_overall_status(
+                f"Server unhealthy, pausing for {fields['seconds']}s..."
+            )
+        case "api_resumed":
+            status.set_overall_status("Server back, resuming.")
+        case "license_exhausted":
+            status.set_overall_status(
+                f"API Key {fields['license']} is out of minutes."
+            )
+        case "unmixing_complete":
+            # one file of a batch, or one segment of a file, being done
+            # isn't the end of the batch
+            if event.file_index is None and event.segment is None:
+                status.set_overall_status("All Done.")
+                status.finish()
+        case "file_start":
+            status.set_overall_status(
+                f"Starting file {event.file_index} of {fields['file_count']}..."
+            )
+        case "file_complete":
+            status.set_overall_status(f"{prefix}File done.")
+        case "file_failed":
+            status.set_overall_status(f"{prefix}File failed: {fields['message']}")
+        case "batch_complete":
+            status.set_overall_status(
+                f"All Done, {fields['failed']} of {fields['file_count']} files failed."
+            )
+            status.finish()
         case _:
-            print(f"unhandled progress message: {message}")
+            # anything else has no status line of its own
+            pass
 
 
 store = KeyValueStore(os.path.expanduser("~/.unmixer.sqlite3"))